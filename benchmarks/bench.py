@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the transliteration and suggestion hot paths.
+
+Every benchmark runs over the bundled corpus of roman Bangla text. Results
+are printed as a table and may be written to a JSON file; comparing with
+the results of an earlier release reports regressions.
+
+Usage:
+    python3 benchmarks/bench.py [-o RESULTS] [--compare BASELINE] [NAME...]
+
+Times are per operation: a character of input for the parser, the stream
+and the engine, a word for everything else.
+"""
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+from os.path import join as pjoin
+from unittest import mock
+
+sys.path.insert(0, pjoin(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sphotiklib.parser import Parser
+from sphotiklib.ruleparser import Rule
+from sphotiklib.stream import transliterate_stream
+from sphotiklib.cache import TransliterationCache
+
+from sphotik.parser import EditingParser
+from sphotik.history import HistoryManager
+from sphotik.core import EngineCore, Frontend
+from sphotik.fakeibus import MainContext
+
+CORPUS_PATH = pjoin(os.path.dirname(os.path.abspath(__file__)), 'corpus.txt')
+
+DEFAULT_RULENAME = 'avro'
+
+# Benchmarks are run this many times; the median is reported.
+DEFAULT_REPEAT = 5
+
+# Loops of a run are added until it takes at least this many seconds.
+DEFAULT_MIN_TIME = 0.1
+
+# Number of rows of made up words in the large history database.
+DEFAULT_HISTORY_ROWS = 100000
+
+# A benchmark is a regression if it is slower than the baseline by more
+# than this fraction.
+DEFAULT_TOLERANCE = 0.2
+
+RESULTS_FORMAT = 'sphotik-benchmarks'
+RESULTS_VERSION = 1
+
+
+class Corpus:
+
+    def __init__(self, path, rulename, history_rows):
+        with open(path) as f:
+            self.lines = [line.strip() for line in f if line.strip()]
+        self.text = "\n".join(self.lines)
+        self.words = self.text.split()
+        self.rulename = rulename
+        self.rule = Rule(rulename)
+        self.history_rows = history_rows
+
+
+# Benchmarks by name, in the order of definition.
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """ Register a benchmark. It is a context manager, made of a generator
+    function taking the corpus and yielding a function to time and the
+    number of operations it performs.
+    """
+    def register(function):
+        BENCHMARKS[name] = contextlib.contextmanager(function)
+        return function
+    return register
+
+
+@benchmark('rule_load')
+def _rule_load(corpus):
+    yield lambda: Rule(corpus.rulename), 1
+
+
+@benchmark('rule_compile')
+def _rule_compile(corpus):
+    yield lambda: Rule(corpus.rulename, use_snapshot=False), 1
+
+
+@benchmark('parser_insert_bulk')
+def _parser_insert_bulk(corpus):
+    def run():
+        for line in corpus.lines:
+            Parser(corpus.rule).insert(line)
+    yield run, sum(map(len, corpus.lines))
+
+
+@benchmark('parser_insert_chars')
+def _parser_insert_chars(corpus):
+    def run():
+        for line in corpus.lines:
+            parser = Parser(corpus.rule)
+            for c in line:
+                parser.insert(c)
+    yield run, sum(map(len, corpus.lines))
+
+
+def _word_parsers(corpus, parser_class=Parser):
+    parsers = []
+    for word in corpus.words:
+        parser = parser_class(corpus.rule)
+        parser.insert(word)
+        parsers.append(parser)
+    return parsers
+
+
+@benchmark('render_text')
+def _render_text(corpus):
+    parsers = _word_parsers(corpus)
+
+    def run():
+        for parser in parsers:
+            parser.render_text(parser.cord)
+    yield run, len(parsers)
+
+
+@benchmark('preedit')
+def _preedit(corpus):
+    parsers = _word_parsers(corpus, EditingParser)
+    # The cursor mark is rendered inside of words.
+    for parser in parsers:
+        parser.cursor = len(parser.cord) // 2
+
+    def run():
+        for parser in parsers:
+            parser.preedit
+    yield run, len(parsers)
+
+
+@benchmark('suggest_flag_modifications')
+def _suggest_flag_modifications(corpus):
+    parsers = _word_parsers(corpus, EditingParser)
+
+    def run():
+        for parser in parsers:
+            parser.suggest_flag_modifications()
+    yield run, len(parsers)
+
+
+@benchmark('stream')
+def _stream(corpus):
+    def run():
+        "".join(transliterate_stream(corpus.rule, [corpus.text]))
+    yield run, len(corpus.text)
+
+
+@benchmark('stream_cached')
+def _stream_cached(corpus):
+    cache = TransliterationCache()
+
+    def run():
+        "".join(transliterate_stream(corpus.rule, [corpus.text], cache=cache))
+    yield run, len(corpus.text)
+
+
+def _made_up_words(count):
+    # Distinct words looking like roman Bangla, with made up outputs; the
+    # outputs do not matter to the database.
+    rand = random.Random(0)
+    letters = string.ascii_lowercase
+    words = set()
+    while len(words) < count:
+        words.add("".join(
+            rand.choice(letters) for i in range(rand.randint(3, 10))))
+    return [(word, word[::-1]) for word in sorted(words)]
+
+
+@contextlib.contextmanager
+def _history(corpus, large):
+    """ A history manager over a database of the corpus, along with the
+    pairs of roman and bangla words of the corpus.
+    """
+    pairs = [
+        (word, parser.text)
+        for word, parser in zip(corpus.words, _word_parsers(corpus))]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pjoin(tmpdir, 'history.sqlite')
+        history = HistoryManager(path)
+        for roman_text, bangla_text in pairs:
+            history.save(roman_text, bangla_text)
+        if large:
+            for roman_text, bangla_text in _made_up_words(
+                    corpus.history_rows):
+                history.save(roman_text, bangla_text)
+        # Closing gives up on writing after a while; the large database
+        # takes longer.
+        history.flush(timeout=None)
+        history.close()
+
+        # Searches should hit the disk, not the history of the session.
+        history = HistoryManager(path)
+        try:
+            yield history, pairs
+        finally:
+            history.close()
+
+
+def _history_benchmarks(size, large):
+
+    @benchmark('history_search_' + size)
+    def _search(corpus):
+        with _history(corpus, large) as (history, pairs):
+            def run():
+                for roman_text, _ in pairs:
+                    history.search(roman_text)
+            yield run, len(pairs)
+
+    @benchmark('history_complete_' + size)
+    def _complete(corpus):
+        with _history(corpus, large) as (history, pairs):
+            def run():
+                for roman_text, _ in pairs:
+                    history.complete(roman_text[:2], 5)
+            yield run, len(pairs)
+
+    # Saving hands the words over to the writer of history...
+    @benchmark('history_save_' + size)
+    def _save(corpus):
+        with _history(corpus, large) as (history, pairs):
+            def run():
+                for roman_text, bangla_text in pairs:
+                    history.save(roman_text, bangla_text)
+            yield run, len(pairs)
+
+    # ... which writes them to disk in the background.
+    @benchmark('history_save_flush_' + size)
+    def _save_flush(corpus):
+        with _history(corpus, large) as (history, pairs):
+            def run():
+                for roman_text, bangla_text in pairs:
+                    history.save(roman_text, bangla_text)
+                history.flush(timeout=None)
+            yield run, len(pairs)
+
+
+_history_benchmarks('small', large=False)
+_history_benchmarks('large', large=True)
+
+
+@benchmark('engine_keys')
+def _engine_keys(corpus):
+    class Core(EngineCore):
+        enchant_dict_names = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        loop = MainContext()
+        core = Core(Frontend(), loop, pjoin(tmpdir, 'history.sqlite'))
+
+        def run():
+            # Updates are flushed at the end of every line, as if the
+            # keys were typed too fast for the update timer.
+            for line in corpus.lines:
+                for c in line:
+                    core.process_key_event(ord(c), 0, 0)
+                core.flush()
+                loop.run_until_idle()
+        try:
+            yield run, sum(map(len, corpus.lines))
+        finally:
+            core.close()
+
+
+def measure(function, repeat, min_time):
+    """ Returns the number of loops of a run and the times of the runs. """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    times = [elapsed]
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            function()
+        times.append(time.perf_counter() - start)
+    return number, times
+
+
+def run_benchmarks(names, corpus, repeat, min_time, out=sys.stdout):
+    results = {}
+    print("{:<28} {:>12} {:>12}  (microseconds per op)".format(
+        'benchmark', 'median', 'min'), file=out)
+
+    for name in names:
+        with BENCHMARKS[name](corpus) as (function, ops):
+            number, times = measure(function, repeat, min_time)
+
+        per_op = [t / number / ops for t in times]
+        results[name] = {
+            'ops': ops,
+            'loops': number,
+            'median': statistics.median(per_op),
+            'min': min(per_op),
+        }
+        print("{:<28} {:>12.3f} {:>12.3f}".format(
+            name, 1e6 * results[name]['median'], 1e6 * results[name]['min']),
+            file=out)
+        out.flush()
+
+    return results
+
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+    """ Print the ratios of medians to those of the baseline. Returns the
+    names of the regressed benchmarks.
+    """
+    regressions = []
+    print("{:<28} {:>12}".format('benchmark', 'vs baseline'), file=out)
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print("{:<28} {:>11.2f}x{}".format(
+            name, ratio, "  REGRESSION" if regressed else ""), file=out)
+    return regressions
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        prog='python3 benchmarks/bench.py',
+        description="Run the benchmarks of sphotik.")
+    argparser.add_argument(
+        'names', metavar='NAME', nargs='*',
+        help="Benchmarks to run (default: all of them).")
+    argparser.add_argument(
+        '-o', '--output', default=None,
+        help="Write the results to this JSON file.")
+    argparser.add_argument(
+        '--compare', metavar='BASELINE', default=None,
+        help=(
+            "Compare with the results in this JSON file; exit with status"
+            " 1 on regressions."))
+    argparser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help=(
+            "Slowdown beyond which a benchmark is a regression"
+            " (default: %(default)s)."))
+    argparser.add_argument(
+        '--repeat', type=int, default=DEFAULT_REPEAT,
+        help="Number of runs of every benchmark (default: %(default)s).")
+    argparser.add_argument(
+        '--min-time', type=float, default=DEFAULT_MIN_TIME,
+        help="Minimum seconds of a run (default: %(default)s).")
+    argparser.add_argument(
+        '--history-rows', type=int, default=DEFAULT_HISTORY_ROWS,
+        help=(
+            "Number of words in the large history database"
+            " (default: %(default)s)."))
+    argparser.add_argument(
+        '--corpus', default=CORPUS_PATH,
+        help="Corpus of roman text (default: the bundled one).")
+    argparser.add_argument(
+        '-r', '--rule', dest='rulename', default=DEFAULT_RULENAME,
+        help="Name of a builtin rule set (default: %(default)s).")
+    args = argparser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        argparser.error("Unknown benchmarks: {}".format(", ".join(unknown)))
+
+    # Snapshots of rules are written to a cache of the run, leaving that
+    # of the user alone; 'rule_load' does not depend on what is in there.
+    with tempfile.TemporaryDirectory() as cachedir, mock.patch.dict(
+            os.environ, XDG_CACHE_HOME=cachedir):
+        corpus = Corpus(args.corpus, args.rulename, args.history_rows)
+        results = run_benchmarks(names, corpus, args.repeat, args.min_time)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'format': RESULTS_FORMAT,
+                'version': RESULTS_VERSION,
+                'time': int(time.time()),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'corpus': {
+                    'lines': len(corpus.lines),
+                    'words': len(corpus.words),
+                    'chars': len(corpus.text)},
+                'history_rows': args.history_rows,
+                'results': results}, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -157,6 +157,26 @@ try:
 except Exception as e:
     print("[ ERROR ] Failed to install ibus component file: {}".format(e))
     sys.exit(6)
+
+# Build precompiled snapshot of the rules, so that engine instances
+# don't have to parse the rule files on every startup.
+from sphotik.engine import RULESET_NAME
+from sphotiklib import snapshot
+from sphotiklib.ruleparser import Rule
+try:
+    sources = Rule.read_sources(RULESET_NAME)
+    snapshot_file = snapshot.save_snapshot(
+        RULESET_NAME,
+        snapshot.compute_digest(sources),
+        Rule.compile_sources(sources),
+        os.path.join(install_dir, "sphotiklib", "snapshots"))
+
+    os.chown(snapshot_file, INSTALLED_FILE_OWNER, INSTALLED_FILE_GROUP)
+    files_installed.append(snapshot_file)
+    print("Installed '{}'".format(snapshot_file))
+except Exception as e:
+    # This is not fatal; rules are parsed on demand without a snapshot.
+    print("[ WARNING ] Failed to build rule snapshot: {}".format(e))
 #--------------------------------------------------------------------/
 
 # Comfort the user, for she has jumped through such long hoops
@@ -0,0 +1,1024 @@
+"""
+Logic of the input method, free of IBus.
+
+An 'EngineCore' takes key events and puts out preedit text, candidates and
+commits through a frontend; the IBus engine is a thin adapter around it.
+Without IBus, the core is run by tests, benchmarks and trace replays.
+"""
+import time
+import heapq
+import os.path
+import tempfile
+import unittest
+import unicodedata
+
+from sphotiklib.ruleparser import Rule
+from sphotiklib.cache import LRUCache
+
+from . import keysyms
+from .parser import EditingParser, Preedit
+from .history import (
+    HistoryManager, HISTORY_FILE_PATH, DEFAULT_GENERALIZERS)
+from .suggester import AsyncSuggester
+from .scheduler import (
+    UpdateScheduler, UPDATE_DEBOUNCE_DELAY, UPDATE_MAX_DELAY)
+from .latency import LatencyRecorder
+
+
+RULESET_NAME = "avro"
+
+MAX_WORD_LENGTH = 40
+ENCHANT_DICT_NAMES = ['bn_BD', 'bn']
+# Completions from history are offered for inputs this long or longer.
+COMPLETION_MIN_INPUT_LENGTH = 2
+COMPLETION_LIMIT = 5
+# Number of inputs to remember the candidates of.
+CANDIDATE_CACHE_SIZE = 64
+
+LOOKUP_TABLE_PAGE_SIZE = 5
+LOOKUP_TABLE_IS_ROUND = False
+
+
+# Keys to look after. An example of uninteresting event is
+# CTRL key press event ( note that this is seperate from
+# CTRL + some other key press event ).
+INTERESTING_KEYS = set(keysyms.KEYSYMS.values())
+
+# Ignore key release events.
+STATES_TO_IGNORE = keysyms.RELEASE_MASK
+
+# Commit as soon as ALT/CTRL/SUPER modifiers are set.
+# Pass the character unmodified as it is most probably
+# an editor command.
+STATES_TO_COMMIT_ASAP = (
+    keysyms.CONTROL_MASK
+    | keysyms.MOD1_MASK
+    | keysyms.SUPER_MASK
+    | keysyms.META_MASK
+    | keysyms.HYPER_MASK)
+
+
+def count_graphemes(text):
+    """This is probably the most stupid grapheme counter ever,
+    but hopefully it will be enough for our purpose.
+    """
+    return len([
+        # Count all chars except unicode 'mark's.
+        c for c in text if not unicodedata.category(c).startswith('M')])
+
+
+class _UselessEnchantDict:
+
+    def suggest(self, text):
+        return []
+
+
+def load_enchant_dict(names):
+    """ Create an enchant dictionary from any of the specified names. If
+    all failed, create a fake dictionary object that does nothing.
+    """
+    if not names:
+        return _UselessEnchantDict()
+
+    for d in names:
+        try:
+            import enchant
+
+            try:
+                return enchant.Dict(d)
+            except enchant.errors.DictNotFoundError:
+                pass
+        except ImportError:
+            print(
+                "[Warning] Failed to find enchant binding for python."
+                " Dictionary suggestions will not be available.")
+            return _UselessEnchantDict()
+
+    print(
+        "[Warning] Failed to find any Bangla dictionary."
+        " Dictionary suggestions will not be available.")
+    return _UselessEnchantDict()
+
+
+class LookupTable:
+    """ A lookup table of candidate texts, paged and with a cursor; works
+    like the 'LookupTable' of IBus.
+    """
+
+    def __init__(self, page_size, cursor_pos=0, cursor_visible=True,
+                 round=False):
+        self._page_size = page_size
+        self._cursor_visible = cursor_visible
+        self._round = round
+        self._candidates = []
+        self._cursor_pos = cursor_pos
+
+    def clear(self):
+        self._candidates = []
+        self._cursor_pos = 0
+
+    def append_candidate(self, text):
+        self._candidates.append(text)
+
+    def get_candidate(self, index):
+        return self._candidates[index]
+
+    def get_number_of_candidates(self):
+        return len(self._candidates)
+
+    def get_page_size(self):
+        return self._page_size
+
+    def is_round(self):
+        return self._round
+
+    def is_cursor_visible(self):
+        return self._cursor_visible
+
+    def get_cursor_pos(self):
+        return self._cursor_pos
+
+    def set_cursor_pos(self, pos):
+        self._cursor_pos = pos
+
+    def get_cursor_in_page(self):
+        return self._cursor_pos % self._page_size
+
+    def cursor_up(self):
+        if self._cursor_pos == 0:
+            if not self._round or not self._candidates:
+                return False
+            self._cursor_pos = len(self._candidates) - 1
+            return True
+
+        self._cursor_pos -= 1
+        return True
+
+    def cursor_down(self):
+        if self._cursor_pos >= len(self._candidates) - 1:
+            if not self._round:
+                return False
+            self._cursor_pos = 0
+            return True
+
+        self._cursor_pos += 1
+        return True
+
+    def page_up(self):
+        if self._cursor_pos < self._page_size:
+            if not self._round or not self._candidates:
+                return False
+            last_page = (len(self._candidates) - 1) // self._page_size
+            self._cursor_pos = min(
+                last_page * self._page_size + self._cursor_pos,
+                len(self._candidates) - 1)
+            return True
+
+        self._cursor_pos -= self._page_size
+        return True
+
+    def page_down(self):
+        page, pos = divmod(self._cursor_pos, self._page_size)
+        if (page + 1) * self._page_size >= len(self._candidates):
+            if not self._round:
+                return False
+            self._cursor_pos = pos
+            return True
+
+        self._cursor_pos = min(
+            self._cursor_pos + self._page_size, len(self._candidates) - 1)
+        return True
+
+
+class _Candidates:
+    """ Candidates of an input, as (type, freq, text) entries. """
+
+    def __init__(self, hist):
+        self.hist = hist
+        self.entries = []
+
+        # Whether dictionary suggestions are among the entries.
+        self.complete = False
+
+    def add_entry(self, type_, freq, text):
+        self.entries.append((type_, freq, text))
+
+
+class LookupTableManager:
+    """ Collects candidates of the lookup table.
+
+    Entries of the same text are merged as they are added, keeping the
+    best ranked one. Candidates are only handed over to the lookup table
+    a page at a time, as the user gets to them; a frontend converts only
+    those.
+    """
+
+    def __init__(self, table):
+        self._table = table
+        self._page_size = self._table.get_page_size()
+        self.clear()
+
+    def clear(self):
+        self._table.clear()
+        self._finalized = False
+
+        # Best entry of every text. Every entry is a tuple of it's rank
+        # and three other elements: (rank, type, freq, text)
+        self._entries = {}
+        self._seq = 0
+        self._max_freq = None
+
+        # Place to hold the entries at exact order matching
+        # the underlaying lookup table. Every entry is a tuple of
+        # three elements: (type, freq, text)
+        self._finalized_entries = []
+
+    def add_entry(self, type_, freq, text):
+        # Entries of type 'default' always go to top of the list. The
+        # rest are sorted by their frequency of appearence; equals keep
+        # the order of their addition.
+        rank = (type_ == 'default', freq, -self._seq)
+        self._seq += 1
+        if self._max_freq is None or freq > self._max_freq:
+            self._max_freq = freq
+
+        entry = self._entries.get(text)
+        if entry is not None and entry[0] >= rank:
+            return
+
+        self._entries[text] = (rank, type_, freq, text)
+        self._finalized = False
+
+    def _load(self, count):
+        # Hand over the best 'count' entries to the lookup table.
+        loaded = len(self._finalized_entries)
+        if count <= loaded or loaded >= len(self._entries):
+            return
+
+        for rank, type_, freq, text in heapq.nlargest(
+                count, self._entries.values())[loaded:]:
+            self._finalized_entries.append((type_, freq, text))
+            self._table.append_candidate(text)
+
+    @property
+    def table(self):
+        if self._finalized:
+            return self._table
+
+        self._table.clear()
+        self._finalized_entries = []
+
+        # Set the cursor to text with highest frequency. We are only
+        # concerned with the first candidate with maximum frequency.
+        ranks = [e[0] for e in self._entries.values()
+                 if e[2] == self._max_freq]
+        index = 0
+        if ranks:
+            rank = max(ranks)
+            index = sum(1 for e in self._entries.values() if e[0] > rank)
+
+        self._load(max(self._page_size, index + 1))
+        self._table.set_cursor_pos(index)
+
+        self._finalized = True
+        return self._table
+
+    def entry_exists(self, text):
+        return text in self._entries
+
+    def get_entry(self, index):
+        return self._finalized_entries[index]
+
+    def get_entry_under_cursor(self):
+        return self.get_entry(self._table.get_cursor_pos())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cursor_up(self):
+        table = self.table
+        if table.is_round() and table.get_cursor_pos() == 0:
+            self._load(len(self._entries))
+        table.cursor_up()
+
+    def cursor_down(self):
+        table = self.table
+        self._load(table.get_cursor_pos() + 2)
+        table.cursor_down()
+
+    def page_up(self):
+        table = self.table
+        if table.is_round() and table.get_cursor_pos() < self._page_size:
+            self._load(len(self._entries))
+        table.page_up()
+
+    def page_down(self):
+        table = self.table
+        page = table.get_cursor_pos() // self._page_size
+        self._load((page + 2) * self._page_size)
+        table.page_down()
+
+    def select(self, text):
+        """ Put the cursor on the candidate of 'text'. """
+        table = self.table
+        rank = self._entries[text][0]
+        index = sum(1 for e in self._entries.values() if e[0] > rank)
+        self._load(index + 1)
+        table.set_cursor_pos(index)
+
+
+class Frontend:
+    """ Receives the output of an 'EngineCore'. This one ignores it. """
+
+    def commit(self, text):
+        pass
+
+    def show_preedit(self, preedit):
+        pass
+
+    def hide_preedit(self):
+        pass
+
+    def show_auxiliary(self, text, visible):
+        pass
+
+    def show_lookup_table(self, table, visible):
+        pass
+
+    def forward_key(self, keyval, keycode, state):
+        pass
+
+
+class EngineCore:
+    """ Key handling and candidate logic of the engine.
+
+    Key events go in through 'process_key_event'; the output goes to the
+    methods of 'frontend', see 'Frontend'. Timers and callbacks from other
+    threads are run by 'loop', which offers the 'timeout_add',
+    'source_remove' and 'idle_add' functions of GLib. The 'clock' has to
+    agree with the timers of the loop.
+    """
+    ruleset_name = RULESET_NAME
+
+    max_word_length = MAX_WORD_LENGTH
+    enchant_dict_names = ENCHANT_DICT_NAMES
+    history_file_path = os.path.expanduser(HISTORY_FILE_PATH)
+    history_generalizers = DEFAULT_GENERALIZERS
+
+    completion_min_input_length = COMPLETION_MIN_INPUT_LENGTH
+    completion_limit = COMPLETION_LIMIT
+    candidate_cache_size = CANDIDATE_CACHE_SIZE
+
+    update_debounce_delay = UPDATE_DEBOUNCE_DELAY
+    update_max_delay = UPDATE_MAX_DELAY
+
+    # Latencies of the phases of key handling, shared by all engines.
+    latency_recorder = LatencyRecorder()
+
+    # Key events are written to this 'trace.TraceRecorder', if any.
+    trace_recorder = None
+
+    lookup_table_page_size = LOOKUP_TABLE_PAGE_SIZE
+    lookup_table_is_round = LOOKUP_TABLE_IS_ROUND
+
+    def __init__(
+            self, frontend, loop, history_file_path=None,
+            clock=time.monotonic):
+        self.frontend = frontend
+
+        self._rule = Rule(self.ruleset_name)
+        self._parser = EditingParser(self._rule)
+        self._history_manager = HistoryManager(
+            history_file_path or self.history_file_path,
+            self.history_generalizers)
+        self._lookup_table_manager = LookupTableManager(LookupTable(
+            self.lookup_table_page_size,
+            0,  # Cursor index.
+            True,  # Cursor is visible.
+            self.lookup_table_is_round))
+
+        self._enchant_dict = load_enchant_dict(self.enchant_dict_names)
+
+        # Dictionary suggestions are made in the background. Every remake
+        # of the lookup table is a new generation; suggestions made for
+        # an older one are thrown away.
+        self._generation = 0
+        self._suggester = AsyncSuggester(
+            self._suggest_from_dict, loop.idle_add)
+
+        # Recently made candidates, by input. Saving history outdates
+        # all of them.
+        self._candidate_cache = LRUCache(self.candidate_cache_size)
+        self._candidates = None
+
+        # Updates after editing keys are coalesced. Commits and lookup
+        # table navigation run the pending update first, as they act
+        # upon the candidates of the current input.
+        self._scheduler = UpdateScheduler(
+            self._update, loop.timeout_add, loop.source_remove,
+            self.update_debounce_delay, self.update_max_delay, clock)
+
+    def _update_lookup_table(self, remake=True):
+        ltm = self._lookup_table_manager
+        default_text = self._parser.text
+
+        # If not instructed to remake, don't.
+        if not remake:
+            self._show_lookup_table()
+            return
+
+        ltm.clear()  # Clear lookup table.
+        self._generation += 1
+
+        # No point in making a lookup table if we don't have
+        # enough of transliterated text.
+        if not len(default_text) > 0:
+            self._suggester.cancel()
+            self._show_lookup_table()
+            return
+
+        # Candidates of an input are the same until history changes,
+        # hence they are remembered across keystrokes.
+        key = (
+            self._parser.input_text,
+            tuple((bead.v, bead.flags) for bead in self._parser.cord))
+        candidates = self._candidate_cache.get(key)
+        if candidates is None:
+            with self.latency_recorder.measure('candidates'):
+                candidates = self._find_candidates(default_text)
+            self._candidate_cache.put(key, candidates)
+        self._candidates = candidates
+
+        for entry in candidates.entries:
+            ltm.add_entry(*entry)
+
+        # Ask for dictionary suggestions; they are added on arrival.
+        if not candidates.complete:
+            self._suggester.request(
+                self._generation, default_text, self._add_dict_suggestions)
+
+        # Finalize the table.
+        with self.latency_recorder.measure('table'):
+            table = ltm.table
+
+        # If parser-cursor is not residing at it's natural rightmost
+        # position, table-cursor should sit on top of default text.
+        if not self._parser.cursor >= len(self._parser.cord):
+            table.set_cursor_pos(0)
+
+        self._show_lookup_table()
+
+    def _show_lookup_table(self):
+        ltm = self._lookup_table_manager
+        self.frontend.show_lookup_table(ltm.table, len(ltm) > 0)
+
+    def _suggest_from_dict(self, text):
+        with self.latency_recorder.measure('enchant'):
+            return self._enchant_dict.suggest(text)
+
+    def _find_candidates(self, default_text):
+        # hist = self._history_manager.search(self._parser.input_text)
+        fuzzy = set()
+        with self.latency_recorder.measure('history'):
+            hist = self._history_manager.search_without_punctuation(
+                self._parser, fuzzy)
+
+        # Words used for a generalization of the input may be other words;
+        # they are listed, but never picked over the default text.
+        for text in fuzzy:
+            hist[text] = 0
+        candidates = _Candidates(hist)
+        add_entry = candidates.add_entry
+
+        # Add default text to suggestions.
+        add_entry("default", hist[default_text], default_text)
+
+        # Add simple suggestions made by flag modifications.
+        for sug in self._parser.suggest_flag_modifications():
+            add_entry("flagmod", hist[sug], sug)
+
+        # Add the words used for the input, or a generalization of it.
+        for sug, freq in hist.items():
+            add_entry("history", freq, sug)
+
+        # Add the most used words from history, that start with the input.
+        input_text = self._parser.input_text
+        if len(input_text) >= self.completion_min_input_length:
+            with self.latency_recorder.measure('completion'):
+                completions = (
+                    self._history_manager.complete_without_punctuation(
+                        self._parser, self.completion_limit))
+            for sug, _ in completions:
+                add_entry("completion", hist[sug], sug)
+
+        return candidates
+
+    def _add_dict_suggestions(self, generation, text, suggestions):
+        # Suggestions of an outdated input are of no use.
+        if generation != self._generation or text != self._parser.text:
+            return False
+
+        # Keep the cursor on the same candidate; the user may have moved
+        # it while waiting.
+        ltm = self._lookup_table_manager
+        selected = ltm.get_entry_under_cursor()[2]
+
+        candidates = self._candidates
+        for sug in suggestions:
+            entry = ("dict", candidates.hist[sug], sug)
+            candidates.add_entry(*entry)
+            ltm.add_entry(*entry)
+        candidates.complete = True
+
+        ltm.select(selected)
+        self._update(remake_lookup_table=False)
+        return False
+
+    def _update(self, remake_lookup_table=True):
+        with self.latency_recorder.measure('update'):
+            self._update_all(remake_lookup_table)
+
+    def _update_all(self, remake_lookup_table):
+        # A remake covers the pending update, if any.
+        if remake_lookup_table:
+            self._scheduler.cancel()
+
+        self._update_lookup_table(remake_lookup_table)
+
+        # Update preedit text. If lookup table has the 'default'
+        # text selected, then preedit text should be the special
+        # one with the custom preedit cursor in it. Otherwise, we
+        # show currently selected candidate as preedit text.
+        #-------------------------------------------------------------------\
+        try:
+            type_, freq, text = (
+                self._lookup_table_manager.get_entry_under_cursor())
+
+            if type_ == "default":
+                preedit = self._parser.preedit
+            else:
+                preedit = Preedit(text, None, None, None)
+
+            self.frontend.show_preedit(preedit)
+
+        except IndexError:
+            self.frontend.hide_preedit()
+        #-------------------------------------------------------------------/
+
+        # Update auxiliary text.
+        self.frontend.show_auxiliary(
+            self._parser.input_text, len(self._parser.cord) > 0)
+
+        # Commit text if our cord length gets bigger than permissible limits.
+        if len(self._parser.cord) > self.max_word_length:
+            self._commit()
+            self._update()
+
+    def _save_history(self, bangla_text):
+        self._history_manager.save_without_punctuation(
+            self._parser, bangla_text)
+
+        # Candidates are ranked by history, which just changed.
+        self._candidate_cache.clear()
+
+    def _commit_from_lookup_table(self):
+        if not len(self._lookup_table_manager) > 0:
+            return False
+
+        type_, freq, text = (
+            self._lookup_table_manager.get_entry_under_cursor())
+
+        # We don't want to commit 'default' texts from this function.
+        if type_ == 'default':
+            return False
+
+        # Do commit.
+        self.frontend.commit(text)
+
+        # Save history.
+        self._save_history(text)
+
+        # Clear parser.
+        self._parser.clear()
+
+        return True
+
+    def _commit(self):
+        if not self._commit_from_lookup_table():
+            # Do commit.
+            self.frontend.commit(self._parser.text)
+
+            # Save history.
+            self._save_history(self._parser.text)
+
+            # Clear parser.
+            self._parser.clear()
+
+    def _commit_upto_cursor(self):
+        if not self._commit_from_lookup_table():
+            cursor = self._parser.cursor
+
+            to_commit = self._parser.cord[:cursor]
+            to_retain = self._parser.cord[cursor:]
+
+            # Do commit.
+            self.frontend.commit(self._parser.render_text(to_commit))
+
+            # Save history.
+            self._save_history(self._parser.render_text(to_commit))
+
+            # Create new parser with uncommited text.
+            self._parser = EditingParser(self._rule, to_retain, 0)
+
+    def candidate_clicked(self, index, button, state):
+        pass
+
+    def enable(self):
+        self._parser.clear()
+
+    def disable(self):
+        self._parser.clear()
+
+        # Have the history of this session written to disk, without
+        # waiting for a slow disk in the main loop.
+        self._history_manager.flush(timeout=0)
+
+    def focus_in(self):
+        self._parser.clear()
+
+    def focus_out(self):
+        self._parser.clear()
+
+    def flush(self):
+        """ Run the pending update, if any, right away. """
+        self._scheduler.flush()
+
+    def close(self):
+        self._scheduler.cancel()
+        self._suggester.close()
+        self._history_manager.close()
+
+    def process_key_event(self, keyval, keycode, state):
+        """ Handle a key event. Returns whether the key was consumed. """
+        if self.trace_recorder is not None:
+            self.trace_recorder.record(keyval, state)
+
+        with self.latency_recorder.measure('key'):
+            return self._process_key_event(keyval, keycode, state)
+
+    def _process_key_event(self, keyval, keycode, state):
+        if keyval not in INTERESTING_KEYS:
+            return False
+
+        elif state & STATES_TO_IGNORE:
+            return False
+
+        elif state & STATES_TO_COMMIT_ASAP:
+            self._scheduler.flush()
+            self._commit()
+            self._update()
+            return False
+
+        elif keyval == keysyms.space:
+            self._scheduler.flush()
+            keystr = keysyms.keyval_to_unicode(keyval)
+            with self.latency_recorder.measure('insert'):
+                self._parser.insert(keystr)
+            self._commit_upto_cursor()
+            self._update()
+            return True
+
+        elif keyval == keysyms.Return:
+            self._scheduler.flush()
+            if len(self._parser.cord) > 0:
+                self._commit_upto_cursor()
+                self._update()
+                # This is a work around for Skype on Linux v4.3.0.37.
+                # Skype discards any CR char at the end of commit text.
+                # But if a commit is made while the CR is left unhandled,
+                # the CR appears before the committed text in the chatlog.
+                # As a work around, we don't let skype handle the original
+                # CR, commit current buffer and then generate an spurious CR.
+                self.frontend.forward_key(keyval, keycode, state)
+                return True
+            else:
+                return False
+
+        elif keyval == keysyms.Tab:
+            self._scheduler.flush()
+            if len(self._parser.cord) == 0:
+                return False
+
+            self._commit()
+            self._update()
+            return True
+
+        elif keyval == keysyms.BackSpace:
+            if len(self._parser.cord) == 0:
+                return False
+
+            with self.latency_recorder.measure('delete'):
+                self._parser.delete(-1)
+            self._scheduler.schedule()
+            return True
+
+        elif keyval == keysyms.Delete:
+            if self._parser.cursor >= len(self._parser.cord):
+                return False
+
+            with self.latency_recorder.measure('delete'):
+                self._parser.delete(1)
+            self._scheduler.schedule()
+            return True
+
+        elif keyval == keysyms.Left:
+            if len(self._parser.cord) == 0:
+                return False
+
+            if self._parser.cursor == 0:
+                # Commit the current text and update immediately.
+                text = self._parser.text
+                self.frontend.commit(text)
+                self._parser.clear()
+                self._update()
+
+                # Since our cursor is placed at right side of the committed
+                # text, let's go back to previous position by going left by
+                # the number of graphemes commited. Go an extra step back to
+                # account for the actual key press.
+                for x in range(count_graphemes(text) + 1):
+                    self.frontend.forward_key(keyval, keycode, state)
+
+                return True
+
+            self._parser.normcursor += -1
+            self._scheduler.schedule()
+            return True
+
+        elif keyval == keysyms.Right:
+            if len(self._parser.cord) == 0:
+                return False
+
+            self._parser.normcursor += 1
+            self._scheduler.schedule()
+            return True
+
+        elif keyval == keysyms.Up:
+            self._scheduler.flush()
+            if not len(self._lookup_table_manager) > 0:
+                return False
+
+            self._lookup_table_manager.cursor_up()
+            self._update(remake_lookup_table=False)
+            return True
+
+        elif keyval == keysyms.Down:
+            self._scheduler.flush()
+            if not len(self._lookup_table_manager) > 0:
+                return False
+
+            self._lookup_table_manager.cursor_down()
+            self._update(remake_lookup_table=False)
+            return True
+
+        elif keyval == keysyms.Page_Up:
+            self._scheduler.flush()
+            if not len(self._lookup_table_manager) > 0:
+                return False
+
+            self._lookup_table_manager.page_up()
+            self._update(remake_lookup_table=False)
+            return True
+
+        elif keyval == keysyms.Page_Down:
+            self._scheduler.flush()
+            if not len(self._lookup_table_manager) > 0:
+                return False
+
+            self._lookup_table_manager.page_down()
+            self._update(remake_lookup_table=False)
+            return True
+
+        elif keyval == keysyms.Escape:
+            self._scheduler.flush()
+            if not len(self._lookup_table_manager) > 0:
+                return False
+
+            # Put lookup table cursor to default position
+            # if it is not already.
+            table = self._lookup_table_manager.table
+            if table.get_cursor_pos() > 0:
+                table.set_cursor_pos(0)
+                self._update(remake_lookup_table=False)
+                return True
+
+            # Discard preedit text.
+            self._parser.clear()
+            self._update()
+            return True
+
+        else:
+            keystr = keysyms.keyval_to_unicode(keyval)
+            with self.latency_recorder.measure('insert'):
+                self._parser.insert(keystr)
+            self._scheduler.schedule()
+
+            return True
+
+
+
+
+class _RecordingFrontend(Frontend):
+
+    def __init__(self):
+        self.committed = ""
+        self.preedit = None
+        self.lookup_table = None
+        self.forwarded = []
+
+    def commit(self, text):
+        self.committed += text
+
+    def show_lookup_table(self, table, visible):
+        self.lookup_table = table if visible else None
+
+    def show_preedit(self, preedit):
+        self.preedit = preedit
+
+    def hide_preedit(self):
+        self.preedit = None
+
+    def forward_key(self, keyval, keycode, state):
+        self.forwarded.append(keyval)
+
+
+class _TestLookupTable(unittest.TestCase):
+
+    def test_paging(self):
+        table = LookupTable(3)
+        for c in "abcdefg":
+            table.append_candidate(c)
+
+        table.page_down()
+        table.cursor_down()
+        self.assertEqual(table.get_cursor_pos(), 4)
+        self.assertEqual(table.get_cursor_in_page(), 1)
+
+        # Not a round table; the cursor stops at the ends.
+        table.page_down()
+        table.page_down()
+        self.assertEqual(table.get_cursor_pos(), 6)
+        for i in range(10):
+            table.cursor_up()
+        self.assertEqual(table.get_cursor_pos(), 0)
+
+        round_table = LookupTable(3, round=True)
+        for c in "abcdefg":
+            round_table.append_candidate(c)
+        round_table.cursor_up()
+        self.assertEqual(round_table.get_cursor_pos(), 6)
+
+
+class _TestEngineCore(unittest.TestCase):
+
+    class _Core(EngineCore):
+        enchant_dict_names = []
+
+    def setUp(self):
+        # The fake main loop lives along with the fake IBus.
+        from .fakeibus import MainContext
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.loop = MainContext()
+        self.frontend = _RecordingFrontend()
+        self.core = self._Core(
+            self.frontend, self.loop,
+            os.path.join(self.tmpdir.name, 'history.sqlite'))
+
+    def tearDown(self):
+        self.core.close()
+        self.tmpdir.cleanup()
+
+    def _type(self, text):
+        for c in text:
+            self.core.process_key_event(ord(c), 0, 0)
+        self.core.flush()
+        self.loop.run_until_idle()
+
+    def _transliterate(self, text):
+        parser = EditingParser(Rule(RULESET_NAME))
+        parser.insert(text)
+        return parser.text
+
+    def test_commit_on_space(self):
+        self._type("ami ")
+        self.assertEqual(
+            self.frontend.committed, self._transliterate("ami") + " ")
+        self.assertIsNone(self.frontend.preedit)
+
+    def test_editing(self):
+        self._type("amik")
+        self.assertTrue(self.core.process_key_event(keysyms.BackSpace, 0, 0))
+        self.core.flush()
+        self.assertEqual(
+            self.frontend.preedit.text, self._transliterate("ami"))
+
+        self.assertTrue(self.core.process_key_event(keysyms.Tab, 0, 0))
+        self.assertEqual(self.frontend.committed, self._transliterate("ami"))
+        self.assertIn(
+            self._transliterate("ami"),
+            self.core._history_manager.search("ami"))
+
+        # Nothing left to handle.
+        self.assertFalse(self.core.process_key_event(keysyms.BackSpace, 0, 0))
+        self.assertFalse(self.core.process_key_event(keysyms.Return, 0, 0))
+
+    def test_completions(self):
+        # Words are saved along with the space and punctuations typed
+        # after them; completions leave those out.
+        self._type("amar amar. amader am")
+        candidates = self._candidates()
+
+        self.assertIn(self._transliterate("amar"), candidates)
+        self.assertIn(self._transliterate("amader"), candidates)
+        self.assertEqual(len(candidates), len(set(candidates)))
+        for candidate in candidates:
+            self.assertEqual(candidate, candidate.rstrip(" .।"))
+
+    def _candidates(self):
+        table = self.frontend.lookup_table
+        return [
+            table.get_candidate(i)
+            for i in range(table.get_number_of_candidates())]
+
+    def test_fuzzy_history(self):
+        tumi, Tumi = self._transliterate("tumi"), self._transliterate("Tumi")
+        self._type("Tumi")
+        self.core.process_key_event(keysyms.Tab, 0, 0)
+
+        # Case tells letters apart; other cases are not matched by default.
+        self._type("tumi")
+        self.assertNotIn(Tumi, self._candidates())
+        self.core.process_key_event(keysyms.Escape, 0, 0)
+
+        from .history import FUZZY_GENERALIZERS
+
+        class Core(self._Core):
+            history_generalizers = FUZZY_GENERALIZERS
+
+        self.core.close()
+        self.core = Core(
+            self.frontend, self.loop,
+            os.path.join(self.tmpdir.name, 'history.sqlite'))
+
+        # Fuzzy matches are listed, but the default text is picked.
+        self._type("tumi")
+        table = self.frontend.lookup_table
+        self.assertIn(Tumi, self._candidates())
+        self.assertEqual(table.get_candidate(table.get_cursor_pos()), tumi)
+
+        self.frontend.committed = ""
+        self.core.process_key_event(keysyms.Tab, 0, 0)
+        self.assertEqual(self.frontend.committed, tumi)
+
+    def test_disable_does_not_wait(self):
+        import threading
+
+        # A disk slow to write to.
+        writer = self.core._history_manager._writer
+        writer.idle_delay = writer.max_delay = 60
+        release = threading.Event()
+        write = writer._write
+
+        def hold(conn, batch):
+            release.wait(5)
+            return write(conn, batch)
+
+        writer._write = hold
+        self._type("ami")
+        self.core.process_key_event(keysyms.Tab, 0, 0)
+
+        start = time.monotonic()
+        self.core.disable()
+        self.assertLess(time.monotonic() - start, 1)
+
+        # The history is written all the same.
+        release.set()
+        deadline = time.monotonic() + 5
+        while writer.pending("ami") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(writer.pending("ami"))
+
+    def test_updates_are_coalesced(self):
+        updates = self.core.latency_recorder.summary().get(
+            'update', {}).get('count', 0)
+        for c in "tumi":
+            self.core.process_key_event(ord(c), 0, 0)
+        self.assertIsNone(self.frontend.preedit)
+
+        self.core.flush()
+        self.assertEqual(
+            self.core.latency_recorder.summary()['update']['count'],
+            updates + 1)
+        self.assertEqual(
+            self.frontend.preedit.text, self._transliterate("tumi"))
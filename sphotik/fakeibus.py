@@ -0,0 +1,362 @@
+"""
+A stand-in for the parts of IBus and GLib used by the engine.
+
+It lets the engine run on a box without IBus, e.g. for tests, benchmarks
+and trace replays. Engines only talk to an 'Engine' base class that keeps
+track of their output; nothing is shown anywhere.
+
+Usage:
+    from sphotik import fakeibus
+    fakeibus.install()
+
+    from sphotik.engine import EngineSphotik
+    engine = EngineSphotik()
+    engine.do_process_key_event(IBus.a, 0, 0)
+    fakeibus.GLib.main_context.run_until_idle()
+"""
+import sys
+import heapq
+import time
+import types
+import unittest
+import itertools
+import threading
+
+from . import keysyms
+from .core import LookupTable as _LookupTable
+
+
+class MainContext:
+    """ Runs timers and idle callbacks, like the main context of GLib.
+
+    Callbacks returning a true value are run again. Idle callbacks may be
+    added from any thread.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+
+        # Heap of (due time, id) pairs and the sources by id.
+        self._timers = []
+        self._sources = {}
+
+    def _add(self, due, interval, function, data):
+        with self._cond:
+            source_id = next(self._ids)
+            self._sources[source_id] = (interval, function, data)
+            heapq.heappush(self._timers, (due, source_id))
+            self._cond.notify_all()
+            return source_id
+
+    def timeout_add(self, interval, function, *data):
+        return self._add(
+            self.clock() + interval / 1000, interval / 1000, function, data)
+
+    def timeout_add_seconds(self, interval, function, *data):
+        return self._add(self.clock() + interval, interval, function, data)
+
+    def idle_add(self, function, *data):
+        # Idle callbacks are due right away, in the order of addition.
+        return self._add(float('-inf'), None, function, data)
+
+    def source_remove(self, source_id):
+        with self._cond:
+            return self._sources.pop(source_id, None) is not None
+
+    def next_due_time(self):
+        """ Due time of the next source, or None. """
+        with self._cond:
+            while self._timers and self._timers[0][1] not in self._sources:
+                heapq.heappop(self._timers)
+            return self._timers[0][0] if self._timers else None
+
+    def iteration(self, may_block=False):
+        """ Run a due source. Returns whether a source was run. """
+        with self._cond:
+            while True:
+                due = self.next_due_time()
+                if due is not None and due <= self.clock():
+                    break
+                if not may_block:
+                    return False
+                self._cond.wait(
+                    None if due is None else max(0, due - self.clock()))
+
+            _, source_id = heapq.heappop(self._timers)
+            interval, function, data = self._sources[source_id]
+
+        again = function(*data)
+
+        with self._cond:
+            if source_id in self._sources:
+                if again:
+                    heapq.heappush(self._timers, (
+                        self.clock() + (interval or 0), source_id))
+                else:
+                    del self._sources[source_id]
+        return True
+
+    def run_until_idle(self):
+        """ Run sources until none of them is due. """
+        while self.iteration():
+            pass
+
+    def run_until(self, deadline):
+        """ Run sources as they fall due, until the clock reaches the
+        'deadline'.
+        """
+        while True:
+            with self._cond:
+                now = self.clock()
+                due = self.next_due_time()
+                if due is None or due > now:
+                    if now >= deadline:
+                        return
+                    self._cond.wait(min(
+                        deadline, deadline if due is None else due) - now)
+                    continue
+            self.iteration()
+
+
+class Text:
+
+    def __init__(self, text):
+        self.text = text
+        self.attributes = []
+
+    @classmethod
+    def new_from_string(cls, text):
+        return cls(text)
+
+    def get_text(self):
+        return self.text
+
+    def get_length(self):
+        return len(self.text)
+
+    def append_attribute(self, type_, value, start, end):
+        self.attributes.append((type_, value, start, end))
+
+
+class LookupTable(_LookupTable):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._orientation = 0
+
+    @classmethod
+    def new(cls, page_size, cursor_pos, cursor_visible, round):
+        return cls(page_size, cursor_pos, cursor_visible, round)
+
+    def set_orientation(self, orientation):
+        self._orientation = orientation
+
+    def get_orientation(self):
+        return self._orientation
+
+
+class Engine:
+    """ Base class of engines, keeping their latest output.
+
+    'committed' is all the committed text, in order.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.committed = ""
+        self.preedit = None
+        self.auxiliary = None
+        self.lookup_table = None
+        self.forwarded = []
+
+    def commit_text(self, text):
+        self.committed += text.get_text()
+
+    def update_preedit_text_with_mode(self, text, cursor_pos, visible, mode):
+        self.preedit = text if visible else None
+
+    def hide_preedit_text(self):
+        self.preedit = None
+
+    def update_auxiliary_text(self, text, visible):
+        self.auxiliary = text if visible else None
+
+    def update_lookup_table_fast(self, table, visible):
+        self.lookup_table = table if visible else None
+
+    def forward_key_event(self, keyval, keycode, state):
+        self.forwarded.append((keyval, keycode, state))
+
+    def do_destroy(self):
+        pass
+
+
+def _make_ibus():
+    ibus = types.ModuleType('gi.repository.IBus')
+    ibus.__dict__.update(keysyms.KEYSYMS)
+    ibus.ModifierType = types.SimpleNamespace(
+        SHIFT_MASK=keysyms.SHIFT_MASK,
+        LOCK_MASK=keysyms.LOCK_MASK,
+        CONTROL_MASK=keysyms.CONTROL_MASK,
+        MOD1_MASK=keysyms.MOD1_MASK,
+        SUPER_MASK=keysyms.SUPER_MASK,
+        HYPER_MASK=keysyms.HYPER_MASK,
+        META_MASK=keysyms.META_MASK,
+        RELEASE_MASK=keysyms.RELEASE_MASK)
+    ibus.AttrType = types.SimpleNamespace(
+        UNDERLINE=1, FOREGROUND=2, BACKGROUND=3)
+    ibus.PreeditFocusMode = types.SimpleNamespace(CLEAR=0, COMMIT=1)
+    ibus.keyval_to_unicode = keysyms.keyval_to_unicode
+    ibus.Text = Text
+    ibus.LookupTable = LookupTable
+    ibus.Engine = Engine
+    return ibus
+
+
+class MainLoop:
+
+    def __init__(self, context=None):
+        self.context = context or main_context
+        self._running = False
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self.context.iteration(may_block=True)
+
+    def quit(self):
+        self._running = False
+        # Wake the loop up.
+        self.context.idle_add(lambda: False)
+
+
+def _make_glib():
+    glib = types.ModuleType('gi.repository.GLib')
+    glib.PRIORITY_DEFAULT = 0
+    glib.main_context = main_context
+    glib.MainLoop = MainLoop
+    glib.timeout_add = main_context.timeout_add
+    glib.timeout_add_seconds = main_context.timeout_add_seconds
+    glib.idle_add = main_context.idle_add
+    glib.source_remove = main_context.source_remove
+    glib.unix_signal_add = lambda priority, signum, handler, *data: 0
+    return glib
+
+
+# The default main context, run by 'GLib.MainLoop'.
+main_context = MainContext()
+
+IBus = _make_ibus()
+GLib = _make_glib()
+
+
+def install():
+    """ Make 'gi.repository' import the fake IBus and GLib, in place of
+    the real ones. Returns the fake IBus and GLib modules.
+    """
+    gi = types.ModuleType('gi')
+    gi.require_version = lambda namespace, version: None
+    repository = types.ModuleType('gi.repository')
+    repository.IBus = IBus
+    repository.GLib = GLib
+    gi.repository = repository
+
+    sys.modules['gi'] = gi
+    sys.modules['gi.repository'] = repository
+    sys.modules['gi.repository.IBus'] = IBus
+    sys.modules['gi.repository.GLib'] = GLib
+    return IBus, GLib
+
+
+class _TestMainContext(unittest.TestCase):
+
+    def test_sources(self):
+        now = [0.0]
+        context = MainContext(clock=lambda: now[0])
+        calls = []
+
+        context.timeout_add(20, lambda: calls.append('timeout'))
+        ticks = iter(range(2))
+        context.timeout_add(10, lambda: calls.append('tick') or next(
+            ticks, None) is not None)
+        removed = context.timeout_add(5, lambda: calls.append('removed'))
+        context.idle_add(calls.append, 'idle')
+        self.assertTrue(context.source_remove(removed))
+
+        context.run_until_idle()
+        self.assertEqual(calls, ['idle'])
+
+        for i in range(4):
+            now[0] += 0.01
+            context.run_until_idle()
+        self.assertEqual(calls, ['idle', 'tick', 'timeout', 'tick', 'tick'])
+        self.assertIsNone(context.next_due_time())
+
+
+class _TestFakeIbus(unittest.TestCase):
+
+    def setUp(self):
+        # Do not leave the fake behind for other importers.
+        names = ('gi', 'gi.repository', 'gi.repository.IBus',
+                 'gi.repository.GLib', 'sphotik.engine')
+        saved = {name: sys.modules.pop(name, None) for name in names}
+
+        def restore():
+            for name, module in saved.items():
+                sys.modules.pop(name, None)
+                if module is not None:
+                    sys.modules[name] = module
+
+        self.addCleanup(restore)
+        install()
+
+    def test_engine(self):
+        import os.path
+        import tempfile
+        from .engine import EngineSphotik
+
+        class Core(EngineSphotik.core_class):
+            enchant_dict_names = []
+
+            def __init__(self, frontend, loop):
+                super().__init__(frontend, loop, os.path.join(
+                    tmpdir.name, 'history.sqlite'))
+
+        class Engine(EngineSphotik):
+            core_class = Core
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        engine = Engine()
+        self.addCleanup(engine.do_destroy)
+        for c in "ami":
+            self.assertTrue(engine.do_process_key_event(ord(c), 0, 0))
+        engine._core.flush()
+
+        self.assertEqual(engine.auxiliary.get_text(), "ami")
+        self.assertEqual(engine.preedit.get_text(), "আমি")
+        self.assertEqual(
+            engine.lookup_table.get_candidate(0).get_text(), "আমি")
+
+        # A cursor off the end is marked in the preedit.
+        self.assertTrue(engine.do_process_key_event(IBus.Left, 0, 0))
+        engine._core.flush()
+        self.assertEqual(
+            sorted(a[0] for a in engine.preedit.attributes),
+            [IBus.AttrType.FOREGROUND, IBus.AttrType.BACKGROUND])
+
+        self.assertTrue(engine.do_process_key_event(IBus.Right, 0, 0))
+        engine._core.flush()
+        self.assertEqual(engine.preedit.attributes, [])
+
+        self.assertTrue(engine.do_process_key_event(IBus.Return, 0, 0))
+        self.assertEqual(engine.committed, "আমি")
+        self.assertEqual(engine.forwarded, [(IBus.Return, 0, 0)])
+        self.assertIsNone(engine.lookup_table)
+
+        # Destroying the engine writes the history to disk.
+        history_manager = engine._core._history_manager
+        engine.do_destroy()
+        self.assertIsNone(history_manager._writer)
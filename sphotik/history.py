@@ -1,8 +1,576 @@
+import sys
+import time
+import atexit
 import os.path
+import argparse
+import random
+import string
 import sqlite3
 import logging
+import tempfile
+import unittest
+import itertools
+import threading
 from collections import deque, Counter
 
+# Increments of history are written to disk once typing pauses for this
+# many seconds, ...
+HISTORY_FLUSH_IDLE_DELAY = 2.0
+
+# ... or once the oldest increment has waited for this many seconds, ...
+HISTORY_FLUSH_MAX_DELAY = 30.0
+
+# ... or once this many (roman text, bangla text) pairs are pending.
+HISTORY_FLUSH_MAX_PENDING = 256
+
+# Time to wait for pending history to be written on exit.
+HISTORY_CLOSE_TIMEOUT = 5.0
+
+# Time a write waits for the database to be unlocked by another process,
+# in seconds. Failed writes are tried again after a delay, doubled for
+# every failure in a row, and given up on after so many tries.
+HISTORY_WRITE_BUSY_TIMEOUT = 5.0
+HISTORY_WRITE_RETRY_DELAY = 1.0
+HISTORY_WRITE_MAX_RETRIES = 5
+
+# Time a read waits for a commit of history to end, in seconds.
+HISTORY_COMMIT_WAIT = 0.01
+
+# Time a read waits for the database to be unlocked by the writer, in
+# seconds; it makes do with the history in memory after that. Keys should
+# not wait for a compaction.
+HISTORY_READ_BUSY_TIMEOUT = 0.005
+
+# Completions of prefixes upto this size are looked up in a table of
+# prefixes. Longer prefixes narrow down the roman texts enough for a
+# range scan of the history table.
+HISTORY_PREFIX_INDEX_SIZE = 3
+
+HISTORY_FILE_PATH = "~/.sphotik_history.sqlite"
+
+# Weight of the uses of a word halves every this many seconds after it's
+# last use, so that old habits fade away.
+HISTORY_HALF_LIFE = 90 * 24 * 3600
+
+# Compaction keeps the best scoring bangla texts of every roman text and
+# the best scoring rows overall, ...
+HISTORY_MAX_ROWS_PER_KEY = 10
+HISTORY_MAX_ROWS = 200000
+
+# ... and is done once in this many seconds, some time after start.
+HISTORY_COMPACTION_INTERVAL = 24 * 3600
+HISTORY_COMPACTION_DELAY = 5 * 60
+
+
+def decayed_usecount(usecount, lastused, now, half_life=HISTORY_HALF_LIFE):
+    """ Use count of a word, decayed by the time since it's last use. """
+    return usecount * 0.5 ** (max(0, now - lastused) / half_life)
+
+
+def squeeze_repeats(text):
+    """ Squeeze runs of the same character, e.g. 'aamii' into 'ami'. """
+    return "".join(c for c, _ in itertools.groupby(text))
+
+
+# Generalizations of roman texts as (name, function) pairs, from the
+# tightest to the loosest. The key of every generalization is kept in a
+# column of it's own, next to the roman text.
+#
+# Avro tells letters apart by case (t and T, o and O ...) and a doubled
+# letter may make another conjunct, so these are not safe for it; by
+# default, only the roman text itself is matched.
+FUZZY_GENERALIZERS = (
+    ('lower', str.lower),
+    ('lower+squeeze', lambda text: squeeze_repeats(text.lower())),
+)
+DEFAULT_GENERALIZERS = ()
+HISTORY_KEY_COLUMNS = ('key1', 'key2')
+
+
+def generalization_keys(roman_text, generalizers=DEFAULT_GENERALIZERS):
+    """ The roman text, followed by a key of every key column. Keys of
+    missing generalizers are None.
+    """
+    keys = [roman_text]
+    for i in range(len(HISTORY_KEY_COLUMNS)):
+        keys.append(generalizers[i][1](roman_text)
+                    if i < len(generalizers) else None)
+    return tuple(keys)
+
+
+def match_level(keys, other_keys):
+    """ Index of the first key shared by two tuples of keys, or None. """
+    for level, (key, other) in enumerate(zip(keys, other_keys)):
+        if key is not None and key == other:
+            return level
+    return None
+
+
+def connect(
+        histfilepath,
+        half_life=HISTORY_HALF_LIFE,
+        generalizers=DEFAULT_GENERALIZERS,
+        timeout=HISTORY_WRITE_BUSY_TIMEOUT):
+    """ Open a history database, with the functions used by queries. """
+    conn = sqlite3.connect(histfilepath, timeout)
+    conn.create_function(
+        "decayed_usecount", 3,
+        lambda u, l, n: decayed_usecount(u, l, n, half_life))
+
+    for i, column in enumerate(HISTORY_KEY_COLUMNS):
+        conn.create_function(
+            "history_" + column, 1,
+            lambda t, i=i: generalization_keys(t, generalizers)[i + 1],
+            deterministic=True)
+    return conn
+
+
+QUERY_CAP_ROWS_PER_KEY = """
+DELETE FROM history WHERE rowid IN (
+    SELECT rowid FROM (
+        SELECT rowid, ROW_NUMBER() OVER (
+            PARTITION BY roman_text
+            ORDER BY decayed_usecount(usecount, lastused, :now) DESC
+        ) AS rank
+        FROM history)
+    WHERE rank > :max_rows_per_key);
+"""
+
+QUERY_CAP_ROWS = """
+DELETE FROM history WHERE rowid IN (
+    SELECT rowid FROM history
+    ORDER BY decayed_usecount(usecount, lastused, :now) ASC
+    LIMIT :excess);
+"""
+
+QUERY_SET_META = """
+INSERT OR REPLACE INTO history_meta (key, value) VALUES (:key, :value);
+"""
+
+QUERY_GET_META = """
+SELECT value FROM history_meta WHERE key = :key;
+"""
+
+QUERY_UPDATE_KEYS = """
+UPDATE history SET
+    key1 = history_key1(roman_text), key2 = history_key2(roman_text);
+"""
+
+
+def compact(
+        conn,
+        max_rows_per_key=HISTORY_MAX_ROWS_PER_KEY,
+        max_rows=HISTORY_MAX_ROWS):
+    """ Remove the worst scoring rows of history, beyond the given
+    limits. Returns the number of removed rows.
+    """
+    now = int(time.time())
+    with conn:
+        removed = conn.execute(QUERY_CAP_ROWS_PER_KEY, {
+            "now": now, "max_rows_per_key": max_rows_per_key}).rowcount
+
+        nrows = conn.execute("SELECT COUNT(*) FROM history;").fetchone()[0]
+        if nrows > max_rows:
+            removed += conn.execute(QUERY_CAP_ROWS, {
+                "now": now, "excess": nrows - max_rows}).rowcount
+
+        conn.execute(
+            QUERY_SET_META, {"key": "last_compaction", "value": now})
+
+    # Give the space of removed rows back, once a good share of the
+    # file is unused.
+    page_count = conn.execute("PRAGMA page_count;").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+    if freelist_count * 4 > page_count:
+        conn.execute("VACUUM;")
+
+    return removed
+
+
+class SessionHistory:
+    """ A bounded sequence of recently used (roman text, bangla text)
+    pairs, indexed by roman text.
+
+    Next to the global order of the pairs, a ring of the most recent
+    outputs is kept for every roman text. Hence the recent outputs of
+    a roman text are found without scanning the whole sequence.
+    """
+
+    def __init__(self, maxlen, concern_size):
+        self.maxlen = maxlen
+        self.concern_size = concern_size
+
+        # Every use gets a sequence number, which relates an entry of
+        # the global order to the same entry in a ring.
+        self._seq = itertools.count()
+        self._order = deque()
+        self._rings = {}
+
+    def append(self, roman_text, bangla_text):
+        seq = next(self._seq)
+        self._order.append((seq, roman_text))
+
+        ring = self._rings.get(roman_text)
+        if ring is None:
+            ring = self._rings[roman_text] = deque(maxlen=self.concern_size)
+        ring.append((seq, bangla_text))
+
+        if len(self._order) > self.maxlen:
+            # The oldest use may have already been pushed out of it's
+            # ring by newer uses of the same roman text.
+            oldseq, oldroman = self._order.popleft()
+            oldring = self._rings[oldroman]
+            if oldring and oldring[0][0] == oldseq:
+                oldring.popleft()
+            if not oldring:
+                del self._rings[oldroman]
+
+    def recent(self, roman_text):
+        """ Bangla texts of the most recent uses of a roman text,
+        newest first; at most 'concern_size' of them.
+        """
+        ring = self._rings.get(roman_text, ())
+        return [bangla_text for _, bangla_text in reversed(ring)]
+
+    def __len__(self):
+        return len(self._order)
+
+
+class HistoryWriter:
+    """ Writes increments of use counts to the history database from a
+    thread of it's own, keeping disk access off the keystroke path.
+
+    Increments of the same (roman text, bangla text) pair are coalesced
+    in memory and written in batched transactions.
+    """
+
+    QUERY_INCREMENT = """
+    UPDATE history SET usecount = usecount + :count, lastused = :now
+    WHERE roman_text = :roman_text AND bangla_text = :bangla_text;
+    """
+
+    QUERY_INSERT = """
+    INSERT INTO history
+        (bangla_text, roman_text, usecount, lastused, key1, key2)
+    VALUES (
+        :bangla_text, :roman_text, :count, :now,
+        history_key1(:roman_text), history_key2(:roman_text));
+    """
+
+    def __init__(
+            self,
+            histfilepath,
+            idle_delay=HISTORY_FLUSH_IDLE_DELAY,
+            max_delay=HISTORY_FLUSH_MAX_DELAY,
+            max_pending=HISTORY_FLUSH_MAX_PENDING,
+            half_life=HISTORY_HALF_LIFE,
+            compaction_interval=HISTORY_COMPACTION_INTERVAL,
+            compaction_delay=HISTORY_COMPACTION_DELAY,
+            max_rows_per_key=HISTORY_MAX_ROWS_PER_KEY,
+            max_rows=HISTORY_MAX_ROWS,
+            generalizers=DEFAULT_GENERALIZERS,
+            busy_timeout=HISTORY_WRITE_BUSY_TIMEOUT,
+            retry_delay=HISTORY_WRITE_RETRY_DELAY,
+            max_retries=HISTORY_WRITE_MAX_RETRIES):
+        self.histfilepath = histfilepath
+        self.idle_delay = idle_delay
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.half_life = half_life
+        self.generalizers = generalizers
+        self.busy_timeout = busy_timeout
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+
+        # Compaction is left to this thread as well, being the writer.
+        # It is disabled if the interval is None.
+        self.compaction_interval = compaction_interval
+        self.max_rows_per_key = max_rows_per_key
+        self.max_rows = max_rows
+        self._next_compaction = time.monotonic() + compaction_delay
+
+        self._cond = threading.Condition()
+
+        # Pending increments, as a mapping of roman texts to counters of
+        # bangla texts. The batch being written is kept apart, so that it
+        # is not missed by readers until it hits the disk.
+        self._pending = {}
+        self._npending = 0
+        self._writing = {}
+
+        # Keys of the roman texts of both.
+        self._keys = {}
+
+        # Whether the batch being written is being committed; whether it
+        # is on disk or not is unknown meanwhile.
+        self._committing = False
+
+        # Times of the oldest and the newest pending increment.
+        self._first_time = None
+        self._last_time = None
+
+        # Failed writes in a row, and the time to try again, if any.
+        self._failures = 0
+        self._retry_time = None
+
+        # Flushes are numbered; a flush is done once the number of
+        # completed flushes catches up with it.
+        self._flushes_requested = 0
+        self._flushes_completed = 0
+        self._closing = False
+
+        self._thread = threading.Thread(
+            target=self._run, name='sphotik-history-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, roman_text, bangla_text, count=1):
+        with self._cond:
+            counter = self._pending.setdefault(roman_text, Counter())
+            if roman_text not in self._keys:
+                self._keys[roman_text] = generalization_keys(
+                    roman_text, self.generalizers)
+            if bangla_text not in counter:
+                self._npending += 1
+            counter[bangla_text] += count
+
+            now = time.monotonic()
+            if self._first_time is None:
+                self._first_time = now
+            self._last_time = now
+            self._cond.notify_all()
+
+    def _increments(self, writing):
+        # Pending increments, along with those being written if asked for.
+        return (self._writing, self._pending) if writing else (self._pending,)
+
+    def read_with_pending(self, read, pending):
+        """ Returns 'read()', a read of the database, along with
+        'pending(writing)', increments not yet found on disk.
+
+        Increments of the batch being written are counted once: either
+        by the read, or by 'pending' if 'writing' is true.
+        """
+        with self._cond:
+            # Commits do not start while the lock is held. The one going
+            # on, if any, is short.
+            self._cond.wait_for(
+                lambda: not self._committing, HISTORY_COMMIT_WAIT)
+            writing = not self._committing
+            return read(), pending(writing)
+
+    def pending(self, roman_text, writing=True):
+        """ Increments of a roman text, not yet found on disk. """
+        with self._cond:
+            counter = Counter()
+            for increments in self._increments(writing):
+                counter.update(increments.get(roman_text, ()))
+            return counter
+
+    def pending_with_prefix(self, prefix, writing=True):
+        """ Increments of roman texts starting with 'prefix', not yet
+        found on disk, as a counter of (roman text, bangla text) pairs.
+        """
+        with self._cond:
+            counter = Counter()
+            for increments in self._increments(writing):
+                for roman_text, bangla_counter in increments.items():
+                    if roman_text.startswith(prefix):
+                        for bangla_text, count in bangla_counter.items():
+                            counter[roman_text, bangla_text] += count
+            return counter
+
+    def pending_matches(self, keys, writing=True):
+        """ Increments of roman texts sharing a key with 'keys', not yet
+        found on disk, as tuples of bangla text, count and the level of
+        the first shared key.
+        """
+        with self._cond:
+            matches = []
+            for increments in self._increments(writing):
+                for roman_text, counter in increments.items():
+                    level = match_level(self._keys[roman_text], keys)
+                    if level is not None:
+                        matches.extend(
+                            (bangla_text, count, level)
+                            for bangla_text, count in counter.items())
+            return matches
+
+    def flush(self, timeout=None):
+        """ Write all the pending increments and wait for them to reach
+        the disk. Returns False on timeout.
+        """
+        with self._cond:
+            self._flushes_requested += 1
+            target = self._flushes_requested
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: (
+                    self._flushes_completed >= target or
+                    not self._thread.is_alive()),
+                timeout)
+
+    def close(self, timeout=None):
+        """ Write all the pending increments and stop the thread. """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _wait_for_work(self):
+        # Returns with the lock held, once a batch is due. A batch that
+        # failed to be written is only due at the time of the retry.
+        while True:
+            if self._retry_time is None:
+                if self._closing:
+                    return
+                if self._flushes_requested > self._flushes_completed:
+                    return
+
+            now = time.monotonic()
+            deadlines = []
+            if self._retry_time is not None:
+                deadlines.append(self._retry_time)
+            elif self._npending:
+                if self._npending >= self.max_pending:
+                    return
+
+                deadlines.append(self._last_time + self.idle_delay)
+                deadlines.append(self._first_time + self.max_delay)
+
+            if self.compaction_interval is not None:
+                deadlines.append(self._next_compaction)
+
+            timeout = min(deadlines) - now if deadlines else None
+            if timeout is not None and timeout <= 0:
+                return
+
+            self._cond.wait(timeout)
+
+    def _run(self):
+        try:
+            conn = connect(
+                self.histfilepath, self.half_life, self.generalizers,
+                self.busy_timeout)
+        except sqlite3.Error:
+            logging.exception("Could not open history file for writing.")
+            return
+
+        try:
+            while True:
+                with self._cond:
+                    self._wait_for_work()
+                    batch = self._writing = self._pending
+                    self._pending = {}
+                    self._npending = 0
+                    self._first_time = None
+                    closing = self._closing
+                    flushes = self._flushes_requested
+
+                written = self._write(conn, batch)
+
+                # The batch is on disk and out of memory at once.
+                with self._cond:
+                    self._committing = False
+                    self._writing = {}
+                    if written:
+                        self._failures = 0
+                        self._retry_time = None
+                    else:
+                        self._retry(batch)
+                    self._keys = {r: self._keys[r] for r in self._pending}
+                    self._flushes_completed = flushes
+                    self._cond.notify_all()
+
+                if closing and self._retry_time is None:
+                    break
+
+                if (self.compaction_interval is not None and
+                        time.monotonic() >= self._next_compaction):
+                    self._next_compaction = (
+                        time.monotonic() + self.compaction_interval)
+                    self._compact(conn)
+        finally:
+            conn.close()
+
+    def _compact(self, conn):
+        try:
+            # The last compaction may have been done by another process.
+            row = conn.execute(
+                QUERY_GET_META, {"key": "last_compaction"}).fetchone()
+            if row and time.time() - row[0] < self.compaction_interval:
+                return
+
+            removed = compact(conn, self.max_rows_per_key, self.max_rows)
+            logging.info("Removed {} rows of history.".format(removed))
+
+        except sqlite3.Error as e:
+            logging.exception("Could not compact history.")
+
+    def _retry(self, batch):
+        # Put a batch that failed to be written back with the pending
+        # increments, e.g. as another process kept the database locked.
+        # Called with the lock held.
+        self._failures += 1
+        if self._failures > self.max_retries:
+            logging.error(
+                "Gave up on saving {} words of history.".format(
+                    sum(map(len, batch.values()))))
+            self._failures = 0
+            self._retry_time = None
+            return
+
+        for roman_text, counter in batch.items():
+            pending = self._pending.setdefault(roman_text, Counter())
+            self._npending += sum(1 for b in counter if b not in pending)
+            pending.update(counter)
+
+        now = time.monotonic()
+        if self._first_time is None:
+            self._first_time = self._last_time = now
+        self._retry_time = (
+            now + self.retry_delay * 2 ** (self._failures - 1))
+
+    def _write(self, conn, batch):
+        # Returns whether the batch was written.
+        if not batch:
+            return True
+
+        now = int(time.time())
+        try:
+            for roman_text, counter in batch.items():
+                for bangla_text, count in counter.items():
+                    values = {
+                        "roman_text": roman_text,
+                        "bangla_text": bangla_text,
+                        "count": count,
+                        "now": now}
+
+                    result = conn.execute(self.QUERY_INCREMENT, values)
+                    if result.rowcount == 0:
+                        conn.execute(self.QUERY_INSERT, values)
+
+            # Readers can not tell whether the batch is on disk until
+            # the batch is cleared; see 'read_with_pending'.
+            with self._cond:
+                self._committing = True
+            conn.commit()
+            return True
+
+        except sqlite3.Error as e:
+            conn.rollback()
+            logging.exception("Could not save history to disk.")
+            return False
+
+
+def _log_read_error(error):
+    # A database locked beyond the busy timeout is expected while the
+    # writer commits or compacts.
+    if isinstance(error, sqlite3.OperationalError) and (
+            "locked" in str(error)):
+        logging.debug("History is locked; read from memory only.")
+    else:
+        logging.exception("Could not read history from disk.")
+
 
 class HistoryManager:
 
@@ -16,23 +584,110 @@ class HistoryManager:
     );
     """
 
+    # Changes of the schema, in order. The number of changes applied to
+    # a database is kept as it's 'user_version'.
+    MIGRATIONS = (
+        # Rows of every short prefix of the roman texts, for completion.
+        # Triggers keep them in sync with the history table.
+        """
+        CREATE TABLE history_prefix(
+            prefix TEXT NOT NULL,
+            roman_text TEXT NOT NULL,
+            bangla_text TEXT NOT NULL,
+            usecount INTEGER NOT NULL
+        );
+
+        CREATE INDEX history_prefix_usecount
+        ON history_prefix (prefix, usecount);
+
+        CREATE INDEX history_prefix_text
+        ON history_prefix (roman_text, bangla_text);
+
+        CREATE TABLE history_prefix_sizes(n INTEGER PRIMARY KEY);
+        WITH RECURSIVE sizes(n) AS (
+            SELECT 1 UNION ALL SELECT n + 1 FROM sizes WHERE n < {size}
+        )
+        INSERT INTO history_prefix_sizes SELECT n FROM sizes;
+
+        CREATE TRIGGER history_prefix_insert AFTER INSERT ON history
+        BEGIN
+            INSERT INTO history_prefix
+            SELECT substr(new.roman_text, 1, n), new.roman_text,
+                new.bangla_text, new.usecount
+            FROM history_prefix_sizes
+            WHERE n <= length(new.roman_text);
+        END;
+
+        CREATE TRIGGER history_prefix_update
+        AFTER UPDATE OF usecount ON history
+        BEGIN
+            UPDATE history_prefix SET usecount = new.usecount
+            WHERE roman_text = new.roman_text
+                AND bangla_text = new.bangla_text;
+        END;
+
+        CREATE TRIGGER history_prefix_delete AFTER DELETE ON history
+        BEGIN
+            DELETE FROM history_prefix
+            WHERE roman_text = old.roman_text
+                AND bangla_text = old.bangla_text;
+        END;
+
+        INSERT INTO history_prefix
+        SELECT substr(roman_text, 1, n), roman_text, bangla_text, usecount
+        FROM history, history_prefix_sizes
+        WHERE n <= length(roman_text);
+        """.format(size=HISTORY_PREFIX_INDEX_SIZE),
+
+        # Time of the last use of every row, in seconds since the epoch.
+        # Rows of older files are taken as being used just now. Also, a
+        # table of assorted values.
+        """
+        ALTER TABLE history ADD COLUMN lastused INTEGER NOT NULL DEFAULT 0;
+        UPDATE history SET lastused = CAST(strftime('%s', 'now') AS INTEGER);
+
+        CREATE TABLE history_meta(
+            key TEXT PRIMARY KEY,
+            value
+        );
+        """,
+
+        # Generalized keys of the roman texts, for fuzzy search. They are
+        # filled in by '_update_keys'.
+        """
+        ALTER TABLE history ADD COLUMN key1 TEXT;
+        ALTER TABLE history ADD COLUMN key2 TEXT;
+
+        CREATE INDEX history_key1 ON history (key1);
+        CREATE INDEX history_key2 ON history (key2);
+        """,
+    )
+
     def __init__(
             self,
             histfilepath,
-            input_generalizer=lambda x: x,
+            generalizers=DEFAULT_GENERALIZERS,
             session_history_size=1000,
-            session_history_concern_size=20,):
-        # An input generalizer is a function that may be used to
-        # generalize the input data, so that history suggestions can be
-        # laxed and fuzzy; trading their accuracy in return.
-        self.input_generalizer = input_generalizer
+            session_history_concern_size=20,
+            half_life=HISTORY_HALF_LIFE,):
+        # Generalizers make history suggestions lax and fuzzy, trading
+        # their accuracy in return. Looser generalizations are only
+        # searched if the tighter ones find nothing. Generalizers are
+        # identified by their names; keys are computed anew once the
+        # names change.
+        if len(generalizers) > len(HISTORY_KEY_COLUMNS):
+            raise ValueError(
+                "At most {} generalizers are supported."
+                .format(len(HISTORY_KEY_COLUMNS)))
+        self.generalizers = generalizers
 
         # Session history is an in-memory sequence of most recently used
         # words and their input texts. The most likely conversion of a word
         # can be deduced by filtering the sequence by respective input text
         # and doing a frequency analysis on the used output texts.
         self.session_history_concern_size = session_history_concern_size
-        self.session_history = deque(maxlen=session_history_size)
+        self.session_history = SessionHistory(
+            session_history_size, session_history_concern_size)
 
         if not os.path.isfile(histfilepath):
             # Create the history file with proper permissions.
@@ -40,22 +695,71 @@ class HistoryManager:
                 os.chmod(histfilepath, 0o600)
 
             # Write database schema.
-            self.conn = sqlite3.connect(histfilepath)
+            self.conn = connect(histfilepath, half_life, generalizers)
             with self.conn:
                 self.conn.execute(self.SCHEMA.strip())
         else:
             # Open an existing database.
             try:
-                self.conn = sqlite3.connect(histfilepath)
+                self.conn = connect(histfilepath, half_life, generalizers)
             except sqlite3.DatabaseError as e:
                 self.conn = None
                 logging.warning(
                     "Failed to open history file '{}': {}"
-                    .format(dbfilepath, e))
+                    .format(histfilepath, e))
+
+        if self.conn is not None:
+            self._migrate()
+            self._update_keys()
+            self.conn.execute("PRAGMA busy_timeout = {:d};".format(
+                round(1000 * HISTORY_READ_BUSY_TIMEOUT)))
+
+        # History is written to disk in the background. Whatever is still
+        # pending gets written on exit.
+        self._writer = None
+        if self.conn is not None:
+            self._writer = HistoryWriter(
+                histfilepath, half_life=half_life, generalizers=generalizers)
+            atexit.register(self.close)
+
+    def _migrate(self):
+        try:
+            version = self.conn.execute("PRAGMA user_version;").fetchone()[0]
+            for i in range(version, len(self.MIGRATIONS)):
+                self.conn.executescript(
+                    "BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;"
+                    .format(self.MIGRATIONS[i], i + 1))
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logging.exception("Could not upgrade history file.")
+
+    def _update_keys(self):
+        names = ",".join(name for name, _ in self.generalizers)
+        try:
+            row = self.conn.execute(
+                QUERY_GET_META, {"key": "generalizers"}).fetchone()
+            if row and row[0] == names:
+                return
 
+            with self.conn:
+                self.conn.execute(QUERY_UPDATE_KEYS)
+                self.conn.execute(
+                    QUERY_SET_META, {"key": "generalizers", "value": names})
+        except sqlite3.Error as e:
+            logging.exception("Could not update keys of history.")
+
+    # Rows matching the roman text or any of it's keys, along with the
+    # level of the tightest matching key.
     QUERY_SEARCH = """
-    SELECT bangla_text, usecount FROM history
-    WHERE roman_text = :roman_text ORDER BY usecount DESC;
+    SELECT bangla_text, decayed_usecount(usecount, lastused, :now) AS score,
+        CASE
+            WHEN roman_text = :key0 THEN 0
+            WHEN key1 = :key1 THEN 1
+            ELSE 2
+        END AS level
+    FROM history
+    WHERE roman_text = :key0 OR key1 = :key1 OR key2 = :key2
+    ORDER BY level, score DESC;
     """
 
     def _split_trailing_punctuations_from_cord(self, cord, puncs):
@@ -68,9 +772,9 @@ class HistoryManager:
 
         return cord[:split_at], cord[split_at:]
 
-    def search_without_punctuation(self, parser):
+    def search_without_punctuation(self, parser, fuzzy=None):
         # Collect with-punctuation search results.
-        results = self.search(parser.input_text)
+        results = self.search(parser.input_text, fuzzy)
 
         # Split the cord into a punctuation-less head
         # and a punctuation tail.
@@ -85,33 +789,29 @@ class HistoryManager:
         input_t = parser.render_input_text(tail)
         if len(input_t) > 0:
             input_h = parser.render_input_text(head)
-            for output, count in self.search(input_h).items():
-                results[output + parser.render_text(tail)] = count
+            fuzzy_h = set()
+            for output, count in self.search(input_h, fuzzy_h).items():
+                text = output + parser.render_text(tail)
+                results[text] = count
+                if fuzzy is not None:
+                    if output in fuzzy_h:
+                        fuzzy.add(text)
+                    else:
+                        fuzzy.discard(text)
 
         return results
 
-    def search(self, roman_text):
-        return self._search(self.input_generalizer(roman_text))
-
-    def _search(self, roman_text):
-        # Fetch results from memory. The work flow of the following
-        # comprehension is as followes:
-        #   - Find all the elements having target roman text,
-        #     newest first.
-        #
-        #   - Cut the above sequence upto 'concern size' length.
-        #     This is done because we only want to do frequency
-        #     analysis on most recent data.
-        #
-        #   - Count the converted bangla texts and order them
-        #     according to their relative frequency.
-        hist = Counter(
-            [
-                bt for rt, bt
-                in reversed(self.session_history)
-                if rt == roman_text
-            ][:self.session_history_concern_size]
-        )
+    def search(self, roman_text, fuzzy=None):
+        """ Find the bangla texts used for a roman text, or else for the
+        tightest generalization of it, along with their use counts.
+
+        If a set is given as 'fuzzy', the bangla texts found for a
+        generalization are added to it.
+        """
+        # Fetch results from memory. Only the most recent uses (upto
+        # 'concern size') of the roman text are counted, as we only
+        # want to do frequency analysis on most recent data.
+        hist = Counter(self.session_history.recent(roman_text))
 
         if hist:
             return hist
@@ -121,33 +821,115 @@ class HistoryManager:
         if self.conn is None:
             return Counter()
 
-        try:
-            hist = Counter()
+        keys = generalization_keys(roman_text, self.generalizers)
 
+        def read():
             with self.conn:
-                result = self.conn.execute(
-                    self.QUERY_SEARCH, {"roman_text": roman_text})
-
-                for bangla_text, freq in result:
-                    hist[bangla_text] = freq
-
-            return hist
+                return self.conn.execute(self.QUERY_SEARCH, {
+                    "key0": keys[0], "key1": keys[1], "key2": keys[2],
+                    "now": int(time.time())}).fetchall()
 
+        # Add up the uses not yet written to disk.
+        try:
+            rows, pending = self._writer.read_with_pending(
+                read,
+                lambda writing: self._writer.pending_matches(keys, writing))
         except sqlite3.Error as e:
-            logging.exception("Could not read history from disk.")
-            return Counter()
+            _log_read_error(e)
+            rows, pending = [], self._writer.pending_matches(keys)
+        rows.extend(pending)
+
+        # Only the tightest matching level counts.
+        hist = Counter()
+        if rows:
+            best = min(level for _, _, level in rows)
+            for bangla_text, freq, level in rows:
+                if level == best:
+                    hist[bangla_text] += freq
+            if best > 0 and fuzzy is not None:
+                fuzzy.update(hist)
+        return hist
         #----------------------------------------------------------------/
 
-    QUERY_SAVE_NEW = """
-    INSERT INTO history (bangla_text, roman_text, usecount)
-    VALUES (:bangla_text, :roman_text, 1);
+    # Candidates of completion are the rows of the highest decayed use
+    # counts; an old word used a lot does not push out recent ones.
+    QUERY_COMPLETE_SHORT = """
+    SELECT p.roman_text, p.bangla_text,
+        decayed_usecount(h.usecount, h.lastused, :now) AS score
+    FROM history_prefix AS p JOIN history AS h
+        ON h.roman_text = p.roman_text AND h.bangla_text = p.bangla_text
+    WHERE p.prefix = :prefix ORDER BY score DESC LIMIT :limit;
     """
 
-    QUERY_UPDATE_OLD = """
-    UPDATE history SET usecount = usecount + 1
-    WHERE roman_text = :roman_text AND bangla_text = :bangla_text;
+    QUERY_COMPLETE_LONG = """
+    SELECT roman_text, bangla_text,
+        decayed_usecount(usecount, lastused, :now) AS score
+    FROM history
+    WHERE roman_text >= :prefix AND roman_text < :prefix_end
+    ORDER BY score DESC LIMIT :limit;
     """
 
+    def complete_without_punctuation(self, parser, limit):
+        # Words are saved along with the white space and punctuations
+        # after them; complete them without those.
+        return self.complete(
+            parser.input_text, limit,
+            strip=string.whitespace + "".join(parser.rule.punctuations))
+
+    def complete(self, prefix, limit, strip=""):
+        """ Find the most used bangla texts of roman texts starting with
+        'prefix'. Returns a list of upto 'limit' tuples of bangla
+        text and use count, most used first.
+
+        Characters in 'strip' are stripped from the end of the bangla
+        texts; texts left the same are merged, empty ones left out.
+        """
+        if self.conn is None or not prefix or limit <= 0:
+            return []
+
+        # Different roman texts may have the same bangla text, which are
+        # merged later on. Fetch some more rows to make up for them.
+        values = {
+            "prefix": prefix,
+            "prefix_end": prefix[:-1] + chr(ord(prefix[-1]) + 1),
+            "limit": 4 * limit,
+            "now": int(time.time())}
+
+        query = (
+            self.QUERY_COMPLETE_SHORT
+            if len(prefix) <= HISTORY_PREFIX_INDEX_SIZE
+            else self.QUERY_COMPLETE_LONG)
+
+        def read():
+            with self.conn:
+                return Counter({
+                    (roman_text, bangla_text): usecount
+                    for roman_text, bangla_text, usecount
+                    in self.conn.execute(query, values)})
+
+        # Add up the uses not yet written to disk.
+        try:
+            counts, pending = self._writer.read_with_pending(
+                read,
+                lambda writing: self._writer.pending_with_prefix(
+                    prefix, writing))
+        except sqlite3.Error as e:
+            _log_read_error(e)
+            counts, pending = Counter(), self._writer.pending_with_prefix(
+                prefix)
+        counts.update(pending)
+
+        completions = {}
+        for (roman_text, bangla_text), count in counts.items():
+            bangla_text = bangla_text.rstrip(strip)
+            if not bangla_text:
+                continue
+            completions[bangla_text] = max(
+                count, completions.get(bangla_text, 0))
+
+        return sorted(
+            completions.items(), key=lambda x: x[1], reverse=True)[:limit]
+
     def _split_trailing_punctuations_from_text(self, text, puncs):
         split_at = len(text)
         for c in reversed(text):
@@ -174,27 +956,477 @@ class HistoryManager:
         self.save(parser.render_input_text(inp_head), outp_head)
 
     def save(self, roman_text, bangla_text):
-        return self._save(self.input_generalizer(roman_text), bangla_text)
-
-    def _save(self, roman_text, bangla_text):
         # Save data to memory.
-        self.session_history.append((roman_text, bangla_text))
+        self.session_history.append(roman_text, bangla_text)
 
-        # Save data to disk.
-        #-----------------------------------------------------------------\
-        if self.conn is None:
-            return
+        # Save data to disk, in the background.
+        if self._writer is not None:
+            self._writer.add(roman_text, bangla_text)
+
+    def flush(self, timeout=HISTORY_CLOSE_TIMEOUT):
+        """ Wait for the saved history to be written to disk. A timeout
+        of 0 has it written without waiting.
+        """
+        if self._writer is not None:
+            return self._writer.flush(timeout)
+        return True
+
+    def close(self, timeout=HISTORY_CLOSE_TIMEOUT):
+        if self._writer is not None:
+            self._writer.close(timeout)
+            self._writer = None
+            atexit.unregister(self.close)
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        prog='python3 -m sphotik.history',
+        description="Maintain the history database of sphotik.")
+    argparser.add_argument(
+        'command', choices=('compact',))
+    argparser.add_argument(
+        '--file', dest='histfilepath',
+        default=os.path.expanduser(HISTORY_FILE_PATH),
+        help="History database (default: %(default)s).")
+    argparser.add_argument(
+        '--max-rows-per-key', type=int, default=HISTORY_MAX_ROWS_PER_KEY,
+        help=(
+            "Number of bangla texts to keep for every roman text"
+            " (default: %(default)s)."))
+    argparser.add_argument(
+        '--max-rows', type=int, default=HISTORY_MAX_ROWS,
+        help="Number of rows to keep overall (default: %(default)s).")
+    args = argparser.parse_args(argv)
+
+    if not os.path.isfile(args.histfilepath):
+        print("No history file at '{}'.".format(args.histfilepath))
+        return 1
+
+    # Bring the schema up to date, then wait for the engine, if it is
+    # writing, as long as sqlite does by default.
+    HistoryManager(args.histfilepath).close()
+    conn = connect(args.histfilepath)
+    try:
+        size = os.path.getsize(args.histfilepath)
+        removed = compact(conn, args.max_rows_per_key, args.max_rows)
+        print("Removed {} rows; file size went from {} to {} bytes.".format(
+            removed, size, os.path.getsize(args.histfilepath)))
+    finally:
+        conn.close()
+
+    return 0
+
+
+# Half life of history in tests, where uses never decay.
+NO_DECAY = float('inf')
+
+
+class _TestSessionHistory(unittest.TestCase):
 
+    def test_same_as_linear_scan(self):
+        maxlen, concern_size = 50, 4
+        history = SessionHistory(maxlen, concern_size)
+        reference = deque(maxlen=maxlen)
+
+        rand = random.Random(0)
+        for i in range(2000):
+            pair = (rand.choice("abcdefg"), rand.choice("xyz") + str(i))
+            history.append(*pair)
+            reference.append(pair)
+
+            for roman_text in "abcdefgh":
+                self.assertEqual(
+                    history.recent(roman_text),
+                    [bt for rt, bt in reversed(reference)
+                     if rt == roman_text][:concern_size])
+
+        self.assertEqual(len(history), maxlen)
+        self.assertLessEqual(len(history._rings), 7)
+
+    def test_save_and_search(self):
+        with tempfile.TemporaryDirectory() as d:
+            history = HistoryManager(
+                os.path.join(d, 'history.sqlite'), half_life=NO_DECAY)
+            try:
+                history.save('ami', 'আমি')
+                history.save('ami', 'আমি')
+                history.save('ami', 'অমি')
+                history.save('tumi', 'তুমি')
+
+                self.assertEqual(
+                    history.search('ami'), Counter({'আমি': 2, 'অমি': 1}))
+                self.assertEqual(history.search('tumi'), Counter({'তুমি': 1}))
+                self.assertEqual(history.search('se'), Counter())
+            finally:
+                history.close()
+
+
+class _TestHistoryWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'history.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _read(self, roman_text):
+        reader = HistoryManager(self.path, half_life=NO_DECAY)
         try:
-            with self.conn:
-                values = {
-                    "roman_text": roman_text,
-                    "bangla_text": bangla_text}
+            return reader.search(roman_text)
+        finally:
+            reader.close()
 
-                result = self.conn.execute(self.QUERY_UPDATE_OLD, values)
-                if result.rowcount == 0:
-                    self.conn.execute(self.QUERY_SAVE_NEW, values)
+    def test_write_behind(self):
+        history = HistoryManager(self.path, half_life=NO_DECAY)
+        writer = history._writer
+        writer.idle_delay = writer.max_delay = 60
 
-        except sqlite3.Error as e:
-            logging.exception("Could not save history to disk.")
-        #-----------------------------------------------------------------/
+        for i in range(3):
+            history.save('ami', 'আমি')
+        history.save('ami', 'অমি')
+
+        # Nothing is on disk yet, but searches see the pending uses.
+        self.assertEqual(self._read('ami'), Counter())
+        self.assertEqual(
+            writer.pending('ami'), Counter({'আমি': 3, 'অমি': 1}))
+        history.session_history = SessionHistory(10, 10)
+        self.assertEqual(history.search('ami'), Counter({'আমি': 3, 'অমি': 1}))
+
+        self.assertTrue(history.flush())
+        self.assertEqual(self._read('ami'), Counter({'আমি': 3, 'অমি': 1}))
+        self.assertEqual(writer.pending('ami'), Counter())
+
+        # Pending uses are written on close.
+        history.save('ami', 'আমি')
+        history.close()
+        self.assertEqual(self._read('ami'), Counter({'আমি': 4, 'অমি': 1}))
+
+    def test_flush_when_idle(self):
+        history = HistoryManager(self.path, half_life=NO_DECAY)
+        history._writer.idle_delay = 0.01
+        history.save('tumi', 'তুমি')
+
+        deadline = time.monotonic() + 5
+        while not self._read('tumi') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self._read('tumi'), Counter({'তুমি': 1}))
+        history.close()
+
+    def test_read_while_locked(self):
+        history = HistoryManager(self.path, half_life=NO_DECAY)
+        history.save('ami', 'আমি')
+        history.flush()
+        history._writer.idle_delay = history._writer.max_delay = 60
+        history.save('ami', 'আমি')
+        history.session_history = SessionHistory(10, 10)
+
+        # A compaction, say, locks the database for long.
+        conn = sqlite3.connect(self.path)
+        conn.execute("BEGIN EXCLUSIVE;")
+        try:
+            start = time.monotonic()
+            self.assertEqual(history.search('ami'), Counter({'আমি': 1}))
+            self.assertEqual(history.complete('a', 5), [('আমি', 1)])
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            conn.rollback()
+            conn.close()
+
+        self.assertEqual(history.search('ami'), Counter({'আমি': 2}))
+        history.close()
+
+    def test_retry_when_locked(self):
+        # Another process keeps the database locked.
+        HistoryManager(self.path).close()
+        writer = HistoryWriter(
+            self.path, busy_timeout=0.01, retry_delay=0.01, max_retries=2)
+        writer.idle_delay = writer.max_delay = 60
+        writer.add('ami', 'আমি')
+
+        conn = sqlite3.connect(self.path)
+        conn.execute("BEGIN EXCLUSIVE;")
+        try:
+            with self.assertLogs(level='ERROR'):
+                writer.flush()
+            self.assertEqual(writer.pending('ami'), Counter({'আমি': 1}))
+        finally:
+            conn.rollback()
+            conn.close()
+
+        # The failed batch is written once the lock is gone.
+        writer.add('ami', 'আমি')
+        self.assertTrue(writer.flush(5))
+        writer.close()
+        self.assertEqual(self._read('ami'), Counter({'আমি': 2}))
+
+    def test_count_once_while_committing(self):
+        history = HistoryManager(self.path, half_life=NO_DECAY)
+        writer = history._writer
+        writer.idle_delay = 0
+
+        # Hold the writer between the commit and the end of it.
+        committed = threading.Event()
+        release = threading.Event()
+        write = writer._write
+
+        def hold(conn, batch):
+            written = write(conn, batch)
+            committed.set()
+            release.wait(5)
+            return written
+
+        writer._write = hold
+        history.save('ami', 'আমি')
+        self.assertTrue(committed.wait(5))
+
+        history.session_history = SessionHistory(10, 10)
+        self.assertEqual(history.search('ami'), Counter({'আমি': 1}))
+        self.assertEqual(history.complete('a', 5), [('আমি', 1)])
+
+        release.set()
+        history.close()
+
+
+class _TestCompletion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'history.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _save(self, history, pairs):
+        for roman_text, bangla_text, count in pairs:
+            for i in range(count):
+                history.save(roman_text, bangla_text)
+
+    def test_complete(self):
+        history = HistoryManager(self.path, half_life=NO_DECAY)
+        self._save(history, [
+            ('bangla', 'বাংলা', 3), ('banglay', 'বাংলায়', 5),
+            ('bangali', 'বাঙালি', 1), ('ami', 'আমি', 9),
+            ('banGla', 'বাংলা', 1)])
+
+        # Pending uses are completed from memory, the rest from disk.
+        for flush in (False, True):
+            if flush:
+                history.flush()
+
+            for prefix in ('b', 'ban', 'bangl'):
+                self.assertEqual(
+                    history.complete(prefix, 2),
+                    [('বাংলায়', 5), ('বাংলা', 3)])
+
+            self.assertEqual(
+                history.complete('bangla', 5), [('বাংলায়', 5), ('বাংলা', 3)])
+            self.assertEqual(history.complete('x', 5), [])
+
+        history.close()
+
+    def test_complete_stripped(self):
+        history = HistoryManager(self.path, half_life=NO_DECAY)
+        self._save(history, [
+            ('amar ', 'আমার ', 2), ('amar. ', 'আমার। ', 1),
+            ('amader ', 'আমাদের ', 1), ('. ', '। ', 4)])
+
+        self.assertEqual(
+            history.complete('am', 5, strip=" ।"),
+            [('আমার', 2), ('আমাদের', 1)])
+        self.assertEqual(history.complete('.', 5, strip=" ।"), [])
+        history.close()
+
+    def test_migration(self):
+        # A database of the original schema.
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute(HistoryManager.SCHEMA.strip())
+            conn.execute(
+                "INSERT INTO history VALUES ('tumi', 'তুমি', 4);")
+        conn.close()
+
+        history = HistoryManager(
+            self.path, FUZZY_GENERALIZERS, half_life=NO_DECAY)
+        self.assertEqual(
+            history.conn.execute("PRAGMA user_version;").fetchone()[0],
+            len(HistoryManager.MIGRATIONS))
+        self.assertEqual(history.complete('tu', 5), [('তুমি', 4)])
+        self.assertEqual(history.search('TUUMI'), Counter({'তুমি': 4}))
+
+        history.save('tumi', 'তুমি')
+        history.flush()
+        self.assertEqual(history.complete('t', 5), [('তুমি', 5)])
+        history.close()
+
+
+class _TestGeneralization(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'history.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_keys(self):
+        self.assertEqual(generalization_keys('AamI'), ('AamI', None, None))
+        self.assertEqual(
+            generalization_keys('AamI', FUZZY_GENERALIZERS),
+            ('AamI', 'aami', 'ami'))
+        self.assertEqual(
+            generalization_keys('AamI', (('lower', str.lower),)),
+            ('AamI', 'aami', None))
+        self.assertEqual(match_level(('a', 'b', 'c'), ('x', 'b', 'c')), 1)
+        self.assertIsNone(match_level(('a', None), ('b', None)))
+
+    def test_tightest_match_wins(self):
+        history = HistoryManager(
+            self.path, FUZZY_GENERALIZERS, half_life=NO_DECAY)
+        for roman_text, bangla_text in [
+                ('ami', 'আমি'), ('ami', 'আমি'), ('Ami', 'অমি'),
+                ('amii', 'আমী')]:
+            history.save(roman_text, bangla_text)
+
+        # Pending uses are matched in memory, the rest on disk.
+        for flush in (False, True):
+            if flush:
+                history.flush()
+            history.session_history = SessionHistory(10, 10)
+
+            fuzzy = set()
+            self.assertEqual(
+                history.search('ami', fuzzy), Counter({'আমি': 2}))
+            self.assertEqual(fuzzy, set())
+            self.assertEqual(
+                history.search('AMI', fuzzy), Counter({'আমি': 2, 'অমি': 1}))
+            self.assertEqual(fuzzy, {'আমি', 'অমি'})
+            self.assertEqual(
+                history.search('aamii'),
+                Counter({'আমি': 2, 'অমি': 1, 'আমী': 1}))
+            self.assertEqual(history.search('tumi'), Counter())
+
+        history.close()
+
+    def test_search_uses_indexes(self):
+        history = HistoryManager(self.path, FUZZY_GENERALIZERS)
+        plan = " ".join(
+            row[-1] for row in history.conn.execute(
+                "EXPLAIN QUERY PLAN " + history.QUERY_SEARCH,
+                {"key0": "a", "key1": "a", "key2": "a", "now": 0}))
+        self.assertIn("MULTI-INDEX OR", plan)
+        self.assertNotIn("SCAN history", plan)
+        history.close()
+
+    def test_changed_generalizers(self):
+        history = HistoryManager(self.path, FUZZY_GENERALIZERS)
+        history.save('Ami', 'আমি')
+        history.close()
+
+        generalizers = (('upper', str.upper),)
+        history = HistoryManager(self.path, generalizers=generalizers)
+        self.assertEqual(
+            list(history.conn.execute("SELECT key1, key2 FROM history;")),
+            [('AMI', None)])
+        self.assertEqual(history.search('ami'), Counter({'আমি': 1}))
+        self.assertEqual(history.search('aami'), Counter())
+        history.close()
+
+        with self.assertRaises(ValueError):
+            HistoryManager(self.path, generalizers=generalizers * 3)
+
+
+class _TestAging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'history.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_decayed_usecount(self):
+        self.assertEqual(decayed_usecount(8, 100, 100, 10), 8)
+        self.assertEqual(decayed_usecount(8, 100, 120, 10), 2)
+        self.assertEqual(decayed_usecount(8, 100, 90, 10), 8)
+
+    def _insert(self, conn, rows):
+        with conn:
+            conn.executemany(
+                "INSERT INTO history"
+                " (roman_text, bangla_text, usecount, lastused)"
+                " VALUES (?, ?, ?, ?);", rows)
+
+    def test_newer_habits_win(self):
+        history = HistoryManager(self.path, half_life=3600)
+        now = int(time.time())
+        self._insert(history.conn, [
+            ('ki', 'কী', 50, now - 10 * 3600),
+            ('ki', 'কি', 5, now)])
+
+        self.assertEqual(
+            list(history.search('ki')), ['কি', 'কী'])
+        self.assertEqual(
+            [t for t, _ in history.complete('k', 5)], ['কি', 'কী'])
+        history.close()
+
+    def test_recent_completions_win(self):
+        history = HistoryManager(self.path, half_life=3600)
+        now = int(time.time())
+        self._insert(history.conn, [
+            ('kha' + c, 'খা' + c, 50, now - 10 * 3600) for c in "abcde"] + [
+            ('khan', 'খান', 1, now)])
+
+        # Fewer rows are fetched than there are old, once heavy ones.
+        self.assertEqual(
+            [t for t, _ in history.complete('kh', 1)], ['খান'])
+        history.close()
+
+    def test_compact(self):
+        history = HistoryManager(self.path, half_life=3600)
+        now = int(time.time())
+        self._insert(history.conn, [
+            ('a', str(i), i, now) for i in range(1, 6)] + [
+            ('b', str(i), 10, now - i * 3600) for i in range(1, 4)])
+
+        removed = compact(history.conn, max_rows_per_key=3, max_rows=4)
+        self.assertEqual(removed, 4)
+        self.assertEqual(
+            sorted(history.conn.execute(
+                "SELECT roman_text, bangla_text FROM history;")),
+            [('a', '3'), ('a', '4'), ('a', '5'), ('b', '1')])
+
+        # Prefixes of the removed rows are gone too.
+        self.assertEqual(
+            history.conn.execute(
+                "SELECT COUNT(*) FROM history_prefix;").fetchone()[0], 4)
+        history.close()
+
+    def test_compaction_in_background(self):
+        history = HistoryManager(self.path, half_life=NO_DECAY)
+        now = int(time.time())
+        self._insert(history.conn, [('a', 'x', 1, now), ('a', 'y', 2, now)])
+        history.close()
+
+        writer = HistoryWriter(
+            self.path, compaction_interval=3600, compaction_delay=0,
+            max_rows_per_key=1)
+
+        deadline = time.monotonic() + 5
+        conn = connect(self.path)
+        while time.monotonic() < deadline and not conn.execute(
+                QUERY_GET_META, {"key": "last_compaction"}).fetchone():
+            time.sleep(0.01)
+        writer.close()
+
+        self.assertEqual(
+            list(conn.execute("SELECT bangla_text FROM history;")), [('y',)])
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
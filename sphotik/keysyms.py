@@ -0,0 +1,79 @@
+"""
+Key symbols and modifier masks, as used by IBus (and X11).
+
+They let the engine logic handle key events without IBus. Keysyms of
+printable ASCII characters are the same as their code points.
+"""
+import string
+
+Escape = 0xff1b
+space = 0x020
+Return = 0xff0d
+BackSpace = 0xff08
+Delete = 0xffff
+Tab = 0xff09
+
+Left = 0xff51
+Up = 0xff52
+Right = 0xff53
+Down = 0xff54
+Page_Up = 0xff55
+Page_Down = 0xff56
+
+# Names of the keysyms of printable ASCII punctuations.
+PUNCTUATION_NAMES = {
+    "asciitilde": '~',
+    "grave": '`',
+    "exclam": '!',
+    "at": '@',
+    "numbersign": '#',
+    "dollar": '$',
+    "percent": '%',
+    "asciicircum": '^',
+    "ampersand": '&',
+    "asterisk": '*',
+    "parenleft": '(',
+    "parenright": ')',
+    "minus": '-',
+    "underscore": '_',
+    "plus": '+',
+    "equal": '=',
+    "colon": ':',
+    "semicolon": ';',
+    "quotedbl": '"',
+    "apostrophe": "'",
+    "less": '<',
+    "comma": ',',
+    "greater": '>',
+    "period": '.',
+    "question": '?',
+    "slash": '/',
+    "backslash": '\\',
+}
+
+# Keysyms by name, as found in the IBus module.
+KEYSYMS = dict(
+    {name: ord(c) for name, c in PUNCTUATION_NAMES.items()},
+    **{c: ord(c) for c in string.digits + string.ascii_letters},
+    Escape=Escape, space=space, Return=Return, BackSpace=BackSpace,
+    Delete=Delete, Tab=Tab, Left=Left, Up=Up, Right=Right, Down=Down,
+    Page_Up=Page_Up, Page_Down=Page_Down)
+
+# Modifier masks.
+SHIFT_MASK = 1 << 0
+LOCK_MASK = 1 << 1
+CONTROL_MASK = 1 << 2
+MOD1_MASK = 1 << 3
+SUPER_MASK = 1 << 26
+HYPER_MASK = 1 << 27
+META_MASK = 1 << 28
+RELEASE_MASK = 1 << 30
+
+
+def keyval_to_unicode(keyval):
+    """ Character of a keysym of a printable ASCII character, or an
+    empty string.
+    """
+    if 0x20 <= keyval <= 0x7e:
+        return chr(keyval)
+    return ""
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import bisect
+import logging
+import tempfile
+import unittest
+import threading
+from os.path import join as pjoin
+
+# Upper bounds of histogram buckets in seconds; four buckets per doubling
+# from 10 microseconds upto about 10 seconds. Slower samples go to an
+# overflow bucket.
+LATENCY_BUCKET_BOUNDS = tuple(10e-6 * 2 ** (i / 4) for i in range(81))
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+# Latencies are written to disk once in this many seconds, if any new
+# samples were recorded.
+LATENCY_DUMP_INTERVAL = 600
+
+LATENCY_FILE_NAME = 'latency.json'
+
+
+def user_state_dir():
+    state_dir = (
+        os.environ.get('XDG_STATE_HOME') or
+        os.path.expanduser(pjoin('~', '.local', 'state')))
+    return pjoin(state_dir, 'sphotik')
+
+
+def latency_file_path():
+    return pjoin(user_state_dir(), LATENCY_FILE_NAME)
+
+
+class LatencyHistogram:
+    """ Counts of samples in fixed, logarithmic buckets. """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the 'p'th percentile. """
+        if not self.count:
+            return 0.0
+
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+
+        # The overflow bucket is bound by the slowest sample.
+        if i >= len(LATENCY_BUCKET_BOUNDS):
+            return self.max
+        return min(LATENCY_BUCKET_BOUNDS[i], self.max)
+
+    def summary(self):
+        """ Statistics of the samples, in milliseconds. """
+        summary = {
+            'count': self.count,
+            'mean': 1000 * self.total / self.count if self.count else 0.0,
+            'max': 1000 * self.max}
+        for p in LATENCY_PERCENTILES:
+            summary['p{}'.format(p)] = 1000 * self.percentile(p)
+        return summary
+
+
+class _Measurement:
+
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.recorder.record(self.name, time.perf_counter() - self.start)
+
+
+class LatencyRecorder:
+    """ Histograms of latencies, by the name of the measured phase.
+
+    Usage:
+        with recorder.measure('insert'):
+            parser.insert(text)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._nsamples = 0
+        self._ndumped = 0
+
+    def measure(self, name):
+        return _Measurement(self, name)
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+            self._nsamples += 1
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: histogram.summary()
+                for name, histogram in sorted(self._histograms.items())}
+
+    def format(self):
+        lines = ["{:<12} {:>8} {:>8} {:>8} {:>8} {:>8}  (ms)".format(
+            'phase', 'count', 'p50', 'p95', 'p99', 'max')]
+        for name, s in self.summary().items():
+            lines.append(
+                "{:<12} {:>8} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+                    name, s['count'], s['p50'], s['p95'], s['p99'],
+                    s['max']))
+        return "\n".join(lines)
+
+    def dump(self, path=None):
+        """ Atomically write the summary to a JSON file. Returns the
+        path of the file.
+        """
+        if path is None:
+            path = latency_file_path()
+
+        with self._lock:
+            self._ndumped = self._nsamples
+
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'time': int(time.time()),
+                    'pid': os.getpid(),
+                    'latency': self.summary()}, f, indent=2)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+        return path
+
+    def dump_if_changed(self, path=None):
+        """ Dump the summary, if samples were recorded since the last
+        dump. Errors are logged.
+        """
+        if self._nsamples == self._ndumped:
+            return
+        try:
+            self.dump(path)
+        except OSError:
+            logging.exception("Could not write latencies to disk.")
+
+
+class _TestLatency(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(50), 0.0)
+
+        for i in range(1, 101):
+            histogram.record(i / 1000)
+
+        # Bounds of buckets are off by a fifth at most.
+        for p in LATENCY_PERCENTILES:
+            self.assertLessEqual(histogram.percentile(p), p / 1000 * 1.2)
+            self.assertGreaterEqual(histogram.percentile(p), p / 1000)
+        self.assertEqual(histogram.percentile(100), 0.1)
+
+        histogram.record(1000)
+        self.assertEqual(histogram.percentile(100), 1000)
+
+    def test_dump(self):
+        recorder = LatencyRecorder()
+        with recorder.measure('insert'):
+            pass
+        recorder.record('update', 0.002)
+
+        with tempfile.TemporaryDirectory() as d:
+            path = pjoin(d, 'sphotik', LATENCY_FILE_NAME)
+            self.assertEqual(recorder.dump(path), path)
+            with open(path) as f:
+                latency = json.load(f)['latency']
+
+            self.assertEqual(sorted(latency), ['insert', 'update'])
+            self.assertEqual(latency['update']['count'], 1)
+            self.assertAlmostEqual(latency['update']['p99'], 2)
+
+            # Nothing new to write.
+            os.unlink(path)
+            recorder.dump_if_changed(path)
+            self.assertFalse(os.path.exists(path))
+
+        self.assertIn('update', recorder.format())
@@ -1,11 +1,15 @@
-from copy import deepcopy
-
-from gi.repository import IBus
+from copy import copy
+from collections import namedtuple
 
 from sphotiklib.parser import Parser
+from sphotiklib.utils import DIACRITIC, CONJOINED, FORCED_DIACRITIC
+
+# Preedit text, with the position and the foreground and background colors
+# of a cursor mark in it. The position is None if there is no mark.
+Preedit = namedtuple('Preedit', 'text mark_pos mark_fg mark_bg')
 
 
-class ParserIbus(Parser):
+class EditingParser(Parser):
     preedit_cursor = ('|', 0x555555, 0xFFBBBB)
     preedit_cursor_alt = ('+', 0x555555, 0xBBFFBB)
     preedit_cursor_enabled = True
@@ -45,12 +49,12 @@ class ParserIbus(Parser):
                 except IndexError:
                     break
 
-        self.cord = self.cord[:start] + self.cord[end:]
+        self.cord.delete(start, end)
         self.cursor = (
             max(0, self.cursor - taken_steps)
                 if (steps < 0) else self.cursor)
 
-        self.cord = self._adjust_flags(self.cord)
+        self.cord = self._adjust_flags(self.cord, start, start)
 
     @property
     def normcursor(self):
@@ -89,18 +93,11 @@ class ParserIbus(Parser):
         self.cursor = min(len(self.cord), max(0, self.cursor))
 
     @property
-    def itext(self):
-        return self._render_itext(self.cord)
-
-    def _render_itext(self, cord):
-        return IBus.Text.new_from_string(super().render_text(cord))
-
-    @property
-    def preedit_itext(self):
-        return self._render_preddit_itext(
+    def preedit(self):
+        return self.render_preedit(
             self.cord, self.cursor if self.preedit_cursor_enabled else None)
 
-    def _render_preddit_itext(self, cord, cursor):
+    def render_preedit(self, cord, cursor):
         output = ""
         alt_cursor_used = False
         rendered_cursor_pos = None
@@ -108,8 +105,7 @@ class ParserIbus(Parser):
         for i, bead in enumerate(cord):
             show_cursor = (i == cursor)
 
-            if (('DIACRITIC' in bead.flags) or
-                    ('FORCED_DIACRITICT' in bead.flags)):
+            if bead.flags & (DIACRITIC | FORCED_DIACRITIC):
                 if show_cursor:
                     rendered_cursor_pos = len(output)
                     output += (self.preedit_cursor_alt[0] + bead.v)
@@ -118,7 +114,7 @@ class ParserIbus(Parser):
                     output += self._to_diacritic(bead).v
                 continue
 
-            if 'CONJOINED' in bead.flags:
+            if bead.flags & CONJOINED:
                 if show_cursor:
                     rendered_cursor_pos = len(output)
                     output += (self.preedit_cursor_alt[0] + bead.v)
@@ -136,38 +132,15 @@ class ParserIbus(Parser):
 
             output += bead.v
 
-        t = IBus.Text.new_from_string(output)
-
-        if rendered_cursor_pos is not None:
-            if alt_cursor_used:
-                fgc, bgc = self.preedit_cursor_alt[1:]
-            else:
-                fgc, bgc = self.preedit_cursor[1:]
+        if rendered_cursor_pos is None:
+            return Preedit(output, None, None, None)
 
-            # Add background color.
-            if bgc is not None:
-                t.append_attribute(
-                    IBus.AttrType.BACKGROUND,
-                    bgc,
-                    rendered_cursor_pos,
-                    rendered_cursor_pos + 1)
-
-            # Add foreground color.
-            if fgc is not None:
-                t.append_attribute(
-                    IBus.AttrType.FOREGROUND,
-                    fgc,
-                    rendered_cursor_pos,
-                    rendered_cursor_pos + 1)
-
-        return t
-
-    @property
-    def auxiliary_itext(self):
-        return self._render_auxiliary_itext(self.cord)
+        if alt_cursor_used:
+            fgc, bgc = self.preedit_cursor_alt[1:]
+        else:
+            fgc, bgc = self.preedit_cursor[1:]
 
-    def _render_auxiliary_itext(self, cord):
-        return IBus.Text.new_from_string(self.render_input_text(cord))
+        return Preedit(output, rendered_cursor_pos, fgc, bgc)
 
     @property
     def input_text(self):
@@ -194,8 +167,8 @@ class ParserIbus(Parser):
         suggestions = []
 
         def suggest_without_flags(index, flags_to_remove):
-            newbead = deepcopy(self.cord[index])
-            newbead.remove_flags(*flags_to_remove)
+            newbead = copy(self.cord[index])
+            newbead.remove_flags(flags_to_remove)
 
             newcord = self.cord[:index] + newbead + self.cord[index + 1:]
             suggestions.append(self.render_text(newcord))
@@ -203,15 +176,15 @@ class ParserIbus(Parser):
         # Find first (from right) consonant that is conjoined and
         # suggest it to be disjoined.
         for i, bead in reversed(list(enumerate(self.cord))):
-            if 'CONJOINED' in bead.flags:
-                suggest_without_flags(i, ('CONJOINED',))
+            if bead.flags & CONJOINED:
+                suggest_without_flags(i, CONJOINED)
                 break
 
         # Find first (from left) consonant that is conjoined and
         # suggest it to be disjoined.
         for i, bead in enumerate(self.cord):
-            if 'CONJOINED' in bead.flags:
-                suggest_without_flags(i, ('CONJOINED',))
+            if bead.flags & CONJOINED:
+                suggest_without_flags(i, CONJOINED)
                 break
 
         # Shape of these vowels are usually ambiguous except at the
@@ -229,9 +202,8 @@ class ParserIbus(Parser):
             if bead.v not in vowels_to_modify:
                 continue
 
-            if (('DIACRITIC' in bead.flags) or
-                    ('FORCED_DIACRITIC' in bead.flags)):
-                suggest_without_flags(i, ('DIACRITIC', 'FORCED_DIACRITIC'))
+            if bead.flags & (DIACRITIC | FORCED_DIACRITIC):
+                suggest_without_flags(i, DIACRITIC | FORCED_DIACRITIC)
                 break
 
         # Find first (from left) vowel that is diacritic and
@@ -240,9 +212,8 @@ class ParserIbus(Parser):
             if bead.v not in vowels_to_modify:
                 continue
 
-            if (('DIACRITIC' in bead.flags) or
-                    ('FORCED_DIACRITIC' in bead.flags)):
-                suggest_without_flags(i, ('DIACRITIC', 'FORCED_DIACRITIC'))
+            if bead.flags & (DIACRITIC | FORCED_DIACRITIC):
+                suggest_without_flags(i, DIACRITIC | FORCED_DIACRITIC)
                 break
 
         return suggestions
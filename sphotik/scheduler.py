@@ -0,0 +1,170 @@
+import time
+import unittest
+
+# An update runs once no change is made for this many seconds, ...
+UPDATE_DEBOUNCE_DELAY = 0.03
+
+# ... but never later than this many seconds after the first change.
+UPDATE_MAX_DELAY = 0.1
+
+
+class UpdateScheduler:
+    """ Runs an update some time after a change, so that a burst of
+    keystrokes is covered by a single update.
+
+    Fetching suggestions for every key insert can incur significant
+    runtime cost and sluggish user experience when users type very fast.
+    At most one timer is pending at a time; changes made while it waits
+    merely push the update further, within the latency budget.
+    """
+
+    def __init__(
+            self,
+            update,
+            add_timeout,
+            remove_timeout,
+            debounce=UPDATE_DEBOUNCE_DELAY,
+            budget=UPDATE_MAX_DELAY,
+            clock=time.monotonic):
+        """ Timers are made by 'add_timeout(milliseconds, callback)' and
+        removed by 'remove_timeout(id)', e.g. 'GLib.timeout_add' and
+        'GLib.source_remove'.
+        """
+        self._update = update
+        self._add_timeout = add_timeout
+        self._remove_timeout = remove_timeout
+        self.debounce = debounce
+        self.budget = budget
+        self._clock = clock
+
+        # Times of the first and the last change not yet updated.
+        self._first_time = None
+        self._last_time = None
+        self._timer = None
+
+    @property
+    def pending(self):
+        return self._first_time is not None
+
+    def schedule(self):
+        """ Note a change, to be covered by an update later on. """
+        now = self._clock()
+        if self._first_time is None:
+            self._first_time = now
+        self._last_time = now
+
+        if self._timer is None:
+            self._start_timer(self._delay(now))
+
+    def flush(self):
+        """ Run the pending update, if any, right away. """
+        self._stop_timer()
+        if self._first_time is not None:
+            self._run()
+
+    def cancel(self):
+        """ Forget the pending update, if any. """
+        self._stop_timer()
+        self._first_time = self._last_time = None
+
+    def _due_time(self):
+        return min(
+            self._last_time + self.debounce,
+            self._first_time + self.budget)
+
+    def _delay(self, now):
+        # Milliseconds until the update is due.
+        return max(0, round((self._due_time() - now) * 1000))
+
+    def _start_timer(self, delay):
+        self._timer = self._add_timeout(delay, self._on_timeout)
+
+    def _stop_timer(self):
+        if self._timer is not None:
+            self._remove_timeout(self._timer)
+            self._timer = None
+
+    def _on_timeout(self):
+        self._timer = None
+        if self._first_time is None:
+            return False
+
+        # Changes made in the meantime push the update further.
+        delay = self._delay(self._clock())
+        if delay > 0:
+            self._start_timer(delay)
+        else:
+            self._run()
+        return False
+
+    def _run(self):
+        self._first_time = self._last_time = None
+        self._update()
+
+
+class _TestUpdateScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.timers = {}
+        self.timer_ids = iter(range(1, 1000))
+        self.updates = []
+        self.scheduler = UpdateScheduler(
+            lambda: self.updates.append(self.now),
+            self._add_timeout, self.timers.pop,
+            debounce=0.03, budget=0.1, clock=lambda: self.now)
+
+    def _add_timeout(self, milliseconds, callback):
+        timer = next(self.timer_ids)
+        self.timers[timer] = (self.now + milliseconds / 1000, callback)
+        return timer
+
+    def _advance(self, seconds):
+        # Fire the timers due upto the given time, like a main loop.
+        end = self.now + seconds
+        while self.timers:
+            timer, (due, callback) = min(
+                self.timers.items(), key=lambda t: t[1][0])
+            if due > end:
+                break
+            self.now = due
+            del self.timers[timer]
+            callback()
+        self.now = end
+
+    def test_burst_is_coalesced(self):
+        for i in range(5):
+            self.scheduler.schedule()
+            self.assertLessEqual(len(self.timers), 1)
+            self._advance(0.01)
+
+        self._advance(0.1)
+        self.assertEqual(len(self.updates), 1)
+        self.assertAlmostEqual(self.updates[0], 0.07)
+        self.assertFalse(self.scheduler.pending)
+
+    def test_latency_budget(self):
+        for i in range(30):
+            self.scheduler.schedule()
+            self._advance(0.01)
+
+        self.assertEqual(len(self.updates), 2)
+        self.assertAlmostEqual(self.updates[0], 0.1)
+
+    def test_flush(self):
+        self.scheduler.schedule()
+        self.scheduler.flush()
+        self.assertEqual(self.updates, [0.0])
+        self.assertEqual(self.timers, {})
+
+        # Nothing to do.
+        self.scheduler.flush()
+        self._advance(1)
+        self.assertEqual(self.updates, [0.0])
+
+    def test_cancel(self):
+        self.scheduler.schedule()
+        self.scheduler.cancel()
+        self._advance(1)
+        self.assertEqual(self.updates, [])
+        self.assertEqual(self.timers, {})
@@ -0,0 +1,127 @@
+import logging
+import unittest
+import threading
+
+
+class AsyncSuggester:
+    """ Computes suggestions of a dictionary on a thread of it's own,
+    keeping slow dictionaries off the keystroke path.
+
+    Only the latest request matters. A request replaces the one still
+    waiting for the thread, and results are not delivered if a newer
+    request has arrived in the meantime.
+    """
+
+    def __init__(self, suggest, deliver):
+        """ Suggestions of a text are made by 'suggest(text)'. They are
+        handed over by 'deliver(callback, generation, text, suggestions)',
+        which is supposed to run the callback on the thread of the
+        requester, e.g. 'GLib.idle_add'.
+        """
+        self._suggest = suggest
+        self._deliver = deliver
+
+        self._cond = threading.Condition()
+        self._request = None
+        self._closing = False
+
+        self._thread = threading.Thread(
+            target=self._run, name='sphotik-suggester', daemon=True)
+        self._thread.start()
+
+    def request(self, generation, text, callback):
+        """ Ask for suggestions of 'text'. The 'generation' is handed
+        back with the results, so that the requester can tell whether
+        they are still of any use.
+        """
+        with self._cond:
+            self._request = (generation, text, callback)
+            self._cond.notify_all()
+
+    def cancel(self):
+        """ Forget the request waiting for the thread, if any. """
+        with self._cond:
+            self._request = None
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._closing = True
+            self._request = None
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closing or self._request is not None)
+                if self._closing:
+                    return
+
+                generation, text, callback = self._request
+                self._request = None
+
+            try:
+                suggestions = self._suggest(text)
+            except Exception:
+                logging.exception("Could not make suggestions.")
+                suggestions = []
+
+            with self._cond:
+                # Results are outdated already.
+                if self._closing or self._request is not None:
+                    continue
+
+            self._deliver(callback, generation, text, suggestions)
+
+
+class _TestAsyncSuggester(unittest.TestCase):
+
+    def setUp(self):
+        self.delivered = []
+        self.done = threading.Event()
+
+    def _deliver(self, callback, *args):
+        callback(*args)
+
+    def _callback(self, generation, text, suggestions):
+        self.delivered.append((generation, text, suggestions))
+        self.done.set()
+
+    def test_latest_request_wins(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def suggest(text):
+            if text == 'slow':
+                started.set()
+                release.wait(5)
+            return [text.upper()]
+
+        suggester = AsyncSuggester(suggest, self._deliver)
+        suggester.request(1, 'slow', self._callback)
+        self.assertTrue(started.wait(5))
+
+        # Requests made while the thread is busy replace each other; the
+        # results of the busy one are outdated by them.
+        suggester.request(2, 'ami', self._callback)
+        suggester.request(3, 'tumi', self._callback)
+        release.set()
+
+        self.assertTrue(self.done.wait(5))
+        suggester.close(5)
+        self.assertEqual(self.delivered, [(3, 'tumi', ['TUMI'])])
+
+    def test_failing_dictionary(self):
+        def suggest(text):
+            raise RuntimeError(text)
+
+        suggester = AsyncSuggester(suggest, self._deliver)
+        logging.disable(logging.CRITICAL)
+        try:
+            suggester.request(1, 'ami', self._callback)
+            self.assertTrue(self.done.wait(5))
+        finally:
+            logging.disable(logging.NOTSET)
+        suggester.close(5)
+        self.assertEqual(self.delivered, [(1, 'ami', [])])
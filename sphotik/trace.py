@@ -0,0 +1,412 @@
+"""
+Recording and replaying of keystroke traces.
+
+A trace holds the time, keyval and modifier state of every key event the
+engine got. Recording is opt-in; it is turned on for the engine by the
+environment variable 'SPHOTIK_TRACE', holding the path of the trace file.
+If 'SPHOTIK_TRACE_PRIVATE' is set as well, words of letters and digits
+are replaced by random ones before they are written.
+
+Replaying a trace feeds it into an 'EngineCore' without IBus, at the
+original speed or as fast as possible, and reports the latency of every
+key and the committed text:
+    python3 -m sphotik.trace trace.jsonl [--realtime] [--history FILE]
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import random
+import shutil
+import string
+import argparse
+import tempfile
+import unittest
+import collections
+from os.path import join as pjoin
+
+from . import keysyms
+from .core import EngineCore, Frontend
+from .latency import LatencyRecorder, LatencyHistogram
+from .fakeibus import MainContext
+
+TRACE_FORMAT = 'sphotik-trace'
+TRACE_VERSION = 1
+
+TRACE_PATH_VARIABLE = 'SPHOTIK_TRACE'
+TRACE_PRIVATE_VARIABLE = 'SPHOTIK_TRACE_PRIVATE'
+
+# A private recorder remembers the replacements of this many words, the
+# most recently typed ones.
+TRACE_MAX_REPLACEMENTS = 1000
+
+# Keys typed with these modifiers are shortcuts, not text.
+SHORTCUT_MASK = keysyms.CONTROL_MASK | keysyms.MOD1_MASK
+
+
+class TraceRecorder:
+    """ Writes key events to a trace file, one JSON line each.
+
+    The first line is a header; an event is a '[seconds, keyval, state]'
+    list, the time counted from the first event.
+
+    A private trace keeps the timing and the structure of the typed text,
+    but not the text: every word of letters and digits is replaced by a
+    random word of the same shape, the same one for every use of the word
+    and a different one for every other word. Only the replacements of
+    the last 'max_replacements' words are remembered, though; a word
+    typed again after that gets a new one. A replay of it does not
+    reproduce the original text. Shortcuts, like Ctrl+c, are written as
+    they are. The keys of a word are written once the word ends, so the
+    word being typed is lost on a crash.
+    """
+
+    max_replacements = TRACE_MAX_REPLACEMENTS
+
+    def __init__(self, path, private=False, clock=time.monotonic):
+        self.path = path
+        self.private = private
+        self._clock = clock
+        self._start = None
+
+        # Random words by keyed digests of the words they replace, least
+        # recently used first, and the events of the word being typed.
+        # The key is never written; typed words are not kept as they are.
+        self._key = os.urandom(16)
+        self._random = random.SystemRandom()
+        self._replacements = collections.OrderedDict()
+        self._replaced = set()
+        self._word = []
+
+        # Lines are written as they come, so that a crash does not lose
+        # the very keys leading upto it. Typed text is nobody else's
+        # business; the trace is private to the user, like the history.
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._file = os.fdopen(fd, 'a', buffering=1)
+        self._write({
+            'format': TRACE_FORMAT,
+            'version': TRACE_VERSION,
+            'private': private,
+            'time': int(time.time())})
+
+    def _write(self, data):
+        self._file.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+    def _replace(self, word):
+        digest = hmac.digest(self._key, word.encode(), 'sha256')
+        replacement = self._replacements.get(digest)
+        if replacement is not None:
+            self._replacements.move_to_end(digest)
+            return replacement
+
+        # There are as many words of a shape as there are replacements,
+        # so an unused one is always found.
+        while replacement is None or replacement in self._replaced:
+            replacement = "".join(
+                self._random.choice(_alphabet(c)) for c in word)
+        self._replacements[digest] = replacement
+        self._replaced.add(replacement)
+
+        if len(self._replacements) > self.max_replacements:
+            _, forgotten = self._replacements.popitem(last=False)
+            self._replaced.discard(forgotten)
+        return replacement
+
+    def _end_word(self):
+        if not self._word:
+            return
+        word = "".join(chr(keyval) for _, keyval, _ in self._word)
+        for (seconds, _, state), c in zip(
+                self._word, self._replace(word)):
+            self._write([seconds, ord(c), state])
+        self._word = []
+
+    def record(self, keyval, state):
+        now = self._clock()
+        if self._start is None:
+            self._start = now
+
+        event = [round(now - self._start, 6), keyval, state]
+        if self.private:
+            if (keyval < 0x80 and _alphabet(chr(keyval)) and
+                    not state & SHORTCUT_MASK):
+                self._word.append(event)
+                return
+            self._end_word()
+        self._write(event)
+
+    def close(self):
+        if self.private:
+            self._end_word()
+        self._file.close()
+
+
+def _alphabet(c):
+    # Alphabet of a letter or digit, or None.
+    for alphabet in (
+            string.ascii_lowercase,
+            string.ascii_uppercase,
+            string.digits):
+        if c in alphabet:
+            return alphabet
+    return None
+
+
+def recorder_from_environment():
+    """ A recorder as asked for by the environment, or None. """
+    path = os.environ.get(TRACE_PATH_VARIABLE)
+    if not path:
+        return None
+    return TraceRecorder(
+        os.path.expanduser(path),
+        private=bool(os.environ.get(TRACE_PRIVATE_VARIABLE)))
+
+
+def read_trace(path):
+    """ Returns the header and the '(seconds, keyval, state)' events of
+    a trace.
+    """
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('format') != TRACE_FORMAT:
+            raise ValueError("Not a trace: {}".format(path))
+        if header.get('version') != TRACE_VERSION:
+            raise ValueError(
+                "Unknown trace version: {}".format(header.get('version')))
+
+        events = []
+        offset = 0
+        for line in f:
+            # The last line may be cut short by a crash.
+            try:
+                data = json.loads(line)
+            except ValueError:
+                break
+
+            # Later sessions of the engine append to the trace; they go
+            # right after the earlier ones.
+            if isinstance(data, dict):
+                offset = events[-1][0] if events else 0
+                continue
+
+            seconds, keyval, state = data
+            events.append((offset + seconds, keyval, state))
+
+    return header, events
+
+
+class _ReplayFrontend(Frontend):
+
+    def __init__(self):
+        self.committed = ""
+        self.preedit = ""
+
+    def commit(self, text):
+        self.committed += text
+
+    def show_preedit(self, preedit):
+        self.preedit = preedit.text
+
+    def hide_preedit(self):
+        self.preedit = ""
+
+
+class _VirtualClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def replay(events, realtime=False, history_file_path=None,
+           core_class=EngineCore):
+    """ Feed key events into a new engine core.
+
+    As fast as possible, the time of the trace is kept by a virtual clock,
+    so that timers fall due as they did while recording. Replays use a
+    copy of the history file, if any, and a fresh history otherwise.
+
+    Returns a dict of the committed text, the preedit left over, the
+    per-key latencies in seconds and a summary of the latencies of the
+    phases of key handling.
+    """
+    class Core(core_class):
+        latency_recorder = LatencyRecorder()
+        trace_recorder = None
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pjoin(tmpdir, 'history.sqlite')
+        if history_file_path is not None:
+            shutil.copyfile(history_file_path, path)
+
+        clock = time.monotonic if realtime else _VirtualClock()
+        loop = MainContext(clock)
+        frontend = _ReplayFrontend()
+        core = Core(frontend, loop, path, clock)
+
+        key_latencies = []
+        start = clock()
+        try:
+            for seconds, keyval, state in events:
+                # Run the timers due before the key.
+                if realtime:
+                    loop.run_until(start + seconds)
+                else:
+                    _advance(loop, clock, start + seconds)
+
+                t = time.perf_counter()
+                core.process_key_event(keyval, 0, state)
+                key_latencies.append(time.perf_counter() - t)
+
+            core.flush()
+            loop.run_until_idle()
+        finally:
+            core.close()
+
+    histogram = LatencyHistogram()
+    for seconds in key_latencies:
+        histogram.record(seconds)
+
+    return {
+        'committed': frontend.committed,
+        'preedit': frontend.preedit,
+        'key_latencies': key_latencies,
+        'key': histogram.summary(),
+        'latency': Core.latency_recorder.summary()}
+
+
+def _advance(loop, clock, deadline):
+    # Move the virtual clock to the deadline, running timers on the way.
+    while True:
+        due = loop.next_due_time()
+        if due is None or due > deadline:
+            break
+        clock.now = max(clock.now, due)
+        loop.iteration()
+    clock.now = max(clock.now, deadline)
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        prog='python3 -m sphotik.trace',
+        description="Replay a keystroke trace of sphotik.")
+    argparser.add_argument('trace', help="Path of the trace file.")
+    argparser.add_argument(
+        '--realtime', action='store_true',
+        help="Replay at the original speed, not as fast as possible.")
+    argparser.add_argument(
+        '--history', metavar='FILE', default=None,
+        help="Replay upon a copy of this history file.")
+    argparser.add_argument(
+        '--json', action='store_true', help="Print the report as JSON.")
+    args = argparser.parse_args(argv)
+
+    header, events = read_trace(args.trace)
+    report = replay(events, args.realtime, args.history)
+
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return 0
+
+    key = report['key']
+    print("Keys: {}{}".format(
+        key['count'], " (anonymized)" if header.get('private') else ""))
+    print("Key latency (ms): p50 {:.2f}, p95 {:.2f}, p99 {:.2f},"
+          " max {:.2f}".format(key['p50'], key['p95'], key['p99'],
+                               key['max']))
+    print("Committed: {!r}".format(report['committed']))
+    print("Preedit: {!r}".format(report['preedit']))
+    return 0
+
+
+class _TestTrace(unittest.TestCase):
+
+    class _Core(EngineCore):
+        enchant_dict_names = []
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = pjoin(self.tmpdir.name, 'trace.jsonl')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _record(self, text, private=False):
+        now = [0.0]
+        recorder = TraceRecorder(self.path, private, clock=lambda: now[0])
+        for c in text:
+            recorder.record(ord(c), 0)
+            now[0] += 0.1
+        recorder.close()
+        return read_trace(self.path)
+
+    def test_replay(self):
+        header, events = self._record("ami tumi")
+        self.assertFalse(header['private'])
+        self.assertEqual(events[:2], [(0, ord('a'), 0), (0.1, ord('m'), 0)])
+
+        # A second session of the engine.
+        recorder = TraceRecorder(self.path)
+        recorder.record(keysyms.Right, 0)
+        recorder.close()
+        header, events = read_trace(self.path)
+        self.assertEqual(events[-1], (0.7, keysyms.Right, 0))
+
+        report = replay(events, core_class=self._Core)
+        self.assertEqual(report['committed'], "আমি ")
+        self.assertEqual(report['preedit'], "তুমি")
+        self.assertEqual(len(report['key_latencies']), len(events))
+
+        # Keys were .1 seconds apart and every one of them was updated
+        # upon, but for the last two, which came at once.
+        self.assertEqual(
+            report['latency']['update']['count'], len(events) - 1)
+
+    def test_permissions(self):
+        self._record("ami")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_private_shortcuts_and_memory(self):
+        recorder = TraceRecorder(self.path, private=True)
+        recorder.max_replacements = 2
+        for word in ("ami", "tumi", "se", "ami"):
+            for c in word + " ":
+                recorder.record(ord(c), 0)
+        recorder.record(ord('c'), keysyms.CONTROL_MASK)
+        recorder.record(ord('x'), keysyms.MOD1_MASK | keysyms.SHIFT_MASK)
+        self.assertEqual(len(recorder._replacements), 2)
+        self.assertEqual(len(recorder._replaced), 2)
+        self.assertNotIn(b"ami", b"".join(recorder._replacements))
+        recorder.close()
+
+        header, events = read_trace(self.path)
+        self.assertEqual(events[-2][1:], (ord('c'), keysyms.CONTROL_MASK))
+        self.assertEqual(
+            events[-1][1:],
+            (ord('x'), keysyms.MOD1_MASK | keysyms.SHIFT_MASK))
+
+    def test_private(self):
+        text = "ami, ami 42 amr Ami"
+        header, events = self._record(text, private=True)
+        self.assertTrue(header['private'])
+        self.assertEqual(
+            [seconds for seconds, _, _ in events],
+            [round(0.1 * i, 6) for i in range(len(text))])
+
+        typed = "".join(chr(keyval) for _, keyval, _ in events)
+        self.assertNotEqual(typed, text)
+        self.assertEqual(len(typed), len(text))
+        words = typed.replace(",", "").split(" ")
+        self.assertEqual(typed[3:5], ", ")
+        self.assertEqual(words[0], words[1])
+        self.assertEqual(len(set(words)), 4)
+        self.assertTrue(words[0].islower() and words[2].isdigit())
+        self.assertTrue(words[4][0].isupper() and words[4][1:].islower())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
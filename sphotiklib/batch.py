@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Transliterate files or directories of roman text using all cores.
+
+Input is split into shards on line boundaries, or on white space within
+overly long lines, which are transliterated in a pool of worker processes
+and reassembled in order. Each worker loads the rule set once.
+
+Usage:
+    python3 -m sphotiklib.batch [-r RULENAME] [-j JOBS] [-o OUTPUT] INPUT...
+
+Without OUTPUT, the transliterated text is written to standard output.
+Otherwise OUTPUT is a file for a single input file, or a directory that
+mirrors the inputs.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import unittest
+import collections
+from os.path import join as pjoin
+from concurrent.futures import ProcessPoolExecutor
+
+from .parser import Parser
+from .ruleparser import Rule
+from .stream import transliterate_stream, WHITESPACE
+from .cache import TransliterationCache, DEFAULT_CACHE_SIZE
+from .utils import Cord
+
+DEFAULT_RULENAME = 'avro'
+
+# Approximate size of a shard in bytes.
+DEFAULT_SHARD_SIZE = 1 << 20
+
+# Invalid bytes are carried through to the output untouched.
+ENCODING = 'utf-8'
+ENCODING_ERRORS = 'surrogateescape'
+
+# White space bytes to cut shards at; they never occur within a multibyte
+# character of UTF-8.
+_WHITESPACE_BYTES = WHITESPACE.encode('ascii')
+
+# Rule, contexts by separator and word cache of a worker process.
+_worker_rule = None
+_worker_contexts = None
+_worker_cache = None
+
+
+def _init_worker(rulename, cache_size):
+    global _worker_rule, _worker_contexts, _worker_cache
+    _worker_rule = Rule(rulename)
+    _worker_contexts = {b"": Cord()}
+    if cache_size > 0:
+        _worker_cache = TransliterationCache(cache_size)
+
+
+def _context(separator):
+    # Every shard but the first starts right after a line break or some
+    # other white space. That separator is all the context a shard gets;
+    # it keeps contextual rules from taking the start of a shard for the
+    # start of text.
+    context = _worker_contexts.get(separator)
+    if context is None:
+        p = Parser(_worker_rule)
+        p.insert(separator.decode(ENCODING))
+        context = _worker_contexts[separator] = p.cord
+    return context
+
+
+def _transliterate_shard(shard, separator):
+    text = shard.decode(ENCODING, ENCODING_ERRORS)
+    context = _context(separator)
+    output = "".join(
+        transliterate_stream(_worker_rule, [text], context, _worker_cache))
+    return output.encode(ENCODING, ENCODING_ERRORS), len(text.split())
+
+
+def _cut_position(buf):
+    # Position right after the last line break, or else after the last
+    # white space; zero if there is neither.
+    cut = buf.rfind(b"\n") + 1
+    if cut == 0:
+        cut = max(buf.rfind(bytes([c])) for c in _WHITESPACE_BYTES) + 1
+    return cut
+
+
+def read_shards(f, shard_size=DEFAULT_SHARD_SIZE):
+    """ Split a binary file into shards of about 'shard_size' bytes,
+    ending on line boundaries. Lines longer than that are cut on white
+    space; a single word is never cut.
+    """
+    buf = b""
+    while True:
+        block = f.read(shard_size)
+        if not block:
+            break
+        buf += block
+
+        if len(buf) >= shard_size:
+            cut = _cut_position(buf)
+            if cut > 0:
+                yield buf[:cut]
+                buf = buf[cut:]
+
+    if buf:
+        yield buf
+
+
+class Stats:
+
+    def __init__(self):
+        self.files = 0
+        self.words = 0
+        self.nbytes = 0
+        self.start_time = time.monotonic()
+
+    def report(self, out=sys.stderr):
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        mb = self.nbytes / 1e6
+        print(
+            "{} files, {} words, {:.2f} MB in {:.2f}s:"
+            " {:.0f} words/s, {:.2f} MB/s".format(
+                self.files, self.words, mb, elapsed,
+                self.words / elapsed, mb / elapsed),
+            file=out)
+
+
+class BatchTransliterator:
+
+    def __init__(
+            self, rulename=DEFAULT_RULENAME, jobs=None,
+            shard_size=DEFAULT_SHARD_SIZE, cache_size=DEFAULT_CACHE_SIZE):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.stats = Stats()
+        self._executor = ProcessPoolExecutor(
+            self.jobs, initializer=_init_worker,
+            initargs=(rulename, cache_size))
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def transliterate_file(self, infile, outfile):
+        """ Transliterate binary file object 'infile' into 'outfile'. """
+        # A few shards per worker are kept in flight; reading further
+        # ahead would only pile up shards in memory.
+        pending = collections.deque()
+        separator = b""
+        for shard in read_shards(infile, self.shard_size):
+            self.stats.nbytes += len(shard)
+            pending.append(
+                self._executor.submit(_transliterate_shard, shard, separator))
+            separator = shard[-1:]
+
+            if len(pending) >= 2 * self.jobs:
+                self._write(pending.popleft().result(), outfile)
+
+        while pending:
+            self._write(pending.popleft().result(), outfile)
+
+        self.stats.files += 1
+
+    def _write(self, result, outfile):
+        output, nwords = result
+        outfile.write(output)
+        self.stats.words += nwords
+
+    def transliterate_path(self, inpath, outpath):
+        with open(inpath, 'rb') as infile:
+            if outpath is None:
+                self.transliterate_file(infile, sys.stdout.buffer)
+                return
+
+            os.makedirs(os.path.dirname(outpath) or '.', exist_ok=True)
+            with open(outpath, 'wb') as outfile:
+                self.transliterate_file(infile, outfile)
+
+
+def list_inputs(inputs, output):
+    """ Produce pairs of input and output file paths. """
+    todir = output is not None and (
+        len(inputs) > 1 or
+        os.path.isdir(output) or
+        any(os.path.isdir(i) for i in inputs))
+
+    for inpath in inputs:
+        if not os.path.isdir(inpath):
+            if not todir:
+                yield inpath, output
+            else:
+                yield inpath, pjoin(output, os.path.basename(inpath))
+            continue
+
+        for dirpath, dirnames, fnames in os.walk(inpath):
+            dirnames.sort()
+            for fname in sorted(fnames):
+                fpath = pjoin(dirpath, fname)
+                if output is None:
+                    yield fpath, None
+                else:
+                    yield fpath, pjoin(
+                        output,
+                        os.path.basename(os.path.normpath(inpath)),
+                        os.path.relpath(fpath, inpath))
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        prog='python3 -m sphotiklib.batch',
+        description="Transliterate files or directories of roman text.")
+    argparser.add_argument(
+        'inputs', metavar='INPUT', nargs='+',
+        help="Input file or directory.")
+    argparser.add_argument(
+        '-o', '--output', default=None,
+        help="Output file or directory (default: standard output).")
+    argparser.add_argument(
+        '-r', '--rule', dest='rulename', default=DEFAULT_RULENAME,
+        help="Name of a builtin rule set (default: %(default)s).")
+    argparser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help="Number of worker processes (default: number of cores).")
+    argparser.add_argument(
+        '--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+        help="Approximate shard size in bytes (default: %(default)s).")
+    argparser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+        help=(
+            "Number of words cached by each worker, 0 to disable"
+            " (default: %(default)s)."))
+    args = argparser.parse_args(argv)
+
+    with BatchTransliterator(
+            args.rulename, args.jobs, args.shard_size,
+            args.cache_size) as batch:
+        for inpath, outpath in list_inputs(args.inputs, args.output):
+            batch.transliterate_path(inpath, outpath)
+
+        batch.stats.report()
+
+    return 0
+
+
+class _TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = [
+            "ami banglay gan gai.\n",
+            "oi ;) dekho\n",
+            "kichu manuSh sbadhInvabe soman morzada\n",
+            "\n",
+            "ebong odhikar niye jonmogrohon kore.",
+        ]
+
+    def test_read_shards(self):
+        text = "".join(self.lines).encode()
+        with tempfile.TemporaryFile() as f:
+            f.write(text)
+            f.seek(0)
+            # Longer than any of the lines.
+            shards = list(read_shards(f, shard_size=48))
+
+        self.assertEqual(b"".join(shards), text)
+        self.assertGreater(len(shards), 1)
+        for shard in shards[:-1]:
+            self.assertTrue(shard.endswith(b"\n"))
+
+    def test_read_shards_of_long_line(self):
+        text = " ".join(self.lines).replace("\n", "").encode() * 4
+        with tempfile.TemporaryFile() as f:
+            f.write(text)
+            f.seek(0)
+            shards = list(read_shards(f, shard_size=16))
+
+        self.assertEqual(b"".join(shards), text)
+        self.assertGreater(len(shards), 4)
+        for shard in shards[:-1]:
+            self.assertLess(len(shard), 64)
+            self.assertIn(shard[-1:], (b" ", b"\t"))
+
+    def test_identical_to_parser(self):
+        self._check_identical_to_parser("".join(self.lines * 20))
+
+    def test_long_line_identical_to_parser(self):
+        self._check_identical_to_parser(
+            "\t".join(self.lines * 20).replace("\n", " "))
+
+    def _check_identical_to_parser(self, text):
+        p = Parser(Rule(DEFAULT_RULENAME))
+        p.insert(text)
+
+        with tempfile.TemporaryDirectory() as d:
+            inpath = pjoin(d, 'in', 'text.txt')
+            os.makedirs(os.path.dirname(inpath))
+            with open(inpath, 'w', encoding=ENCODING) as f:
+                f.write(text)
+
+            with BatchTransliterator(jobs=2, shard_size=64) as batch:
+                for i, o in list_inputs([pjoin(d, 'in')], pjoin(d, 'out')):
+                    batch.transliterate_path(i, o)
+
+            with open(pjoin(d, 'out', 'in', 'text.txt'), 'rb') as f:
+                self.assertEqual(f.read().decode(ENCODING), p.text)
+
+            self.assertEqual(batch.stats.files, 1)
+            self.assertEqual(batch.stats.words, len(text.split()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
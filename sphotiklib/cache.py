@@ -0,0 +1,87 @@
+"""
+Memoization of transliteration results.
+
+Real text repeats the same words over and over. A 'TransliterationCache'
+remembers the results of recent transliterations, so that repeated words
+skip the transliterator, vowelshaper and conjunctor. Keys contain the
+digest of the rule, hence results of a changed rule are never served.
+
+A cache is opt-in; pass one to 'transliterate_stream'.
+"""
+import unittest
+import collections
+
+DEFAULT_CACHE_SIZE = 1 << 14
+
+
+class LRUCache:
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __str__(self):
+        return "{} items, {} hits, {} misses ({:.1%} hit rate)".format(
+            len(self), self.hits, self.misses, self.hit_rate)
+
+
+class TransliterationCache(LRUCache):
+
+    def key(self, rule, raw, context):
+        """ Key of roman text 'raw', transliterated with 'rule' after the
+        beads of 'context'.
+        """
+        return (rule.digest, raw, tuple(bead.v for bead in context))
+
+
+class _TestCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        # 'b' is the least recently used item now.
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        self.assertEqual(cache.hit_rate, 0.75)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
@@ -82,16 +82,36 @@ def _make_conjunction_parser(multi_start='(', multi_end=')'):
 
         return exprlist
 
-    return (lambda x: express(parse(x)))
+    def pattern(conj):
+        """
+        Turn the nested list into a tuple of choices, without expanding it.
+        Every choice is a sorted tuple of characters. Empty multiple choice
+        entries are dropped, just like they are by 'express'.
+        """
+        return tuple(
+            tuple(sorted(set(c))) if isinstance(c, (list, tuple)) else (c,)
+            for c in conj
+            if not isinstance(c, (list, tuple)) or len(c))
+
+    return (lambda x: express(parse(x))), (lambda x: pattern(parse(x)))
 
 
-parse_conjunction_line = _make_conjunction_parser()
+parse_conjunction_line, parse_conjunction_pattern = (
+    _make_conjunction_parser())
 
 
 class TestConjunctionParser(unittest.TestCase):
 
     def _test_conjunction_parsing(self, inp, exp_outp):
-        outp = set(chain(*map(parse, inp.splitlines())))
+        outp = set(chain(*map(parse_conjunction_line, inp.splitlines())))
+        self.assertEqual(outp, set(exp_outp))
+
+        # Patterns stand for the very same conjunctions.
+        outp = set(
+            "".join(p)
+            for line in inp.splitlines()
+            for p in product(*parse_conjunction_pattern(line))
+            if p)
         self.assertEqual(outp, set(exp_outp))
 
     def test_1(self):
@@ -101,3 +121,9 @@ class TestConjunctionParser(unittest.TestCase):
             'কষ', 'কষব', 'কষণ', 'কষর', 'কষয', 'খর', 'গগ', 'ঘ', 'ঙ',
         ]
         self._test_conjunction_parsing(inp, exp_outp)
+
+    def test_pattern(self):
+        self.assertEqual(
+            parse_conjunction_pattern("ক(তট)র()"),
+            (('ক',), ('ট', 'ত'), ('র',)))
+        self.assertEqual(parse_conjunction_pattern("()()"), ())
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, print_function
 
-from .utils import DstBead, Cord
+from .utils import DstBead, CONJOINED
 
 
 class Conjunctor:
@@ -10,39 +10,59 @@ class Conjunctor:
         self.conjtree = conjtree
         self.longest_conj_size = conjtree.longest_subpath_size
 
-    def _make_a_conjunction(self, unjoined_cord):
-        candidate = unjoined_cord[:self.longest_conj_size]
-        while len(candidate):
-            try:
-                # See if current candidate yields a conjunction.
-                path = [c.v for c in candidate]
-                value = self.conjtree.get_value_for_path(path)
-                if value is None:
-                    candidate = candidate[:-1]
-                    continue
+    def _cluster(self, cord, start, end):
+        # A conjunction is made of beads whose values appear in the tree.
+        # Any other bead separates clusters of beads, which are conjoined
+        # independent of each other. Expand the range to cover whole
+        # clusters around it.
+        alphabet = self.conjtree.alphabet
+        while start > 0 and cord[start - 1].v in alphabet:
+            start -= 1
+        while end < len(cord) and cord[end].v in alphabet:
+            end += 1
+        return start, end
 
-                for bead in candidate[1:]:
-                    bead.add_flags('CONJOINED')
+    def _conjoin(self, unjoined_cord, start, end, final=True):
+        beads = list(unjoined_cord[start:end])
+        path = [bead.v for bead in beads]
 
-                return (candidate, unjoined_cord[len(candidate):])
+        pos = 0
+        while pos < len(path):
+            # Unless the range is final, a conjunction near it's end may
+            # yet grow with beads to come.
+            if not final and pos + self.longest_conj_size > len(path):
+                break
 
-            except KeyError:
-                candidate = candidate[:-1]
+            # Find the longest conjunction starting at current bead.
+            size, value = self.conjtree.longest_match(path, pos)
+            if value is None:
+                beads[pos].remove_flags(CONJOINED)
+                pos += 1
                 continue
-        else:
-            unjoinable = unjoined_cord[:1]
-            for bead in unjoinable:
-                bead.remove_flags('CONJOINED')
 
-            return (unjoinable, unjoined_cord[1:])
+            for bead in beads[pos + 1:pos + size]:
+                bead.add_flags(CONJOINED)
 
-    def _conjoin(self, unjoined_cord):
-        conjoined = Cord()
-        while len(unjoined_cord):
-            newjoined, unjoined_cord = self._make_a_conjunction(unjoined_cord)
-            conjoined += newjoined
+            pos += size
 
-        return conjoined
+        return start + pos
 
-    def __call__(self, unjoined_cord):
-        return self._conjoin(unjoined_cord)
+    def __call__(self, unjoined_cord, start=0, end=None):
+        """ Conjoin the beads in range [start, end) of the cord, along
+        with any neighbouring bead that may form a conjunction with them.
+        """
+        if end is None:
+            end = len(unjoined_cord)
+        self._conjoin(unjoined_cord, *self._cluster(unjoined_cord, start, end))
+        return unjoined_cord
+
+    def conjoin_prefix(self, unjoined_cord, start=0, final=False):
+        """ Conjoin the beads from 'start' to the end of the cord, where
+        'start' must be the start of a cluster or of a conjunction.
+
+        Unless 'final' is set, the trailing beads that may form a different
+        conjunction with beads appended later are left alone. Returns the
+        position upto which the beads are conjoined.
+        """
+        return self._conjoin(
+            unjoined_cord, start, len(unjoined_cord), final=final)
@@ -1,5 +1,22 @@
+import unittest
+
+from .tree import FlatTree
 from .utils import SrcBead, DstBead, Cord
 
+# Special context targets.
+START_TARGET = '[START]'
+VOWEL_TARGET = '[VOWEL]'
+CONSONANT_TARGET = '[CONSONANT]'
+
+# Character classes, as bits of the class table.
+VOWEL_CLASS = 1 << 0
+CONSONANT_CLASS = 1 << 1
+
+CLASS_TARGETS = {
+    VOWEL_TARGET: VOWEL_CLASS,
+    CONSONANT_TARGET: CONSONANT_CLASS,
+}
+
 
 class ContextualModifier:
 
@@ -7,55 +24,108 @@ class ContextualModifier:
         self._vowels = vowels
         self._consonants = consonants
         self._contextual_rules = contextual_rules
+        self.longest_target_size = max(
+            [len(raw_target) for _, raw_target, _ in contextual_rules],
+            default=0)
+
+        # Number of preceding beads the rules may look at.
+        self.context_size = max(
+            [len(targets) for targets, _, _ in contextual_rules],
+            default=0)
 
-    def _match(self, subject, target):
-        if subject == target:
-            return True
-
-        elif target == '[CONSONANT]':
-            if subject in self._consonants:
-                return True
-
-        elif target == '[VOWEL]':
-            if subject in self._vowels:
-                return True
-
-        else:
-            return False
-
-    def __call__(self, context, raw):
-        # The format of contextuals is: (tuple, str, tuple)
-        for context_targets, raw_target, result in self._contextual_rules:
-            # Match raw target.
-            if not raw.startswith(raw_target):
-                continue
-
-            # Match context targets. Rough workflow is -
-            #   Start iterating targets(context) from right side.
-            #   Choose equivalent subject from the actual context
-            #   string. If there is none, an special subject '[START]'
-            #   is produced. Match the subject and target. If any match
-            #   fails, we discard the rule.
-            try:
-                failed = False
-                for i, t in enumerate(reversed(context_targets)):
-                    if i == len(context):
-                        s = '[START]'
-                    else:
-                        s = context[-(i + 1)].v
-
-                    if not self._match(s, t):
-                        failed = True
-                        break
-                if failed:
+        # Classes of every vowel and consonant, as a bitmask.
+        self._classes = {}
+        for v in vowels:
+            self._classes[v] = self._classes.get(v, 0) | VOWEL_CLASS
+        for c in consonants:
+            self._classes[c] = self._classes.get(c, 0) | CONSONANT_CLASS
+
+        # Rules are indexed by their raw target, so that only the rules
+        # whose raw target is found at the current position are looked
+        # at. The position of a rule in the file is kept, as the first
+        # matching rule wins.
+        index = {}
+        for order, (context_targets, raw_target, result) in enumerate(
+                contextual_rules):
+            index.setdefault(raw_target, []).append(
+                (order, self._compile_targets(context_targets), result))
+        self._index = FlatTree(index.items())
+
+    def _compile_targets(self, context_targets):
+        # Targets are matched from the right side, i.e. from the bead
+        # right before the raw target.
+        return tuple(
+            (i, t, CLASS_TARGETS.get(t, 0))
+            for i, t in enumerate(reversed(context_targets)))
+
+    def _context_matches(self, checks, context):
+        n = len(context)
+        for i, target, mask in checks:
+            # A target right before the start of context only matches
+            # the start of text. Anything further is a mismatch.
+            if i >= n:
+                if i == n and target == START_TARGET:
                     continue
+                return False
+
+            subject = context[n - 1 - i].v
+            if subject != target and not (
+                    self._classes.get(subject, 0) & mask):
+                return False
+
+        return True
+
+    def __call__(self, context, raw, pos=0):
+        """ Apply the first matching contextual rule to 'raw[pos:]'.
+
+        Returns the converted Cord and the position in 'raw' upto which
+        the text was converted.
+        """
+        # The rules of every raw target found at 'pos' are candidates.
+        # Among those, the one found first in the file wins.
+        match = None
+        for size, rules in self._index.prefix_matches(raw, pos):
+            for order, checks, result in rules:
+                if match is not None and order > match[0]:
+                    break
+
+                if self._context_matches(checks, context):
+                    match = (order, raw[pos:pos + size], result)
+                    break
+
+        if match is None:
+            return Cord(), pos
+
+        # We have a match!
+        _, raw_target, result = match
+        src_bead = SrcBead(raw_target, contextual=True)
+        dst_beads = [DstBead(c, src_bead) for c in result]
+        return Cord(dst_beads), pos + len(raw_target)
+
+
+class _TestContextualModifier(unittest.TestCase):
 
-            except IndexError:
-                continue
+    def setUp(self):
+        self.rules = [
+            (('[START]',), 'y', ('Y0',)),
+            (('[VOWEL]',), 'ya', ('Y1',)),
+            (('[VOWEL]',), 'y', ('Y2',)),
+            (('x', '[CONSONANT]'), 'y', ('Y3',)),
+            (('[CONSONANT]',), 'y', ('Y4',)),
+        ]
+        self.cm = ContextualModifier(self.rules, {'a', 'i'}, {'k', 'x'})
 
-            # We have a match!
-            src_bead = SrcBead(raw_target)
-            dst_beads = [DstBead(c, src_bead) for c in result]
-            return Cord(dst_beads), raw[len(raw_target):]
+    def _convert(self, context, raw, pos=0):
+        context = Cord([DstBead(c, SrcBead(c)) for c in context])
+        conv, newpos = self.cm(context, raw, pos)
+        return [b.v for b in conv], newpos
 
-        return Cord(), raw
+    def test_first_matching_rule_wins(self):
+        self.assertEqual(self._convert('', 'ya'), (['Y0'], 1))
+        self.assertEqual(self._convert('a', 'ya'), (['Y1'], 2))
+        self.assertEqual(self._convert('a', 'yo'), (['Y2'], 1))
+        self.assertEqual(self._convert('xk', 'y'), (['Y3'], 1))
+        self.assertEqual(self._convert('k', 'y'), (['Y4'], 1))
+        self.assertEqual(self._convert('kk', 'y'), (['Y4'], 1))
+        self.assertEqual(self._convert('o', 'ay', 1), ([], 1))
+        self.assertEqual(self._convert('', 'b'), ([], 0))
@@ -1,8 +1,10 @@
 
+import random
 import unittest
 
 from .ruleparser import Rule
-from .utils import SrcBead, DstBead, Cord
+from .utils import (
+    SrcBead, DstBead, Cord, DIACRITIC, CONJOINED, FORCED_DIACRITIC)
 
 
 class Parser:
@@ -12,7 +14,9 @@ class Parser:
         self.transliterator = rule.transliterator
         self.vowelshaper = rule.vowelshaper
         self.conjunctor = rule.conjunctor
-        self.cord = self._adjust_flags(cord)
+
+        # The cord is edited in place, hence a copy is made.
+        self.cord = self._adjust_flags(Cord(cord))
         self.cursor = len(self.cord)
 
         # Insertion sequence is a necessary ugliness. It is an
@@ -26,73 +30,89 @@ class Parser:
         # transliterations.
         self.insseq = insertion_sequence
 
-    def _adjust_flags(self, cord):
-        return self.conjunctor(self.vowelshaper(cord))
+    def _adjust_flags(self, cord, start=0, end=None):
+        # Only the beads in range [start, end) are assumed to be changed;
+        # vowelshaper and conjunctor adjust flags of the neighbouring beads
+        # as required. Flags of the rest of the cord are left untouched.
+        cord = self.vowelshaper(cord, start, end)
+        return self.conjunctor(cord, start, end)
 
     def _insert(self, text):
+        # Only transliterations starting within the last (lps - 1)
+        # roman chars can be affected by newly inserted text, since
+        # no transliteration is longer than lps chars.
         lps = self.transliterator.longest_path_size
 
         # If the cursor is positioned at the middle of the cord,
-        # reverting texts right to the cursor makes no sense.
-        revertible, preserved_right = (
-            self.cord[:self.cursor], self.cord[self.cursor:])
+        # reverting texts right to the cursor makes no sense. The
+        # beads in range [start, cursor) are the ones to revert.
+        start = self.cursor
 
         reverted = ""
         backstep = 1
-        # We will keep reverting characters from back until we have
-        # roman chars enough to cover the longest possible transliteration
-        # path. This is like an worst case scenerio management.
-        while len(reverted) < lps:
-            try:
-                # Collect the rightmost bead.
-                bead = revertible[-1]
-
-                # Check if the collected bead is relevant (in sequence).
-                # Otherwise, reverting them is pointless.
-                if self.insseq - bead.insseq != backstep:
-                    break
-
-                # Collect the reverted source text.
-                reverted = bead.source.v + reverted
-
-                # Adjust the revertible cord.
-                n_reverted_cords = len(bead.source.destinations)
-                revertible = revertible[
-                    :max(0, len(revertible) - n_reverted_cords)]
-
-                backstep += n_reverted_cords
-
-            except IndexError:
+        while start > 0:
+            # Collect the rightmost bead.
+            bead = self.cord[start - 1]
+
+            # Check if the collected bead is relevant (in sequence).
+            # Otherwise, reverting them is pointless.
+            if self.insseq - bead.insseq != backstep:
                 break
 
-        # Whatever is 'left' in the revertible stays unchanged.
-        preserved_left = revertible
+            # We will keep reverting characters from back until we
+            # have covered the window. A contextual transliteration
+            # right before the window is reverted too. Contextual
+            # rules are never tried right after a contextual
+            # transliteration, so restarting right after one may
+            # yield a different result.
+            if (len(reverted) >= lps - 1 and
+                    not bead.source.contextual):
+                break
+
+            # Collect the reverted source text.
+            reverted = bead.source.v + reverted
+
+            # Adjust the revertible range. Beads of the same source
+            # are adjacent to each other.
+            n_reverted_cords = 0
+            while start > 0 and self.cord[start - 1].source is bead.source:
+                start -= 1
+                n_reverted_cords += 1
+
+            backstep += n_reverted_cords
+
+        # Whatever is 'left' of the reverted range stays unchanged.
+        # Transliterator only looks at the last few beads of it.
+        context = self.cord[
+            max(0, start - self.transliterator.context_size):start]
 
         # Perform the transliteration.
-        reforged = self.transliterator(
-            preserved_left, reverted + text)
+        reforged = self.transliterator(context, reverted + text)
 
         # Attach insertion sequence to the reforged beads.
         for bead in reforged:
             bead.insseq = self.insseq
             self.insseq += 1
 
-        self.cord = preserved_left + reforged + preserved_right
-        self.cursor = len(preserved_left) + len(reforged)
+        self.cord.replace(start, self.cursor, reforged)
+        self.cursor = start + len(reforged)
+
+        # Return the range of the changed beads.
+        return start, self.cursor
 
     def insert(self, text):
-        self._insert(text)
-        self.cord = self._adjust_flags(self.cord)
+        start, end = self._insert(text)
+        self.cord = self._adjust_flags(self.cord, start, end)
 
     def delete(self, steps):
         from_ = self.cursor
         to = max(0, self.cursor + steps)
         start, end = min(from_, to), max(from_, to)
-        self.cord = self.cord[:start] + self.cord[end:]
+        self.cord.delete(start, end)
         if steps < 0:
             self.cursor = max(0, self.cursor + steps)
 
-        self.cord = self._adjust_flags(self.cord)
+        self.cord = self._adjust_flags(self.cord, start, start)
 
     def clear(self):
         self.cord = Cord()
@@ -109,14 +129,13 @@ class Parser:
         output = ""
         for bead in cord:
             # Change vowels to diacritic form when flagged.
-            if (('DIACRITIC' in bead.flags) or
-                    ('FORCED_DIACRITIC' in bead.flags)):
+            if bead.flags & (DIACRITIC | FORCED_DIACRITIC):
                 output += self._to_diacritic(bead).v
                 continue
 
             # Add a conjunction glue in front of every
             # conjoined character.
-            if 'CONJOINED' in bead.flags:
+            if bead.flags & CONJOINED:
                 output += self.rule.conjglue + bead.v
                 continue
 
@@ -136,6 +155,29 @@ class Parser:
             return bead
 
 
+class _RecordingTransliterator:
+    """ A transliterator wrapper that records the size of roman texts
+    it has been asked to transliterate.
+    """
+
+    def __init__(self, transliterator):
+        self._transliterator = transliterator
+        self.longest_path_size = transliterator.longest_path_size
+        self.context_size = transliterator.context_size
+        self.sizes = []
+
+    def __call__(self, context, raw):
+        self.sizes.append(len(raw))
+        return self._transliterator(context, raw)
+
+
+class _FullPassParser(Parser):
+    """ A parser that adjusts the flags of the whole cord on every edit. """
+
+    def _adjust_flags(self, cord, start=0, end=None):
+        return super()._adjust_flags(cord)
+
+
 class _TestParser(unittest.TestCase):
 
     def setUp(self):
@@ -218,3 +260,54 @@ class _TestParser(unittest.TestCase):
         print(
             "Test of insertion at middle: '{}' -> '{}"
             .format(org_text, parser.text))
+
+    def _type_onebyone(self, text):
+        parser = Parser(self.rule)
+        parser.transliterator = _RecordingTransliterator(
+            parser.transliterator)
+        for c in text:
+            parser.insert(c)
+        return parser
+
+    def test_bounded_retransliteration(self):
+        word = 'kingkortobZbimURh'
+        short = self._type_onebyone(word)
+        long = self._type_onebyone(word * 20)
+
+        # Per-keystroke work must not grow with the size of the word.
+        lps = self.rule.transliterator.longest_path_size
+        self.assertEqual(
+            max(short.transliterator.sizes),
+            max(long.transliterator.sizes))
+        self.assertLessEqual(max(long.transliterator.sizes), 2 * lps)
+
+        bulk = Parser(self.rule)
+        bulk.insert(word * 20)
+        self.assertEqual(long.text, bulk.text)
+
+    def test_incremental_flag_adjustment(self):
+        rnd = random.Random(0)
+        alphabet = 'kgcjTDtdnNpbmrlsSh`aAiIuUeEoO ,yw'
+
+        for i in range(100):
+            parsers = (Parser(self.rule), _FullPassParser(self.rule))
+            for step in range(40):
+                r = rnd.random()
+                if r < 0.6:
+                    text = ''.join(
+                        rnd.choice(alphabet) for _ in range(rnd.randint(1, 3)))
+                    for parser in parsers:
+                        parser.insert(text)
+                elif r < 0.8:
+                    steps = rnd.choice((-2, -1, 1, 2))
+                    for parser in parsers:
+                        parser.delete(steps)
+                else:
+                    cursor = rnd.randint(0, len(parsers[0].cord))
+                    for parser in parsers:
+                        parser.cursor = cursor
+
+                incremental, full = parsers
+                self.assertEqual(
+                    [(b.v, b.flags) for b in incremental.cord],
+                    [(b.v, b.flags) for b in full.cord])
@@ -4,13 +4,14 @@ import itertools
 from pkgutil import get_data
 from os.path import join as pjoin
 
-from .tree import TreeNode
+from . import snapshot
+from .tree import FlatTree, ChoiceTree
 from .conjunctor import Conjunctor
 from .vowelshaper import Vowelshaper
-from .utils import SrcBead, DstBead, Cord
+from .utils import SrcBead, DstBead, Cord, flags_from_names
 from .transliterator import Transliterator
 from .contextual_modifier import ContextualModifier
-from .conjunction_parser import parse_conjunction_line
+from .conjunction_parser import parse_conjunction_pattern
 
 
 class Rule:
@@ -26,68 +27,115 @@ class Rule:
     CONJUNCTION_GLUE_FILE = 'conjunction_glue.txt'
     CONTEXTUAL_RULES_FILE = 'contextual_rules.txt'
 
-    def __init__(self, rulename):
+    RULE_FILES = (
+        MODIFIER_FILE,
+        TRANSLITERATIONS_FILE,
+        VOWELMAP_FILE,
+        CONSONANTS_FILE,
+        VOWELHOSTS_FILE,
+        PUNCTUATIONS_FILE,
+        CONJUNCTIONS_FILE,
+        CONJUNCTION_GLUE_FILE,
+        CONTEXTUAL_RULES_FILE,
+    )
+
+    def __init__(self, rulename, use_snapshot=True):
+        self.name = rulename
+
+        # The digest identifies the content of the rule set. Parsing the
+        # rule files is skipped altogether if a snapshot with matching
+        # digest is found.
+        sources = self.read_sources(rulename)
+        self.digest = snapshot.compute_digest(sources)
+
+        data = None
+        if use_snapshot:
+            data = snapshot.load_snapshot(rulename, self.digest)
+
+        if data is None:
+            data = self.compile_sources(sources)
+            if use_snapshot:
+                try:
+                    snapshot.save_snapshot(rulename, self.digest, data)
+                except OSError as e:
+                    logging.warning(
+                        "Failed to save snapshot of rule '{}': {}"
+                        .format(rulename, e))
+
+        self._build(data)
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self._log_rules()
+
+    @classmethod
+    def read_sources(cls, rulename):
         ruledir = pjoin('rules', rulename)
-
-        self.transtree = TreeNode(key='root', parent=None)
-
-        self.modifier = None
-
-        self.vowelmap = {}
-        self.vowels = set()
-        self.vowels_distinct = set()
-        self.vowels_diacritic = set()
-
-        self.conjtree = TreeNode(key='root', parent=None)
-        self.conjglue = None
-
-        self.consonants = set()
-        self.vowelhosts = set()
-        self.punctuations = set()
-
-        self.contextual_rules = []
-
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.MODIFIER_FILE)).decode()
-        self.modifier = self._parse_char(fdata)
-
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.TRANSLITERATIONS_FILE)).decode()
-        for k, v in self._parse_transliterations(fdata, self.modifier).items():
-            self.transtree.set_value_for_path(list(k), v)
-
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.VOWELMAP_FILE)).decode()
-        self.vowelmap = self._parse_vowelmap(fdata)
+        return {
+            fname: get_data(__package__, pjoin(ruledir, fname))
+            for fname in cls.RULE_FILES}
+
+    @classmethod
+    def compile_sources(cls, sources):
+        """Parse raw rule sources into plain python data.
+
+        The returned dictionary consists only of builtin types, so that it
+        can be stored in a snapshot.
+        """
+        def text(fname):
+            return sources[fname].decode()
+
+        data = {}
+        data['modifier'] = cls._parse_char(text(cls.MODIFIER_FILE))
+        data['transliterations'] = cls._parse_transliterations(
+            text(cls.TRANSLITERATIONS_FILE), data['modifier'])
+        data['vowelmap'] = cls._parse_vowelmap(text(cls.VOWELMAP_FILE))
+        data['consonants'] = cls._parse_chardump(
+            text(cls.CONSONANTS_FILE))
+        data['vowelhosts'] = cls._parse_chardump(
+            text(cls.VOWELHOSTS_FILE))
+        data['punctuations'] = cls._parse_chardump(
+            text(cls.PUNCTUATIONS_FILE))
+        data['conjunctions'] = cls._parse_conjunctions(
+            text(cls.CONJUNCTIONS_FILE))
+        data['conjglue'] = cls._parse_char(
+            text(cls.CONJUNCTION_GLUE_FILE))
+        data['contextual_rules'] = cls._parse_contextual_rules(
+            text(cls.CONTEXTUAL_RULES_FILE))
+
+        return data
+
+    def _build(self, data):
+        self.modifier = data['modifier']
+
+        transitems = []
+        for src, (dstfrags, flaglist) in data['transliterations'].items():
+            try:
+                flags = flags_from_names(flaglist)
+            except KeyError as e:
+                raise ValueError(
+                    "Unknown flag {} in transliteration of '{}'"
+                    .format(e, src))
+
+            srcbead = SrcBead(src)
+            dstcord = Cord([DstBead(v, srcbead, flags) for v in dstfrags])
+            transitems.append((src, dstcord))
+        self.transtree = FlatTree(transitems)
+
+        self.vowelmap = dict(data['vowelmap'])
         self.vowels_distinct = set(self.vowelmap.keys())
         self.vowels_diacritic = set(filter(
             lambda x: len(x), self.vowelmap.values()))
         self.vowels = self.vowels_distinct.union(self.vowels_diacritic)
 
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.CONSONANTS_FILE)).decode()
-        self.consonants = self._parse_chardump(fdata)
-
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.VOWELHOSTS_FILE)).decode()
-        self.vowelhosts = self._parse_chardump(fdata)
-
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.PUNCTUATIONS_FILE)).decode()
-        self.punctuations = self._parse_chardump(fdata)
-
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.CONJUNCTIONS_FILE)).decode()
-        for k in self._parse_conjunctions(fdata):
-            self.conjtree.set_value_for_path(list(k), True)
+        self.consonants = set(data['consonants'])
+        self.vowelhosts = set(data['vowelhosts'])
+        self.punctuations = set(data['punctuations'])
 
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.CONJUNCTION_GLUE_FILE)).decode()
-        self.conjglue = self._parse_char(fdata)
+        self.conjtree = ChoiceTree(
+            (pattern, True) for pattern in data['conjunctions'])
+        self.conjglue = data['conjglue']
 
-        fdata = get_data(
-            __package__, pjoin(ruledir, self.CONTEXTUAL_RULES_FILE)).decode()
-        self.contextual_rules = self._parse_contextual_rules(fdata)
+        self.contextual_rules = list(data['contextual_rules'])
 
         self.transliterator = Transliterator(
             self.transtree,
@@ -96,8 +144,9 @@ class Rule:
         self.vowelshaper = Vowelshaper(self.vowels, self.vowelhosts)
         self.conjunctor = Conjunctor(self.conjtree)
 
+    def _log_rules(self):
         logging.debug(
-            "Parsed rules from '{}':\n\t".format(ruledir) +
+            "Parsed rules from '{}':\n\t".format(self.name) +
             "\n\t".join(
                 map(
                     lambda x: "{}: {}".format(
@@ -127,34 +176,42 @@ class Rule:
 
     _ESCAPED_UNICHAR_REGEX = re.compile(r'\\u[0-9A-F]{4}', re.I)
 
-    def _unescape_unichar(self, text):
+    @classmethod
+    def _unescape_unichar(cls, text):
         def replace(matchobj):
             return chr(int(matchobj.group(0)[2:], 16))
-        return re.sub(self._ESCAPED_UNICHAR_REGEX, replace, text)
+        return re.sub(cls._ESCAPED_UNICHAR_REGEX, replace, text)
 
-    def _parse_char(self, text):
-        return self._unescape_unichar(''.join(filter(
+    @classmethod
+    def _parse_char(cls, text):
+        return cls._unescape_unichar(''.join(filter(
             lambda x: not x.startswith('#'),
             map(str.strip, text.splitlines())
         ))).strip()
 
-    def _parse_conjunctions(self, text):
-        conjs = set()
+    @classmethod
+    def _parse_conjunctions(cls, text):
+        # Multiple choices are kept as they are; a pattern stands for
+        # every conjunction made by picking one of each choice.
+        conjs = []
         for line in text.splitlines():
             line = line.strip()
 
             if not line or line.startswith('#'):
                 continue
 
-            conjs.update(parse_conjunction_line(line))
+            pattern = parse_conjunction_pattern(line)
+            if pattern and pattern not in conjs:
+                conjs.append(pattern)
 
         return conjs
 
-    def _parse_transliterations(self, text, modifier):
+    @classmethod
+    def _parse_transliterations(cls, text, modifier):
         transmap = {}
 
         # Replace any modifier mark with the modifier char.
-        text = text.replace(self.MODIFIER_MARK, modifier)
+        text = text.replace(cls.MODIFIER_MARK, modifier)
 
         for line in text.splitlines():
             line = line.strip()
@@ -165,25 +222,23 @@ class Rule:
 
             parts = line.split('#', maxsplit=2)
             # Unescape literal hash sign.
-            parts = [x.replace(self.HASH_MARK, '#') for x in parts]
+            parts = [x.replace(cls.HASH_MARK, '#') for x in parts]
             src = parts[0]
             dst = parts[1] if len(parts) > 1 else ''
             flags = parts[2] if len(parts) > 2 else ''
 
-            srcfrags = list(map(self._unescape_unichar, src.split()))
-            dstfrags = list(map(self._unescape_unichar, dst.split()))
+            srcfrags = list(map(cls._unescape_unichar, src.split()))
+            dstfrags = list(map(cls._unescape_unichar, dst.split()))
             flaglist = list(filter(
                 lambda x: x, map(str.strip, flags.split('|'))))
 
             for sf in srcfrags:
-                srcbead = SrcBead(sf)
-                dstcord = Cord([
-                    DstBead(v, srcbead, flaglist) for v in dstfrags])
-                transmap[sf] = dstcord
+                transmap[sf] = (tuple(dstfrags), tuple(flaglist))
 
         return transmap
 
-    def _parse_vowelmap(self, text):
+    @classmethod
+    def _parse_vowelmap(cls, text):
         vowelmap = {}
 
         for line in text.splitlines():
@@ -197,14 +252,15 @@ class Rule:
             except ValueError:
                 src, dst = line, ''
 
-            src = self._unescape_unichar(src)
-            dst = self._unescape_unichar(dst)
+            src = cls._unescape_unichar(src)
+            dst = cls._unescape_unichar(dst)
 
             vowelmap[src] = dst
 
         return vowelmap
 
-    def _parse_chardump(self, text):
+    @classmethod
+    def _parse_chardump(cls, text):
         chars = set()
 
         for line in text.splitlines():
@@ -213,11 +269,12 @@ class Rule:
             if not line or line.startswith('#'):
                 continue
 
-            chars.update(map(self._unescape_unichar, line.split()))
+            chars.update(map(cls._unescape_unichar, line.split()))
 
         return chars
 
-    def _parse_contextual_rules(self, text):
+    @classmethod
+    def _parse_contextual_rules(cls, text):
         rules = []
 
         for line in text.splitlines():
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Precompiled snapshots of rule sets.
+
+Parsing the text files of a rule set is done once; the parsed data is then
+stored as a binary snapshot, which is keyed by a hash of the content of the
+rule files. Subsequent instantiations of a 'Rule' load the snapshot instead
+of parsing the text files again. A changed rule file yields a different
+hash, hence stale snapshots are never used.
+
+Snapshots are searched for in the 'snapshots' directory of this package
+(built at installation time) and in the cache directory of the user. The
+latter is populated automatically whenever a rule set is parsed.
+
+Usage:
+    python3 -m sphotiklib.snapshot build [--dir DIR] [RULENAME ...]
+    python3 -m sphotiklib.snapshot check [--dir DIR] [RULENAME ...]
+"""
+import os
+import re
+import sys
+import pickle
+import hashlib
+import logging
+import argparse
+import tempfile
+import unittest
+from os.path import join as pjoin
+
+# Bump this whenever the structure of compiled rule data changes.
+SNAPSHOT_FORMAT = 2
+
+# Pickle protocol 4 is readable by every supported python version.
+SNAPSHOT_PICKLE_PROTOCOL = 4
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+DEFAULT_RULENAME = 'avro'
+
+PACKAGE_SNAPSHOT_DIR = pjoin(os.path.dirname(__file__), 'snapshots')
+
+
+def user_snapshot_dir():
+    cache_dir = (
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.expanduser(pjoin('~', '.cache')))
+    return pjoin(cache_dir, 'sphotik')
+
+
+def snapshot_dirs():
+    """Directories to search for snapshots, in order of preference."""
+    return [PACKAGE_SNAPSHOT_DIR, user_snapshot_dir()]
+
+
+def compute_digest(sources):
+    """Compute content hash of rule sources.
+
+    'sources' is a mapping of rule file names to their raw content (bytes).
+    """
+    h = hashlib.sha1()
+    h.update('format:{}\n'.format(SNAPSHOT_FORMAT).encode())
+    for fname in sorted(sources):
+        h.update('{}:{}\n'.format(fname, len(sources[fname])).encode())
+        h.update(sources[fname])
+    return h.hexdigest()
+
+
+def snapshot_path(directory, rulename, digest):
+    return pjoin(
+        directory, '{}-{}{}'.format(rulename, digest, SNAPSHOT_SUFFIX))
+
+
+def load_snapshot(rulename, digest, dirs=None):
+    """Load compiled rule data from the first matching snapshot.
+
+    Returns None if no usable snapshot is found.
+    """
+    for directory in (snapshot_dirs() if dirs is None else dirs):
+        path = snapshot_path(directory, rulename, digest)
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logging.warning(
+                "Ignoring unreadable rule snapshot '{}': {}".format(path, e))
+            continue
+
+        try:
+            if (snapshot['format'] == SNAPSHOT_FORMAT and
+                    snapshot['rulename'] == rulename and
+                    snapshot['digest'] == digest):
+                logging.debug("Loaded rule snapshot '{}'.".format(path))
+                return snapshot['data']
+        except (TypeError, KeyError):
+            pass
+
+        logging.warning("Ignoring mismatched rule snapshot '{}'.".format(path))
+
+    return None
+
+
+def save_snapshot(rulename, digest, data, directory=None):
+    """Atomically write compiled rule data to a snapshot file.
+
+    Snapshots of older revisions of the same rule set are removed from the
+    directory. Returns the path of the written snapshot.
+    """
+    if directory is None:
+        directory = user_snapshot_dir()
+
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory, rulename, digest)
+
+    snapshot = {
+        'format': SNAPSHOT_FORMAT,
+        'rulename': rulename,
+        'digest': digest,
+        'data': data,
+    }
+
+    # Many engine instances may start at once; writing to a temporary file
+    # and renaming it makes sure nobody ever reads a half-written snapshot.
+    fd, tmppath = tempfile.mkstemp(
+        prefix='.{}-'.format(rulename), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(snapshot, f, SNAPSHOT_PICKLE_PROTOCOL)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+    # Remove snapshots of older revisions, but not those of other rule
+    # sets whose names merely start with this one.
+    pattern = re.compile(
+        re.escape(rulename) + r'-[0-9a-f]{40}' + re.escape(SNAPSHOT_SUFFIX))
+    for fname in os.listdir(directory):
+        fpath = pjoin(directory, fname)
+        if pattern.fullmatch(fname) and fpath != path:
+            try:
+                os.unlink(fpath)
+            except OSError:
+                pass
+
+    return path
+
+
+def build(rulenames, directory):
+    from .ruleparser import Rule
+
+    for rulename in rulenames:
+        sources = Rule.read_sources(rulename)
+        digest = compute_digest(sources)
+        data = Rule.compile_sources(sources)
+        path = save_snapshot(rulename, digest, data, directory)
+        print("Built '{}'".format(path))
+
+    return 0
+
+
+def check(rulenames, dirs):
+    from .ruleparser import Rule
+
+    status = 0
+    for rulename in rulenames:
+        sources = Rule.read_sources(rulename)
+        digest = compute_digest(sources)
+        data = Rule.compile_sources(sources)
+
+        usable = False
+        for directory in dirs:
+            path = snapshot_path(directory, rulename, digest)
+            if not os.path.isfile(path):
+                continue
+
+            if load_snapshot(rulename, digest, [directory]) != data:
+                print("[ STALE ] '{}'".format(path))
+                status = 1
+                continue
+
+            print("[ OK ] '{}'".format(path))
+            usable = True
+
+        if not usable:
+            print("[ MISSING ] No usable snapshot of '{}' in: {}".format(
+                rulename, ", ".join("'{}'".format(d) for d in dirs)))
+            status = 1
+
+    return status
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        prog='python3 -m sphotiklib.snapshot',
+        description="Build or check precompiled rule snapshots.")
+    argparser.add_argument(
+        'command', choices=('build', 'check'))
+    argparser.add_argument(
+        'rulenames', metavar='RULENAME', nargs='*',
+        default=[DEFAULT_RULENAME],
+        help="Name of a builtin rule set (default: %(default)s).")
+    argparser.add_argument(
+        '--dir', dest='directory', default=None,
+        help=(
+            "Snapshot directory. Defaults to the package snapshot directory"
+            " for 'build' and to all searched directories for 'check'."))
+    args = argparser.parse_args(argv)
+
+    if args.command == 'build':
+        return build(
+            args.rulenames,
+            args.directory if args.directory else PACKAGE_SNAPSHOT_DIR)
+    else:
+        return check(
+            args.rulenames,
+            [args.directory] if args.directory else snapshot_dirs())
+
+
+class _TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        from .ruleparser import Rule
+
+        self.sources = Rule.read_sources(DEFAULT_RULENAME)
+        self.digest = compute_digest(self.sources)
+        self.data = Rule.compile_sources(self.sources)
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as d:
+            save_snapshot(DEFAULT_RULENAME, self.digest, self.data, d)
+            self.assertEqual(
+                load_snapshot(DEFAULT_RULENAME, self.digest, [d]), self.data)
+
+    def test_changed_rules_miss_the_snapshot(self):
+        sources = dict(self.sources)
+        sources['consonants.txt'] += b'\n'
+        digest = compute_digest(sources)
+        self.assertNotEqual(digest, self.digest)
+
+        with tempfile.TemporaryDirectory() as d:
+            save_snapshot(DEFAULT_RULENAME, self.digest, self.data, d)
+            self.assertIsNone(load_snapshot(DEFAULT_RULENAME, digest, [d]))
+
+            # Snapshot of the older revision gets replaced, while those of
+            # other rule sets stay.
+            other = save_snapshot(
+                DEFAULT_RULENAME + '-phonetic', self.digest, self.data, d)
+            save_snapshot(DEFAULT_RULENAME, digest, self.data, d)
+            self.assertEqual(sorted(os.listdir(d)), sorted([
+                os.path.basename(other),
+                os.path.basename(
+                    snapshot_path(d, DEFAULT_RULENAME, digest))]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+Bulk transliteration of arbitrarily long texts.
+
+'Parser' keeps every bead of it's input around for editing, which is not
+viable for large documents. The functions here transliterate a stream of
+roman text chunk by chunk, keeping only a bounded window of beads that may
+still change. The output is identical to that of 'Parser.insert'.
+
+With a 'TransliterationCache', the text is transliterated word by word and
+the output of repeated words is served from the cache.
+"""
+import re
+import random
+import unittest
+
+from .parser import Parser
+from .ruleparser import Rule
+from .cache import TransliterationCache
+from .utils import Cord
+
+# Large chunks are transliterated piece by piece, so that the window
+# of beads stays small.
+STREAM_PIECE_SIZE = 1 << 16
+
+# No rule spans across white space, hence words and the runs of white
+# space in between are transliterated independent of each other.
+WHITESPACE = ' \t\n\r\f\v'
+_SPACE_RE = re.compile('[{}]+'.format(WHITESPACE))
+_WORD_RE = re.compile('[^{}]+'.format(WHITESPACE))
+_TOKEN_RE = re.compile('[{0}]+|[^{0}]+'.format(WHITESPACE))
+
+
+class StreamTransliterator:
+    piece_size = STREAM_PIECE_SIZE
+
+    def __init__(self, rule, context=Cord(), cache=None):
+        """ Transliterate text in chunks with 'rule'.
+
+        The beads of 'context', if any, are considered to precede the
+        text. They take part in contextual rules and vowel shaping, but
+        never in a conjunction.
+
+        Words are served from 'cache', if given.
+        """
+        self.rule = rule
+        self.transliterator = rule.transliterator
+        self.vowelshaper = rule.vowelshaper
+        self.conjunctor = rule.conjunctor
+        self._renderer = Parser(rule)
+
+        # Number of emitted beads to keep around as context.
+        self._keep = max(1, self.transliterator.context_size)
+
+        # Roman text, yet to be transliterated.
+        self._raw = ""
+
+        # Beads of the window. Beads in range [0, _emitted) are already
+        # rendered; the rest await their conjunctions.
+        self._cord = context[max(0, len(context) - self._keep):]
+        self._emitted = len(self._cord)
+
+        # A word may only be cached if white space never takes part in
+        # vowel shaping or a conjunction.
+        alphabet = self.conjunctor.conjtree.alphabet
+        vowels = self.vowelshaper.vowels
+        if any(c in alphabet or c in vowels for c in WHITESPACE):
+            cache = None
+        self.cache = cache
+
+        # The last word of the text seen so far, which may yet grow. A
+        # word too long to hold is 'spilled' to the uncached path; the
+        # attribute then tells whether it is a run of white space.
+        self._pending = ""
+        self._spilled = None
+
+    def _advance(self, final):
+        cord = self._cord
+
+        if final:
+            converted = self.transliterator(cord, self._raw)
+            self._raw = ""
+        else:
+            converted, size = self.transliterator.transliterate_prefix(
+                cord, self._raw)
+            self._raw = self._raw[size:]
+
+        # Vowels only depend on the bead before them, hence the new
+        # beads are shaped for good.
+        shaped = len(cord)
+        cord.extend(converted)
+        self.vowelshaper(cord, shaped, len(cord))
+
+        # Beads before '_emitted' are never in the middle of a
+        # conjunction, as they are emitted on conjunction boundaries.
+        start = self._emitted
+        end = self.conjunctor.conjoin_prefix(cord, start, final=final)
+        output = self._renderer.render_text(cord[start:end])
+
+        # Forget the beads that no longer matter.
+        cut = max(0, min(end, len(cord) - self._keep))
+        cord.delete(0, cut)
+        self._emitted = end - cut
+
+        return output
+
+    def _feed_raw(self, text):
+        output = ""
+        for i in range(0, len(text), self.piece_size):
+            self._raw += text[i:i + self.piece_size]
+            output += self._advance(final=False)
+        return output
+
+    def _transliterate_word(self, word):
+        key = self.cache.key(self.rule, word, self._cord)
+        cached = self.cache.get(key)
+        if cached is None:
+            self._raw = word
+            output = self._advance(final=True)
+            self.cache.put(key, (output, tuple(self._cord)))
+            return output
+
+        # Beads of the cached window are shared, but never changed; they
+        # are only looked at as context of the words to follow.
+        output, window = cached
+        self._cord = Cord(window)
+        self._emitted = len(self._cord)
+        return output
+
+    def _feed_cached(self, text):
+        output = ""
+        if self._spilled is not None:
+            # The rest of a spilled word follows it's start.
+            match = (_SPACE_RE if self._spilled else _WORD_RE).match(text)
+            size = match.end() if match else 0
+            output += self._feed_raw(text[:size])
+            if size == len(text):
+                return output
+
+            output += self._advance(final=True)
+            self._spilled = None
+            text = text[size:]
+
+        words = _TOKEN_RE.findall(self._pending + text)
+        self._pending = words.pop() if words else ""
+        for word in words:
+            output += self._transliterate_word(word)
+
+        if len(self._pending) > self.piece_size:
+            self._spilled = self._pending[0] in WHITESPACE
+            output += self._feed_raw(self._pending)
+            self._pending = ""
+
+        return output
+
+    def feed(self, text):
+        """ Transliterate a chunk of text. Returns the part of the output
+        that is final; the rest is held back until more text arrives.
+        """
+        if self.cache is None:
+            return self._feed_raw(text)
+        return self._feed_cached(text)
+
+    def finish(self):
+        """ Mark the end of the text. Returns the rest of the output. """
+        if self._pending:
+            output = self._transliterate_word(self._pending)
+            self._pending = ""
+            return output
+        return self._advance(final=True)
+
+
+def transliterate_stream(rule, chunks, context=Cord(), cache=None):
+    """ Transliterate an iterable of roman text chunks with 'rule',
+    yielding bangla text chunk by chunk.
+
+    Concatenation of the output is identical to the text of a 'Parser'
+    after inserting the whole input at once.
+    """
+    stream = StreamTransliterator(rule, context, cache)
+    for chunk in chunks:
+        output = stream.feed(chunk)
+        if output:
+            yield output
+
+    output = stream.finish()
+    if output:
+        yield output
+
+
+class _TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = Rule('avro')
+        self.texts = [
+            "",
+            "k",
+            "ami banglay gan gai.",
+            "kichu manuSh sbadhInvabe soman morzada ebong odhikar niye"
+            " jonmogrohon kore. tader bibek ebong buddhi ache;",
+            "ksh``kkhmmmmmmmmmmsttttrrrrr o`i o` i ;) :-) \n\nrri aaaa",
+            "o" * 50 + "k" * 50 + " " + "ng" * 30,
+        ]
+
+    def _parsed(self, text):
+        p = Parser(self.rule)
+        p.insert(text)
+        return p.text
+
+    def _chunked(self, text, rand):
+        chunks = []
+        while text:
+            size = rand.randint(1, 12)
+            chunks.append(text[:size])
+            text = text[size:]
+        return chunks
+
+    def test_identical_to_parser(self):
+        rand = random.Random(0)
+        for text in self.texts:
+            expected = self._parsed(text)
+            for chunks in [[text], list(text), self._chunked(text, rand)]:
+                self.assertEqual(
+                    "".join(transliterate_stream(self.rule, chunks)),
+                    expected)
+
+    def test_cached_identical_to_parser(self):
+        rand = random.Random(0)
+        cache = TransliterationCache()
+        for text in self.texts * 2:
+            expected = self._parsed(text)
+            for chunks in [[text], list(text), self._chunked(text, rand)]:
+                self.assertEqual(
+                    "".join(transliterate_stream(self.rule, chunks,
+                                                 cache=cache)),
+                    expected)
+
+        self.assertGreater(cache.hit_rate, 0.5)
+
+    def test_cached_long_word(self):
+        cache = TransliterationCache()
+        stream = StreamTransliterator(self.rule, cache=cache)
+        stream.piece_size = 16
+
+        text = "kha " + "kko" * 20 + "  kha"
+        output = "".join(
+            stream.feed(chunk)
+            for chunk in self._chunked(text, random.Random(0)))
+        output += stream.finish()
+        self.assertEqual(output, self._parsed(text))
+
+        # Both of the short words and the spaces after them are cached,
+        # for different contexts. The long word is not.
+        self.assertEqual(len(cache), 4)
+
+    def test_window_is_bounded(self):
+        stream = StreamTransliterator(self.rule)
+        for i in range(200):
+            stream.feed("kichu manuSh sbadhInvabe ")
+            self.assertLess(len(stream._cord), 32)
+            self.assertLess(len(stream._raw), 32)
+
+    def test_context(self):
+        # A context of a line break is no different than a text
+        # starting after a line break.
+        text = "oi ;) onno"
+        context = Parser(self.rule)
+        context.insert("\n")
+        self.assertEqual(
+            "".join(transliterate_stream(self.rule, [text], context.cord)),
+            self._parsed("\n" + text)[1:])
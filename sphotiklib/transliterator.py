@@ -1,9 +1,8 @@
 import operator
 import unittest
-from copy import deepcopy
 from functools import reduce
 
-from .tree import TreeNode
+from .tree import FlatTree
 from .utils import SrcBead, DstBead, Cord
 
 
@@ -12,49 +11,77 @@ class Transliterator:
     def __init__(self, tree, contextual_modifier):
         self._tree = tree
         self._contextual_modifier = contextual_modifier
-        self.longest_path_size = tree.longest_subpath_size
-
-    def _transliterate_a_letter(self, raw):
-        candidate = raw[:self.longest_path_size]
-        while candidate:
-            try:
-                converted = self._tree.get_value_for_path(candidate)
-                if converted is None:
-                    candidate = candidate[:-1]
-                    continue
-
-                unconverted = raw[len(candidate):]
-                return (deepcopy(converted), unconverted)
-
-            except KeyError:
-                candidate = candidate[:-1]
-                continue
-        else:
+
+        # Size of the longest roman text a single transliteration
+        # may depend upon.
+        self.longest_path_size = max(
+            tree.longest_subpath_size,
+            getattr(contextual_modifier, 'longest_target_size', 0))
+
+        # Number of preceding beads a transliteration may depend upon.
+        self.context_size = getattr(contextual_modifier, 'context_size', 0)
+
+        # Size of the longest roman text a round of transliteration, i.e.
+        # a contextual rule followed by a letter, may depend upon.
+        self._round_size = (
+            tree.longest_subpath_size +
+            getattr(contextual_modifier, 'longest_target_size', 0))
+
+    def _transliterate_a_letter(self, raw, pos):
+        # A single walk through the tree finds the longest
+        # transliteration starting at 'pos'.
+        size, converted = self._tree.longest_match(raw, pos)
+        if converted is None:
             # Couldn't find a successful transliteration, which
-            # implies that the first character of the roman string
-            # is not part of any transliteration.
-            unconverted = raw[1:]
-            converted = Cord([
-                DstBead(raw[0], SrcBead(raw[0]))])
-            return (converted, unconverted)
-
-    def _transliterate(self, context, raw):
-        conv = Cord()
-        while True:
-            partconv, raw = self._contextual_modifier(context + conv, raw)
-            conv += partconv
-            if len(raw) == 0:
+            # implies that the character at 'pos' is not part
+            # of any transliteration.
+            srcbead = SrcBead(raw[pos])
+            return (Cord([DstBead(raw[pos], srcbead)]), pos + 1)
+
+        return (self._copy(converted), pos + size)
+
+    def _copy(self, converted):
+        # Every transliteration gets it's own beads, as the beads
+        # are flagged individually later on.
+        srcbead = SrcBead(converted[0].source.v) if len(converted) else None
+        return Cord([
+            DstBead(bead.v, srcbead, bead.flags) for bead in converted])
+
+    def _transliterate(self, context, raw, final=True):
+        # Only the last few beads of the context are relevant. Note
+        # that, a context shorter than 'context_size' is kept whole, so
+        # that contextual rules can still detect the start of text.
+        conv = context[max(0, len(context) - self.context_size):]
+        nctx = len(conv)
+
+        # The converted beads are appended to the relevant context
+        # in place, so that no new cord is built for every letter.
+        pos = 0
+        while final or pos + self._round_size <= len(raw):
+            partconv, pos = self._contextual_modifier(conv, raw, pos)
+            conv.extend(partconv)
+            if pos >= len(raw):
                 break
 
-            partconv, raw = self._transliterate_a_letter(raw)
-            conv += partconv
-            if len(raw) == 0:
+            partconv, pos = self._transliterate_a_letter(raw, pos)
+            conv.extend(partconv)
+            if pos >= len(raw):
                 break
 
-        return conv
+        return conv[nctx:], pos
 
     def __call__(self, context, raw):
-        return self._transliterate(context, raw)
+        return self._transliterate(context, raw)[0]
+
+    def transliterate_prefix(self, context, raw):
+        """ Transliterate the longest prefix of 'raw' whose conversion
+        can not change by appending more text to 'raw'.
+
+        Returns the converted cord and the size of the prefix. Calling
+        again with the rest of the text and the extended context
+        continues the transliteration seamlessly.
+        """
+        return self._transliterate(context, raw, final=False)
 
 
 class _TestTransliterator(unittest.TestCase):
@@ -64,14 +91,15 @@ class _TestTransliterator(unittest.TestCase):
             """ A convenience function to create a single-beaded Cord."""
             return Cord([DstBead(d, SrcBead(s))])
 
-        t = TreeNode("root")
-        t.set_value_for_path("a", cc("a", "1"))
-        t.set_value_for_path("aa", cc("aa", "2"))
-        t.set_value_for_path("b", cc("b", "3"))
-        t.set_value_for_path("abc", cc("abc", "4"))
+        t = FlatTree([
+            ("a", cc("a", "1")),
+            ("aa", cc("aa", "2")),
+            ("b", cc("b", "3")),
+            ("abc", cc("abc", "4")),
+        ])
 
-        def dummy_contextual_modifier(conv, raw):
-            return conv, raw
+        def dummy_contextual_modifier(conv, raw, pos):
+            return Cord(), pos
 
         self._trans = Transliterator(t, dummy_contextual_modifier)
 
@@ -81,3 +109,162 @@ class _TestTransliterator(unittest.TestCase):
         self.assertTrue(self._trans(Cord(), 'abcdefg').text, "4defg")
         self.assertTrue(self._trans(Cord(), 'aaaaaaa').text, "2221")
         self.assertTrue(self._trans(Cord(), 'abcab c').text, "413 c")
+
+
+# Transliterations made by the former algorithm, which retried lookups
+# with shrinking candidates, as of the baseline release. Every one is a
+# tuple of the roman text, the values of the resulting beads and their
+# sources, both joined by '/'.
+_BASELINE_TRANSLITERATIONS = (
+    ('amar sOnar bangla',
+     'আ/ম/আ/র/ /স/ও/ন/আ/র/ /ব/আ/ং/ল/আ',
+     'a/m/a/r/ /s/O/n/a/r/ /b/a/ng/l/a'),
+    ('kukkuT sondhZa kingkortobZbimURh',
+     'ক/উ/ক/ক/উ/ট/ /স/অ/ন/ধ/য/আ/ /ক/ই/ং/ক/অ/র/ত/অ/ব/য/ব/ই/ম/ঊ/ঢ়',
+     'k/u/k/k/u/T/ /s/o/n/dh/Z/a/ /k/i/ng/k/o/r/t/o/b/Z/b/i/m/U/Rh'),
+    (":-)>.... @}-;-'--- raanDom aa^ t``",
+     ":-)>..../ /@}-;-'---/ /র\u200d্যা/ন/ড/অ/ম/ /অ/্যা/ঁ/ /ৎ",
+     ":-)>..../ /@}-;-'---/ /raa/n/D/o/m/ /aa/aa/^/ /t``"),
+    ("stbmzySowr`jzgNge-m:'hoedpw.",
+     "স/ত/ব/ম/য/য/শ/অ/ও/র/`/জ/য/গ/ঙ/এ/-/ম/ঃ/'/হ/অ/এ/দ/প/ব/।",
+     "s/t/b/m/z/y/S/o/w/r/`/j/z/g/Ng/e/-/m/:/'/h/o/e/d/p/w/."),
+    ('rTO-',
+     'র/ট/ও/-',
+     'r/T/O/-'),
+    ('j.wu^mc.aDS )a-yplOdI',
+     'জ/।/ও/উ/ঁ/ম/চ/।/আ/ড/শ/ /)/আ/-/য়/প/ল/ও/দ/ঈ',
+     'j/./w/u/^/m/c/./a/D/S/ /)/a/-/y/p/l/O/d/I'),
+    (",klh:uDDOzyeo.NE.p:j'.`NuD'sO,",
+     ",/ক/ল/হ/:u/ড/ড/ও/য/য/এ/অ/।/ণ/এ/।/প/ঃ/জ/'/।/`/ণ/উ/ড/'/স/ও/,",
+     ",/k/l/h/:u/D/D/O/z/y/e/o/./N/E/./p/:/j/'/./`/N/u/D/'/s/O/,"),
+    ('NiIib- m',
+     'ণ/ই/ঈ/ই/ব/-/ /ম',
+     'N/i/I/i/b/-/ /m'),
+    ('dDghbD:S^n^lj`t`',
+     'দ/ড/ঘ/ব/ড/:S/ঁ/ন/ঁ/ল/জ/`/ত/`',
+     'd/D/gh/b/D/:S/^/n/^/l/j/`/t/`'),
+    ('uy (rDO-E',
+     'উ/য়/ /(/র/ড/ও/-/এ',
+     'u/y/ /(/r/D/O/-/E'),
+    ('`)pIlAnEkRHpTceh',
+     '`/)/প/ঈ/ল/আ/ন/এ/ক/ড়/হ/প/ট/চ/এ/হ',
+     '`/)/p/I/l/A/n/E/k/R/H/p/T/c/e/h'),
+    ("kb,):'dAE)I',ESDREb'AIiEwjcA",
+     "ক/ব/,/)/ঃ/'/দ/আ/এ/)/ঈ/'/,/এ/শ/ড/ড়/এ/ব/'/আ/ঈ/ই/এ/ও/জ/চ/আ",
+     "k/b/,/)/:/'/d/A/E/)/I/'/,/E/S/D/R/E/b/'/A/I/i/E/w/j/c/A"),
+    ("T-emdkd(orTiczUb'e",
+     "ট/-/এ/ম/দ/ক/দ/(/অ/র/ট/ই/চ/য/ঊ/ব/'/এ",
+     "T/-/e/m/d/k/d/(/o/r/T/i/c/z/U/b/'/e"),
+    ("SImrw,HjcHHp^mE'u iawt,",
+     "শ/ঈ/ম/র/ব/,/হ/জ/চ/হ/হ/প/ঁ/ম/এ/'/উ/ /ই/য়া/ও/ত/,",
+     "S/I/m/r/w/,/H/j/c/H/H/p/^/m/E/'/u/ /i/a/w/t/,"),
+    ('zo(rs mh.aUDpb:nglwr-Nr`)-go',
+     'য/অ/(/র/স/ /ম/হ/।/আ/ঊ/ড/প/ব/ঃ/ং/ল/ব/র/-/ণ/র/`/)/-/গ/অ',
+     'z/o/(/r/s/ /m/h/./a/U/D/p/b/:/ng/l/w/r/-/N/r/`/)/-/g/o'),
+    ("t(Da'IpHlk)us",
+     "ত/(/ড/আ/'/ঈ/প/হ/ল/ক/)/উ/স",
+     "t/(/D/a/'/I/p/H/l/k/)/u/s"),
+    (",tbS,t bHudmHu^y.'abyOo",
+     ",/ত/ব/শ/,/ত/ /ব/হ/উ/দ/ম/হ/উ/ঁ/য়/।/'/আ/ব/য/ও/অ",
+     ",/t/b/S/,/t/ /b/H/u/d/m/H/u/^/y/./'/a/b/y/O/o"),
+    ("UctI.)DgaStOajaa^-eIE'(Ioni",
+     "ঊ/চ/ত/ঈ/।/)/ড/গ/আ/শ/ত/ও/য়া/জ/অ/্যা/ঁ/-/এ/ঈ/এ/'/(/ঈ/অ/ন/ই",
+     "U/c/t/I/./)/D/g/a/S/t/O/a/j/aa/aa/^/-/e/I/E/'/(/I/o/n/i"),
+    ('wS)D',
+     'ও/শ/)/ড',
+     'w/S/)/D'),
+    ('n',
+     'ন',
+     'n'),
+    ("uEmg(^((rEhnAbbjm.OR,b'(y(U)TR",
+     "উ/এ/ম/গ/(/ঁ/(/(/র/এ/হ/ন/আ/ব/ব/জ/ম/।/ও/ড়/,/ব/'/(/য়/(/ঊ/)/ট/ড়",
+     "u/E/m/g/(/^/(/(/r/E/h/n/A/b/b/j/m/./O/R/,/b/'/(/y/(/U/)/T/R"),
+    (':ijs`NaghnppRDp-bbnHh`NRS.gN',
+     'ঃ/ই/জ/স/`/ণ/আ/ঘ/ন/প/প/ড়/ড/প/-/ব/ব/ন/হ/হ/`/ণ/ড়/শ/।/গ/ণ',
+     ':/i/j/s/`/N/a/gh/n/p/p/R/D/p/-/b/b/n/H/h/`/N/R/S/./g/N'),
+    ('wlco',
+     'ও/ল/চ/অ',
+     'w/l/c/o'),
+    ('^doSpo',
+     'ঁ/দ/অ/শ/প/অ',
+     '^/d/o/S/p/o'),
+    ('ee.wwppEwEyTbo',
+     'ঈ/।/ও/ও/প/প/এ/ও/এ/য়/ট/ব/অ',
+     'ee/./w/w/p/p/E/w/E/y/T/b/o'),
+    ('hH),s)DdDIk',
+     'হ/হ/)/,/স/)/ড/দ/ড/ঈ/ক',
+     'h/H/)/,/s/)/D/d/D/I/k'),
+    ('sa',
+     'স/আ',
+     's/a'),
+    ('S.^N',
+     'শ/।/ঁ/ণ',
+     'S/./^/N'),
+    ('y`jTDRkm`HTIrEd',
+     'ইয়/`/জ/ট/ড/ড়/ক/ম/`/হ/ট/ঈ/র/এ/দ',
+     'y/`/j/T/D/R/k/m/`/H/T/I/r/E/d'),
+    ("A^uIEySmj(bj-heIUsR:he'yh,S",
+     "আ/ঁ/উ/ঈ/এ/য়/শ/ম/জ/(/ব/জ/-/হ/এ/ঈ/ঊ/স/ড়/ঃ/হ/এ/'/য়/হ/,/শ",
+     "A/^/u/I/E/y/S/m/j/(/b/j/-/h/e/I/U/s/R/:/h/e/'/y/h/,/S"),
+    ("T^yOyy) I:-kapOOb^hm'",
+     "ট/ঁ/য়/ও/য়/য/)/ /ঈ/ঃ/-/ক/আ/প/ও/ও/ব/ঁ/হ/ম/'",
+     "T/^/y/O/y/y/)/ /I/:/-/k/a/p/O/O/b/^/h/m/'"),
+    ('hs`NwdD^bdkgboaupHh(URzs^z',
+     'হ/স/`/ণ/ব/দ/ড/ঁ/ব/দ/ক/গ/ব/অ/য়া/উ/প/হ/হ/(/ঊ/ড়/য/স/ঁ/য',
+     'h/s/`/N/w/d/D/^/b/d/k/g/b/o/a/u/p/H/h/(/U/R/z/s/^/z'),
+    (',D',
+     ',/ড',
+     ',/D'),
+    ("^'dTjN:'tws'`kA aioz,m",
+     "ঁ/'/দ/ট/জ/ণ/ঃ/'/ত/ব/স/'/`/ক/আ/ /আ/ই/অ/য/,/ম",
+     "^/'/d/T/j/N/:/'/t/w/s/'/`/k/A/ /a/i/o/z/,/m"),
+    ('dymotsscH(g',
+     'দ/য/ম/অ/ত/স/স/চ/হ/(/গ',
+     'd/y/m/o/t/s/s/c/H/(/g'),
+    ('Npcbwthy',
+     'ণ/প/চ/ব/ব/থ/য',
+     'N/p/c/b/w/th/y'),
+    ("'Dhrtb-UsUcewhAb'-g)Oe.(rIsyE",
+     "'/ঢ/র/ত/ব/-/ঊ/স/ঊ/চ/এ/ও/হ/আ/ব/'/-/গ/)/ও/এ/।/(/র/ঈ/স/য/এ",
+     "'/Dh/r/t/b/-/U/s/U/c/e/w/h/A/b/'/-/g/)/O/e/./(/r/I/s/y/E"),
+    ('c-U-)p(E-NgsNE^IbSuRIUr)dbbym',
+     'চ/-/ঊ/-/)/প/(/এ/-/ঙ/স/ণ/এ/ঁ/ঈ/ব/শ/উ/ড়/ঈ/ঊ/র/)/দ/ব/ব/য/ম',
+     'c/-/U/-/)/p/(/E/-/Ng/s/N/E/^/I/b/S/u/R/I/U/r/)/d/b/b/y/m'),
+    ('A^ ,,jkD)z^tzoEhT,TDetdethAuT',
+     'আ/ঁ/ /্/জ/ক/ড/)/য/ঁ/ত/য/অ/এ/হ/ট/,/ট/ড/এ/ত/দ/এ/থ/আ/উ/ট',
+     'A/^/ /,,/j/k/D/)/z/^/t/z/o/E/h/T/,/T/D/e/t/d/e/th/A/u/T'),
+    ("tAyOmDrdErArriakRd'hja",
+     "ত/আ/য়/ও/ম/ড/র/দ/এ/র/আ/ঋ/য়া/ক/ড়/দ/'/হ/জ/আ",
+     "t/A/y/O/m/D/r/d/E/r/A/rri/a/k/R/d/'/h/j/a"),
+    (" EaNRA'",
+     " /এ/য়া/ণ/ড়/আ/'",
+     " /E/a/N/R/A/'"),
+    ('hiUEwrmg',
+     'হ/ই/ঊ/এ/ও/র/ম/গ',
+     'h/i/U/E/w/r/m/g'),
+    ('j',
+     'জ',
+     'j'),
+)
+
+
+class _TestSinglePassTransliteration(unittest.TestCase):
+
+    def setUp(self):
+        from .ruleparser import Rule
+        self.rule = Rule('avro')
+
+    def _compare(self, context, raw, values, sources):
+        conv = self.rule.transliterator(context, raw)
+        self.assertEqual("/".join(b.v for b in conv), values)
+        self.assertEqual("/".join(b.source.v for b in conv), sources)
+        self.assertFalse(any(b.flags for b in conv))
+
+    def test_identical_to_shrinking_candidates(self):
+        for raw, values, sources in _BASELINE_TRANSLITERATIONS:
+            with self.subTest(raw=raw):
+                self._compare(Cord(), raw, values, sources)
+
+        self._compare(
+            self.rule.transliterator(Cord(), 'ka'), 'yOga',
+            'য়/ও/গ/আ', 'y/O/g/a')
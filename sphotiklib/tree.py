@@ -1,4 +1,9 @@
+import random
 import operator
+import unittest
+import itertools
+from array import array
+from bisect import bisect_left
 from functools import reduce
 from collections import deque
 
@@ -31,10 +36,11 @@ class TreeNode:
         current_node.value = value
 
         # Update longest_subpath_size for self and all the ancestors.
-        parent = self
+        parent, size = self, len(path)
         while parent is not None:
-            parent.longest_subpath_size += len(path)
-            parent = parent.parent
+            parent.longest_subpath_size = max(
+                parent.longest_subpath_size, size)
+            parent, size = parent.parent, size + 1
 
         # Return the node where value was attached.
         return current_node
@@ -120,3 +126,349 @@ class TreeNode:
             c.transform(register)
 
         return "\n".join(sorted(nodes))
+
+
+class FlatTree:
+    """ An immutable trie, stored in a handful of flat arrays.
+
+    Nodes are numbered in breadth-first order, with the root being node 0.
+    Outgoing edges of node 'i' occupy the slice
+    '_edge_first[i]:_edge_first[i + 1]' of '_edge_keys' and '_edge_targets',
+    sorted by key. Hence a lookup of a child is a binary search within a
+    slice of an array, rather than a walk through python objects.
+
+    Like TreeNode, a node without a value has the value None.
+    """
+
+    def __init__(self, items=()):
+        # Build a temporary dict-of-dicts trie first.
+        root = {}
+        values = {}
+        for path, value in items:
+            node = root
+            for key in path:
+                node = node.setdefault(key, {})
+            values[id(node)] = value
+
+        self._edge_first = array('i', [0])
+        self._edge_keys = []
+        self._edge_targets = array('i')
+        self._values = []
+
+        # Equal keys share a single object.
+        keys = {}
+
+        # Number the nodes in breadth-first order.
+        self.longest_subpath_size = 0
+        nodes = deque([(root, 0)])
+        next_id = 1
+        while nodes:
+            node, depth = nodes.popleft()
+            self._values.append(values.get(id(node)))
+            self.longest_subpath_size = max(self.longest_subpath_size, depth)
+
+            for key in sorted(node):
+                self._edge_keys.append(keys.setdefault(key, key))
+                self._edge_targets.append(next_id)
+                nodes.append((node[key], depth + 1))
+                next_id += 1
+
+            self._edge_first.append(len(self._edge_keys))
+
+        # All the keys used in any of the paths.
+        self.alphabet = frozenset(keys)
+
+    def _child(self, node, key):
+        lo, hi = self._edge_first[node], self._edge_first[node + 1]
+        i = bisect_left(self._edge_keys, key, lo, hi)
+        if i < hi and self._edge_keys[i] == key:
+            return self._edge_targets[i]
+        return None
+
+    def get_value_for_path(self, path):
+        node = 0
+        for key in path:
+            node = self._child(node, key)
+            if node is None:
+                raise KeyError(key)
+        return self._values[node]
+
+    def path_is_leaf(self, path):
+        node = 0
+        for key in path:
+            node = self._child(node, key)
+            if node is None:
+                raise KeyError(key)
+        return self._edge_first[node] == self._edge_first[node + 1]
+
+    def longest_match(self, seq, offset=0):
+        """ Find the longest path with a value, that is a prefix of
+        'seq[offset:]'.
+
+        Returns a tuple of the size of the path and it's value. If
+        no such path exists, the tuple (0, None) is returned.
+        """
+        keys, targets, first = (
+            self._edge_keys, self._edge_targets, self._edge_first)
+
+        node = 0
+        match_size, match_value = 0, None
+        for i in range(offset, len(seq)):
+            key = seq[i]
+            lo, hi = first[node], first[node + 1]
+            j = bisect_left(keys, key, lo, hi)
+            if j == hi or keys[j] != key:
+                break
+
+            node = targets[j]
+            value = self._values[node]
+            if value is not None:
+                match_size, match_value = i - offset + 1, value
+
+        return match_size, match_value
+
+    def prefix_matches(self, seq, offset=0):
+        """ Yield a tuple of the size and the value of every path with
+        a value, that is a prefix of 'seq[offset:]', shortest first.
+        """
+        keys, targets, first = (
+            self._edge_keys, self._edge_targets, self._edge_first)
+
+        node = 0
+        if self._values[node] is not None:
+            yield 0, self._values[node]
+
+        for i in range(offset, len(seq)):
+            key = seq[i]
+            lo, hi = first[node], first[node + 1]
+            j = bisect_left(keys, key, lo, hi)
+            if j == hi or keys[j] != key:
+                break
+
+            node = targets[j]
+            value = self._values[node]
+            if value is not None:
+                yield i - offset + 1, value
+
+    def items(self):
+        """ Yield (path, value) pairs of all the nodes having a value."""
+        nodes = deque([((), 0)])
+        while nodes:
+            path, node = nodes.popleft()
+            if self._values[node] is not None:
+                yield path, self._values[node]
+
+            lo, hi = self._edge_first[node], self._edge_first[node + 1]
+            for i in range(lo, hi):
+                nodes.append(
+                    (path + (self._edge_keys[i],), self._edge_targets[i]))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __str__(self):
+        return "\n".join(sorted(
+            "{} -> {}".format(" / ".join(path), value)
+            for path, value in self.items()))
+
+
+class ChoiceTree:
+    """ A trie whose edges are labelled with sets of keys.
+
+    A path of the tree stands for every sequence made by picking a key from
+    each of it's sets, without ever spelling those sequences out. Edges of
+    a node may overlap, hence a sequence is followed along every matching
+    path at once. The sets of nodes reached this way are remembered, which
+    makes the tree a lazily built DFA.
+    """
+
+    def __init__(self, items=()):
+        self._edges = [[]]
+        self._values = [None]
+        self.longest_subpath_size = 0
+
+        alphabet = set()
+        for path, value in items:
+            node = 0
+            for depth, choices in enumerate(path, 1):
+                choices = frozenset(choices)
+                alphabet.update(choices)
+
+                for edge, target in self._edges[node]:
+                    if edge == choices:
+                        node = target
+                        break
+                else:
+                    self._edges.append([])
+                    self._values.append(None)
+                    self._edges[node].append((choices, len(self._values) - 1))
+                    node = len(self._values) - 1
+
+                self.longest_subpath_size = max(
+                    self.longest_subpath_size, depth)
+
+            self._values[node] = value
+
+        # All the keys used in any of the paths.
+        self.alphabet = frozenset(alphabet)
+
+        self._root_state = frozenset([0])
+        self._transitions = {}
+        self._state_values = {}
+
+    def _step(self, state, key):
+        try:
+            return self._transitions[state, key]
+        except KeyError:
+            pass
+
+        newstate = frozenset(
+            target
+            for node in state
+            for choices, target in self._edges[node]
+            if key in choices)
+        self._transitions[state, key] = newstate
+        return newstate
+
+    def _state_value(self, state):
+        try:
+            return self._state_values[state]
+        except KeyError:
+            pass
+
+        # Where paths of different values meet, the earliest one wins.
+        value = next(
+            (self._values[node] for node in sorted(state)
+             if self._values[node] is not None), None)
+        self._state_values[state] = value
+        return value
+
+    def longest_match(self, seq, offset=0):
+        """ Find the longest path with a value, that matches a prefix
+        of 'seq[offset:]'.
+
+        Returns a tuple of the size of the match and the value. If there
+        is no match, the tuple (0, None) is returned.
+        """
+        state = self._root_state
+        match_size, match_value = 0, None
+        for i in range(offset, len(seq)):
+            if seq[i] not in self.alphabet:
+                break
+
+            state = self._step(state, seq[i])
+            if not state:
+                break
+
+            value = self._state_value(state)
+            if value is not None:
+                match_size, match_value = i - offset + 1, value
+
+        return match_size, match_value
+
+    def items(self):
+        """ Yield (path, value) pairs of all the nodes having a value,
+        where a path is a tuple of sorted tuples of keys.
+        """
+        nodes = deque([((), 0)])
+        while nodes:
+            path, node = nodes.popleft()
+            if self._values[node] is not None:
+                yield path, self._values[node]
+
+            for choices, target in self._edges[node]:
+                nodes.append((path + (tuple(sorted(choices)),), target))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __str__(self):
+        return "\n".join(sorted(
+            "{} -> {}".format(
+                " / ".join(
+                    c[0] if len(c) == 1 else "({})".format("".join(c))
+                    for c in path),
+                value)
+            for path, value in self.items()))
+
+
+class _TestTreeNode(unittest.TestCase):
+
+    def test_longest_subpath_size(self):
+        t = TreeNode("root")
+        t.set_value_for_path("abc", 1)
+        t.set_value_for_path("ab", 2)
+        t.set_value_for_path("b", 3)
+        child = t.children["a"]
+        child.set_value_for_path("bcde", 4)
+
+        self.assertEqual(t.longest_subpath_size, 5)
+        self.assertEqual(child.longest_subpath_size, 4)
+        self.assertEqual(
+            t.longest_subpath_size, t.get_longest_subpath_size())
+
+
+class _TestFlatTree(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = {"a": 1, "aa": 2, "b": 3, "abc": 4, "bcd": 5}
+        self.tree = FlatTree(self.paths.items())
+
+    def test_lookup(self):
+        for path, value in self.paths.items():
+            self.assertEqual(self.tree.get_value_for_path(path), value)
+
+        self.assertIsNone(self.tree.get_value_for_path("ab"))
+        self.assertRaises(KeyError, self.tree.get_value_for_path, "ac")
+        self.assertTrue(self.tree.path_is_leaf("abc"))
+        self.assertFalse(self.tree.path_is_leaf("ab"))
+
+    def test_longest_match(self):
+        self.assertEqual(self.tree.longest_match("abcab"), (3, 4))
+        self.assertEqual(self.tree.longest_match("abd"), (1, 1))
+        self.assertEqual(self.tree.longest_match("xabd", 1), (1, 1))
+        self.assertEqual(self.tree.longest_match("bcx"), (1, 3))
+        self.assertEqual(self.tree.longest_match("c"), (0, None))
+        self.assertEqual(self.tree.longest_match("a", 1), (0, None))
+
+    def test_prefix_matches(self):
+        self.assertEqual(
+            list(self.tree.prefix_matches("aab")), [(1, 1), (2, 2)])
+        self.assertEqual(
+            list(self.tree.prefix_matches("xabc", 1)), [(1, 1), (3, 4)])
+        self.assertEqual(list(self.tree.prefix_matches("c")), [])
+
+    def test_depth(self):
+        self.assertEqual(self.tree.longest_subpath_size, 3)
+        self.assertEqual(dict(
+            ("".join(p), v) for p, v in self.tree.items()), self.paths)
+
+
+class _TestChoiceTree(unittest.TestCase):
+
+    def setUp(self):
+        self.patterns = [
+            ("a", "bcd"), ("ab", "c"), ("a",), ("b", "b", "xy"), ("d", "ad"),
+        ]
+        self.tree = ChoiceTree((p, True) for p in self.patterns)
+
+        # The same tree, with every choice spelled out.
+        self.expanded = FlatTree(
+            ("".join(seq), True)
+            for p in self.patterns for seq in itertools.product(*p))
+
+    def test_attributes(self):
+        self.assertEqual(self.tree.alphabet, self.expanded.alphabet)
+        self.assertEqual(
+            self.tree.longest_subpath_size,
+            self.expanded.longest_subpath_size)
+
+    def test_same_as_expanded(self):
+        rand = random.Random(0)
+        for i in range(2000):
+            seq = "".join(
+                rand.choice("abcdxyz") for _ in range(rand.randint(0, 6)))
+            offset = rand.randint(0, 2)
+            self.assertEqual(
+                self.tree.longest_match(seq, offset),
+                self.expanded.longest_match(seq, offset), seq)
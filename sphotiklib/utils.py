@@ -1,32 +1,58 @@
-import weakref
+import random
+import unittest
+import itertools
+
+
+# Flags of DstBeads. A bead holds a bitwise OR of them.
+DIACRITIC = 1 << 0
+CONJOINED = 1 << 1
+FORCED_DIACRITIC = 1 << 2
+
+FLAG_NAMES = {
+    'DIACRITIC': DIACRITIC,
+    'CONJOINED': CONJOINED,
+    'FORCED_DIACRITIC': FORCED_DIACRITIC,
+}
+
+
+def flags_from_names(names):
+    flags = 0
+    for name in names:
+        flags |= FLAG_NAMES[name]
+    return flags
+
+
+def flag_names(flags):
+    return [name for name, flag in sorted(
+        FLAG_NAMES.items(), key=lambda x: x[1]) if flags & flag]
 
 
 class SrcBead:
+    __slots__ = ('v', 'contextual')
 
-    def __init__(self, val):
+    def __init__(self, val, contextual=False):
         self.v = val
-        self.destinations = []
-
-    def _remove_destination(self, weakref_of_dst):
-        self.destinations.remove(weakref_of_dst)
 
-    def add_destination(self, dst):
-        self.destinations.append(weakref.ref(dst, self._remove_destination))
+        # Whether the bead was transliterated by a contextual rule.
+        self.contextual = contextual
 
 
 class DstBead:
+    # Beads of a single source are always created next to each other.
+    # Hence the beads produced from a source are found by walking along
+    # the cord from one of them, comparing their source.
+    __slots__ = ('v', 'source', 'flags', 'insseq')
 
-    def __init__(self, val, src, flags=set()):
+    def __init__(self, val, src, flags=0):
         self.v = val
         self.source = src
-        self.source.add_destination(self)
-        self.flags = set(flags)
+        self.flags = flags
 
-    def add_flags(self, *args):
-        self.flags.update(args)
+    def add_flags(self, flags):
+        self.flags |= flags
 
-    def remove_flags(self, *args):
-        self.flags.difference_update(args)
+    def remove_flags(self, flags):
+        self.flags &= ~flags
 
     def __add__(self, other):
         return Cord((self, other))
@@ -35,38 +61,214 @@ class DstBead:
         return "({}/{}{})".format(
             self.v,
             self.source.v,
-            '|' + ('|'.join(self.flags)) if self.flags else '')
+            '|' + ('|'.join(flag_names(self.flags))) if self.flags else '')
 
     def __repr__(self):
         return self.__str__()
 
 
 class Cord:
+    """ A sequence of DstBeads.
+
+    Beads are stored in a gap buffer; a list with an unused region (the
+    gap) somewhere in it. The gap is moved to wherever an edit happens,
+    so that consecutive insertions and deletions around the same position
+    (i.e. the cursor) cost O(1) amortized, regardless of the size of the
+    cord.
+
+    Concatenation and slicing return new cords and leave the operands
+    untouched. Only insert(), delete(), replace() and extend() modify a
+    cord in place.
+    """
+
+    _MIN_GAP_SIZE = 16
 
     def __init__(self, items=()):
-        self._data = tuple(items)
+        self._buf = list(items)
+        self._gap_start = self._gap_end = len(self._buf)
+
+    def _move_gap(self, index):
+        buf, gs, ge = self._buf, self._gap_start, self._gap_end
+
+        if index < gs:
+            k = gs - index
+            moved = buf[index:gs]
+            buf[index:gs] = [None] * k
+            buf[ge - k:ge] = moved
+            self._gap_start, self._gap_end = index, ge - k
+
+        elif index > gs:
+            k = index - gs
+            moved = buf[ge:ge + k]
+            buf[ge:ge + k] = [None] * k
+            buf[gs:gs + k] = moved
+            self._gap_start, self._gap_end = index, ge + k
+
+    def _ensure_gap(self, size):
+        gs, ge = self._gap_start, self._gap_end
+        if ge - gs >= size:
+            return
+
+        # Grow the gap in proportion to the cord, so that
+        # reallocations get rarer as the cord grows.
+        newgap = max(size, len(self) // 2, self._MIN_GAP_SIZE)
+        self._buf[gs:ge] = [None] * newgap
+        self._gap_end = gs + newgap
+
+    def _index(self, index):
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("Cord index out of range")
+
+        return (
+            index if index < self._gap_start
+            else index + self._gap_end - self._gap_start)
+
+    def _range(self, start, end):
+        size = len(self)
+        start = min(max(0, start), size)
+        end = min(max(start, end), size)
+        return start, end
+
+    def insert(self, index, items):
+        """ Insert beads at a position. """
+        items = list(items)
+        index, _ = self._range(index, index)
+        self._move_gap(index)
+        self._ensure_gap(len(items))
+
+        gs = self._gap_start
+        self._buf[gs:gs + len(items)] = items
+        self._gap_start = gs + len(items)
+
+    def delete(self, start, end):
+        """ Delete beads in the range [start, end). """
+        start, end = self._range(start, end)
+        self._move_gap(start)
+
+        ge = self._gap_end
+        self._buf[ge:ge + end - start] = [None] * (end - start)
+        self._gap_end = ge + end - start
+
+    def replace(self, start, end, items):
+        """ Replace beads in the range [start, end) with other beads. """
+        start, end = self._range(start, end)
+        self.delete(start, end)
+        self.insert(start, items)
+
+    def extend(self, items):
+        self.insert(len(self), items)
 
     def __add__(self, other):
         if isinstance(other, Cord):
-            return Cord(self._data + other._data)
+            return Cord(itertools.chain(self, other))
         elif isinstance(other, DstBead):
-            return Cord(self._data + (other,))
+            return Cord(itertools.chain(self, (other,)))
         else:
             raise TypeError(
                 "Can not concatenate 'Cord' to {}".format(type(other)))
 
     def __len__(self):
-        return len(self._data)
+        return len(self._buf) - (self._gap_end - self._gap_start)
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return Cord(self._data[key])
+            start, end, step = key.indices(len(self))
+            if step != 1:
+                return Cord(list(self)[key])
+            if end <= start:
+                return Cord()
+
+            gs, ge = self._gap_start, self._gap_end
+            if end <= gs:
+                return Cord(self._buf[start:end])
+
+            gap = ge - gs
+            if start >= gs:
+                return Cord(self._buf[start + gap:end + gap])
+
+            return Cord(self._buf[start:gs] + self._buf[ge:end + gap])
         else:
-            return self._data[key]
+            return self._buf[self._index(key)]
+
+    def __iter__(self):
+        return itertools.chain(
+            self._buf[:self._gap_start], self._buf[self._gap_end:])
+
+    def __reversed__(self):
+        return itertools.chain(
+            reversed(self._buf[self._gap_end:]),
+            reversed(self._buf[:self._gap_start]))
 
     def __str__(self):
-        return "".join(map(str, self._data))
+        return "".join(map(str, self))
 
     @property
     def text(self):
-        return "".join([x.v for x in self._data])
+        return "".join([x.v for x in self])
+
+
+class _TestBead(unittest.TestCase):
+
+    def test_flags(self):
+        bead = DstBead('a', SrcBead('a'), flags_from_names(['DIACRITIC']))
+        bead.add_flags(CONJOINED | FORCED_DIACRITIC)
+        bead.remove_flags(DIACRITIC)
+        self.assertEqual(bead.flags, CONJOINED | FORCED_DIACRITIC)
+        self.assertEqual(
+            flag_names(bead.flags), ['CONJOINED', 'FORCED_DIACRITIC'])
+        self.assertEqual(str(bead), '(a/a|CONJOINED|FORCED_DIACRITIC)')
+
+
+class _TestCord(unittest.TestCase):
+
+    def test_against_list(self):
+        rnd = random.Random(0)
+        src = SrcBead('x')
+        beads = [DstBead(str(i), src) for i in range(1000)]
+
+        cord, model = Cord(beads[:10]), beads[:10]
+        for i in range(2000):
+            start = rnd.randint(0, len(model))
+            end = rnd.randint(start, min(len(model), start + 5))
+            items = rnd.sample(beads, rnd.randint(0, 5))
+
+            op = rnd.choice(('insert', 'delete', 'replace', 'extend'))
+            if op == 'insert':
+                cord.insert(start, items)
+                model[start:start] = items
+            elif op == 'delete':
+                cord.delete(start, end)
+                del model[start:end]
+            elif op == 'replace':
+                cord.replace(start, end, items)
+                model[start:end] = items
+            else:
+                cord.extend(items)
+                model.extend(items)
+
+            self.assertEqual(len(cord), len(model))
+            self.assertEqual(list(cord), model)
+            self.assertEqual(list(reversed(cord)), model[::-1])
+            self.assertEqual(list(cord[start:end]), model[start:end])
+            self.assertEqual(list(cord[-3:]), model[-3:])
+            if model:
+                self.assertIs(cord[-1], model[-1])
+                self.assertIs(cord[start % len(model)],
+                              model[start % len(model)])
+
+        self.assertRaises(IndexError, cord.__getitem__, len(model))
+
+    def test_value_semantics(self):
+        src = SrcBead('ab')
+        a, b = DstBead('a', src), DstBead('b', src)
+
+        cord = Cord([a])
+        joined = cord + b
+        cord.insert(0, [b])
+        self.assertEqual(joined.text, 'ab')
+        self.assertEqual(cord.text, 'ba')
+        self.assertEqual(cord[:1].text, 'b')
+        self.assertEqual((cord + joined).text, 'baab')
@@ -1,6 +1,6 @@
 
 # vim: tabstop=4 expandtab shiftwidth=4
-from .utils import SrcBead, DstBead, Cord
+from .utils import SrcBead, DstBead, Cord, DIACRITIC, FORCED_DIACRITIC
 
 
 class Vowelshaper:
@@ -9,23 +9,31 @@ class Vowelshaper:
         self.vowels = vowels
         self.vowelhosts = vowelhosts
 
-    def __call__(self, cord):
-        for pos, bead in enumerate(cord):
+    def __call__(self, cord, start=0, end=None):
+        """ Shape the vowels of beads in range [start, end) of the cord.
+
+        The shape of a vowel depends on the bead before it, hence the
+        bead right after the range is reshaped as well.
+        """
+        end = len(cord) if end is None else min(len(cord), end + 1)
+
+        for pos in range(start, end):
+            bead = cord[pos]
             if bead.v not in self.vowels:
                 continue
 
-            if 'FORCED_DIACRITIC' in bead.flags:
+            if bead.flags & FORCED_DIACRITIC:
                 continue
 
             if pos == 0:
-                bead.remove_flags('DIACRITIC')
+                bead.remove_flags(DIACRITIC)
                 continue
 
             if cord[max(0, pos - 1)].v in self.vowelhosts:
-                bead.add_flags('DIACRITIC')
+                bead.add_flags(DIACRITIC)
                 continue
             else:
-                bead.remove_flags('DIACRITIC')
+                bead.remove_flags(DIACRITIC)
                 continue
 
         return cord